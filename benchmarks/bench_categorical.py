@@ -0,0 +1,93 @@
+"""
+Benchmark of categorical encoding: LabelEncoder with a float cast, as train_test_split used to do, against the
+fixed-vocabulary category dtypes of data_train.categorical.
+
+Usage (from the repository root, with src on PYTHONPATH):
+    python -m benchmarks.bench_categorical --pigeons 20000 --races 400 --per-race 1500
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import LabelEncoder
+
+from benchmarks.synthetic import add_categoricals, race_history
+from data_train.categorical import UNSEEN_CODE, encode, fit_vocab, to_categorical
+
+CATEGORICAL = [
+    'race_point_name',
+    'race_name',
+    'wind_direction_compass_sicily',
+    'wind_direction_compass_malta',
+    'wind_direction_compass_departure',
+    'release_month',
+    'pigeon_id',
+]
+
+
+def label_encoded(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for c in CATEGORICAL:
+        # LabelEncoder cannot sort None among strings, so missing values become the string 'None'
+        df[c] = LabelEncoder().fit_transform(df[c].astype(str) if df[c].dtype == object else df[c])
+    df[CATEGORICAL] = df[CATEGORICAL].astype(float)
+    return df
+
+
+def category_encoded(df: pd.DataFrame) -> pd.DataFrame:
+    categories = {}
+    for c in CATEGORICAL:
+        vocab = fit_vocab(df[c])
+        categories[c] = to_categorical(encode(vocab, df[c]), vocab)
+    return df.assign(**categories)
+
+
+def measure(fn, df: pd.DataFrame, repeat: int = 3) -> tuple[float, float, pd.DataFrame]:
+    """Best wall time and peak traced allocation in MB of fn(df), and its output"""
+    best, out = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(df)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 2 ** 20, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pigeons', type=int, default=20_000)
+    parser.add_argument('--races', type=int, default=400)
+    parser.add_argument('--per-race', type=int, default=1_500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = add_categoricals(race_history(args.pigeons, args.races, args.per_race))
+    print(f'{len(df):,} race results, {len(CATEGORICAL)} categorical columns')
+
+    results = {}
+    for name, fn in (('LabelEncoder + float', label_encoded), ('category dtype', category_encoded)):
+        seconds, peak, df_out = measure(fn, df, repeat=args.repeat)
+        column_mb = df_out[CATEGORICAL].memory_usage(deep=True, index=False).sum() / 2 ** 20
+        results[name] = seconds, peak, column_mb, df_out
+
+    df_cat = results['category dtype'][3]
+    for c in CATEGORICAL:
+        # decoding gives back the original values, and missing values have the reserved unseen code
+        vocab, codes = fit_vocab(df[c]), df_cat[c].to_numpy(int)
+        known = df[c].notna().to_numpy()
+        round_trip = np.array_equal(vocab[codes[known] - 1], df[c][known].to_numpy(vocab.dtype))
+        unseen = (codes[~known] == UNSEEN_CODE).all()
+        print(f'{c:>34}: {len(vocab):>6} categories, round trip {round_trip}, missing unseen {unseen}')
+
+    base = results['LabelEncoder + float']
+    for name, (seconds, peak, column_mb, _) in results.items():
+        print(
+            f'{name:>22}: {seconds:.3f}s ({base[0] / seconds:.1f}x), peak allocation {peak:,.0f} MB, '
+            f'encoded columns {column_mb:,.1f} MB'
+        )
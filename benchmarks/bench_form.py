@@ -0,0 +1,66 @@
+"""
+Benchmark of rolling_form against the pandas groupby implementation it replaced.
+
+Usage (from the repository root, with src on PYTHONPATH):
+    python -m benchmarks.bench_form --pigeons 20000 --races 400 --per-race 1500
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import race_history
+from data_train.form import form_column, rolling_form
+
+COMPARE_COLUMNS = ['velocity_lag', 'race_count', 'total_race_count', 'velocity_form_linear']
+
+
+def pandas_form(df: pd.DataFrame, halflives: list[str]) -> pd.DataFrame:
+    df = df.sort_values(['pigeon_id', 'release_datetime']).reset_index(drop=True)
+    df['velocity_lag'] = df.groupby('pigeon_id').velocity.shift()
+    df['race_count'] = df.groupby('pigeon_id').velocity_lag.cumcount()
+    df['total_race_count'] = df.groupby('pigeon_id').pigeon_id.transform('count')
+    for halflife in halflives:
+        df[form_column(halflife)] = df.groupby('pigeon_id').velocity_lag.ewm(
+            halflife=halflife, times=pd.DatetimeIndex(df.release_datetime)
+        ).mean().values
+    df['velocity_form_linear'] = df.groupby('pigeon_id').velocity_lag.expanding().mean().values
+    return df
+
+
+def timed(fn, *args, repeat: int = 3) -> tuple[float, object]:
+    best, out = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pigeons', type=int, default=20_000)
+    parser.add_argument('--races', type=int, default=400)
+    parser.add_argument('--per-race', type=int, default=1_500)
+    parser.add_argument('--halflives', nargs='+', default=['30 days', '60 days', '180 days'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = race_history(args.pigeons, args.races, args.per_race)
+    df.loc[df.sample(frac=0.02, random_state=0).index, 'velocity'] = np.nan
+    print(f'{len(df):,} race results, {df.pigeon_id.nunique():,} pigeons, halflives {args.halflives}')
+
+    t_pandas, df_pandas = timed(pandas_form, df, args.halflives, repeat=args.repeat)
+    t_engine, (df_engine, _) = timed(rolling_form, df, args.halflives, repeat=args.repeat)
+
+    columns = COMPARE_COLUMNS + [form_column(halflife) for halflife in args.halflives]
+    df_pandas = df_pandas.sort_values(['pigeon_id', 'release_datetime', 'race_id']).reset_index(drop=True)
+    df_engine = df_engine.sort_values(['pigeon_id', 'release_datetime', 'race_id']).reset_index(drop=True)
+    for c in columns:
+        max_err = np.nanmax(np.abs(df_pandas[c].astype(float) - df_engine[c].astype(float)))
+        same_nan = (df_pandas[c].isna() == df_engine[c].isna()).all()
+        print(f'{c:>24}: max abs diff {max_err:.2e}, same missing values {same_nan}')
+
+    print(f'pandas groupby: {t_pandas:.3f}s')
+    print(f'rolling_form:   {t_engine:.3f}s ({t_pandas / t_engine:.1f}x)')
@@ -0,0 +1,264 @@
+"""
+End-to-end benchmark of ingestion and training against the local stand-in of the federation API, see
+benchmarks.mock_federation, at several scales of the federation.
+
+For every scale the mock server is started in its own process, and a fresh process, pointed at it by BASE_URL and
+GFZ_URL and at a temporary DATA_PATH and MODEL_PATH, times:
+    * get_all_data: every federation request, normalising, weather, Kp index and the merge of the results
+    * clean_race_results: the races joined with their race points and club stats
+    * include_weather_stats: with the weather grid built by get_all_data
+    * calculate_pigeon_form: over df_race_results_final
+    * model: VelocityModel built on df_race_results_final, pigeon form included
+    * fit: Model.fit with --estimators boosting rounds
+Hourly weather of the grid nodes is seeded into the weather cache beforehand, so that no stage touches the network.
+Errors injected by --error-rate are retried by the federation client, and their count is reported with the run.
+
+Every run is appended to a results file with the commit it ran on, and compared to the previous run of the same
+scale and settings: stages slower by more than --threshold, and by more than MIN_REGRESSION_SECONDS, are flagged.
+
+Usage (from the repository root, with src on PYTHONPATH):
+    python -m benchmarks.bench_ingestion --scales small medium --latency 0.005
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+from src import DATA_PATH
+
+# pigeons, races and pigeons per race
+SCALES = {
+    'small': (2_000, 60, 300),
+    'medium': (10_000, 200, 1_000),
+    'large': (20_000, 400, 1_500),
+}
+STAGES = ('get_all_data', 'clean_race_results', 'include_weather_stats', 'calculate_pigeon_form', 'model', 'fit')
+RESULTS_FILE = os.path.join(DATA_PATH, 'benchmarks', 'ingestion.jsonl')
+SERVER_START_SECONDS = 60
+# slowdowns shorter than this are noise, however large relative to a stage of a few milliseconds
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def seed_weather(release: pd.DatetimeIndex, seed: int = 0) -> None:
+    """Writes synthetic hourly weather of the release hours to the weather cache of every grid node"""
+    from src.data_preprocess.loaders import meteostat
+    from src.data_preprocess.loaders.weather_grid import WeatherGrid
+
+    rng = np.random.default_rng(seed)
+    grid = WeatherGrid()
+    hours = pd.DatetimeIndex(release.floor('h').unique().sort_values(), name='time')
+    n = len(hours)
+    for lat, lon in itertools.product(grid.lats, grid.lons):
+        df = pd.DataFrame({
+            'temp': rng.normal(20, 5, n),
+            'dwpt': rng.normal(12, 4, n),
+            'rhum': rng.uniform(40, 95, n),
+            'prcp': rng.exponential(0.2, n),
+            'wdir': rng.uniform(0, 360, n),
+            'wspd': rng.gamma(2, 8, n),
+            'pres': rng.normal(1015, 6, n),
+        }, index=hours)
+        meteostat._save_cache(float(lat), float(lon), df[meteostat.WEATHER_FIELDS])
+
+
+def measure(scale: str, estimators: int) -> None:
+    """Times every stage at a scale and prints the timings and row counts as one json line"""
+    from benchmarks.mock_federation import MockFederation
+    from data_train.models.generic import calculate_pigeon_form
+    from data_train.models.velocity import VelocityModel
+    from src.data_preprocess.data_load import clean_race_results, get_all_data, include_weather_stats
+
+    federation = MockFederation(*SCALES[scale])
+    seed_weather(federation.release)
+    seconds = {}
+
+    start = time.perf_counter()
+    df_races, _, _, df_race_results, _, df_race_results_final = asyncio.run(get_all_data())
+    seconds['get_all_data'] = time.perf_counter() - start
+
+    races, race_points = federation.races(), federation.race_points()
+    race_club_stats = [stats for race in races for stats in federation.bookings(race['id'])]
+    start = time.perf_counter()
+    df_races_clean = clean_race_results(races, race_points, race_club_stats)
+    seconds['clean_race_results'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    include_weather_stats(df_races_clean)
+    seconds['include_weather_stats'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    calculate_pigeon_form(df_race_results_final.copy())
+    seconds['calculate_pigeon_form'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = VelocityModel(df_race_results_final, 'velocity_params.yaml')
+    seconds['model'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.fit(num_boost_round=estimators)
+    seconds['fit'] = time.perf_counter() - start
+
+    rows = {
+        'races': len(df_races),
+        'race_results': len(df_race_results),
+        'race_results_final': len(df_race_results_final),
+    }
+    print(json.dumps({'seconds': seconds, 'rows': rows}))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_json(url: str):
+    with urllib.request.urlopen(url, timeout=5) as res:
+        return json.load(res)
+
+
+def start_server(scale: str, port: int, latency: float, error_rate: float) -> subprocess.Popen:
+    """Starts the mock federation of a scale and waits until it answers"""
+    pigeons, races, per_race = SCALES[scale]
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'benchmarks.mock_federation', '--port', str(port), '--pigeons', str(pigeons),
+            '--races', str(races), '--per-race', str(per_race), '--latency', str(latency),
+            '--error-rate', str(error_rate),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            get_json(f'http://127.0.0.1:{port}/mock/stats')
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError(f'Mock federation exited with {server.returncode}')
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'Mock federation did not start within {SERVER_START_SECONDS}s')
+
+
+def run(scale: str, latency: float, error_rate: float, estimators: int) -> dict:
+    """Runs the measurement of a scale against a fresh mock federation and temporary data directories"""
+    port = free_port()
+    server = start_server(scale, port, latency, error_rate)
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            env = {
+                **os.environ,
+                'BASE_URL': f'http://127.0.0.1:{port}',
+                'GFZ_URL': f'http://127.0.0.1:{port}',
+                'DATA_PATH': os.path.join(path, 'data'),
+                'MODEL_PATH': os.path.join(path, 'models'),
+            }
+            command = ['-m', 'benchmarks.bench_ingestion', '--measure', scale, '--estimators', str(estimators)]
+            out = subprocess.run([sys.executable, *command], capture_output=True, text=True, env=env)
+            if out.returncode:
+                print(out.stdout[-2_000:], out.stderr[-4_000:], sep='\n')
+                raise RuntimeError(f'Measurement of {scale} failed')
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        stats = get_json(f'http://127.0.0.1:{port}/mock/stats')
+        result['requests'] = sum(n for route, n in stats['requests'].items() if not route.startswith('/mock/'))
+        result['errors'] = sum(stats['errors'].values())
+    finally:
+        server.terminate()
+        server.wait()
+    return result
+
+
+def git_commit() -> str:
+    out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True)
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def load_results(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_result(path: str, record: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def compare(record: dict, previous: dict, threshold: float) -> list[str]:
+    """Prints the timings of a run next to the previous one, returning the stages slower by more than threshold"""
+    regressions = []
+    print(
+        f'{record["scale"]}: {record["rows"]["race_results_final"]:,} result rows, {record["requests"]:,} requests, '
+        f'{record["errors"]:,} injected errors retried'
+    )
+    for stage in STAGES:
+        seconds = record['seconds'][stage]
+        line = f'{stage:>22}: {seconds:8.2f}s'
+        if previous is not None and previous['seconds'].get(stage):
+            before = previous['seconds'][stage]
+            change = seconds / before - 1
+            line += f'  was {before:8.2f}s ({change:+.0%})'
+            if change > threshold and seconds - before > MIN_REGRESSION_SECONDS:
+                line += '  REGRESSION'
+                regressions.append(stage)
+        print(line)
+    if previous is not None:
+        print(f'{"":>24}compared to {previous["commit"]} of {previous["date"]}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', choices=SCALES, default=['small', 'medium'])
+    parser.add_argument('--latency', type=float, default=0.005, help='Mean seconds every mock response is delayed')
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0, help='Share of mock federation requests answered with a 500'
+    )
+    parser.add_argument('--estimators', type=int, default=50, help='Boosting rounds of Model.fit')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown flagged as a regression')
+    parser.add_argument('--results', default=RESULTS_FILE, help='Json lines file the runs are appended to')
+    parser.add_argument('--measure', choices=SCALES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.estimators)
+        sys.exit()
+
+    history = load_results(args.results)
+    regressions = []
+    for scale in args.scales:
+        settings = {
+            'scale': scale,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'estimators': args.estimators,
+        }
+        previous = next((r for r in reversed(history) if all(r.get(k) == v for k, v in settings.items())), None)
+
+        record = {
+            **settings,
+            **run(scale, args.latency, args.error_rate, args.estimators),
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+        }
+        regressions += [f'{scale}/{stage}' for stage in compare(record, previous, args.threshold)]
+        save_result(args.results, record)
+
+    print(f'Results appended to {args.results}')
+    if regressions:
+        print(f'Regressions: {", ".join(regressions)}')
+        sys.exit(1)
@@ -0,0 +1,77 @@
+"""
+Benchmark of leaderboard queries: a scan and sort of the race results per query, as answering from
+df_race_results_final would do, against the precomputed LeaderboardIndex of data_serve.leaderboard.
+
+Usage (from the repository root, with src on PYTHONPATH):
+    python -m benchmarks.bench_leaderboard --pigeons 20000 --races 400 --per-race 1500
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import race_results_final
+from data_serve.leaderboard import DIMENSIONS, LeaderboardIndex
+
+
+def scan(df: pd.DataFrame, dimension: str, key: int, season: int, limit: int) -> list:
+    df = df[df['velocity'] > 0]
+    if DIMENSIONS[dimension] is not None:
+        df = df[df[DIMENSIONS[dimension]] == key]
+    if season is not None:
+        df = df[df['season_id'] == season]
+    df = df.sort_values('velocity', ascending=False).drop_duplicates('pigeon_id').head(limit)
+    return df['velocity'].astype('float32').tolist()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pigeons', type=int, default=20_000)
+    parser.add_argument('--races', type=int, default=400)
+    parser.add_argument('--per-race', type=int, default=1_500)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    df = race_results_final(args.pigeons, args.races, args.per_race)
+    df = df.rename(columns={'season_id_race': 'season_id', 'club_number_race': 'club_number'})
+    df['section_number'] = df['member_id'] % 7
+    print(f'{len(df):,} race results')
+
+    rng = np.random.default_rng(0)
+    queries = []
+    for i in range(args.queries):
+        dimension = list(DIMENSIONS)[i % len(DIMENSIONS)]
+        column = DIMENSIONS[dimension]
+        key = None if column is None else int(rng.choice(df[column].to_numpy()))
+        season = int(rng.choice(df['season_id'].unique())) if i % 2 else None
+        queries.append((dimension, key, season, 10))
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        index = LeaderboardIndex(path=path)
+        index.update(df)
+        build_seconds = time.perf_counter() - start
+        index.save()
+        start = time.perf_counter()
+        index = LeaderboardIndex(path=path)
+        load_seconds = time.perf_counter() - start
+    print(f'index of {len(index):,} leaderboards built in {build_seconds:.2f}s, reloaded in {load_seconds:.2f}s')
+
+    results = {}
+    for name, fn in (
+            ('scan and sort', lambda q: scan(df, *q)),
+            ('index', lambda q: [entry['velocity'] for entry in index.top(q[0], q[1], season=q[2], limit=q[3])]),
+    ):
+        times, answers = [], []
+        for query in queries:
+            start = time.perf_counter()
+            answers.append(fn(query))
+            times.append(time.perf_counter() - start)
+        results[name] = np.array(times) * 1e3, answers
+
+    same = all(np.allclose(a, b) for a, b in zip(results['scan and sort'][1], results['index'][1]))
+    print(f'same answers: {same}')
+    for name, (ms, _) in results.items():
+        print(f'{name:>14}: median {np.median(ms):.3f} ms, p99 {np.percentile(ms, 99):.3f} ms per query')
@@ -0,0 +1,90 @@
+"""
+Benchmark of the memory of df_race_results_final: read untyped, as before the declared schema (int64 ids,
+float64 points and weather, object strings), against the typed snapshot store load of data_preprocess.schema.
+
+Every variant runs in a fresh process, which loads the table and builds a VelocityModel on it, and reports its
+peak RSS, read from /proc (Linux only): ru_maxrss would carry over the peak of the parent process. The synthetic
+table is written once to a temporary directory.
+
+Usage (from the repository root, with src on PYTHONPATH):
+    python -m benchmarks.bench_memory --pigeons 20000 --races 400 --per-race 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks.synthetic import race_results_final
+from src.data_preprocess.schema import memory_usage
+from src.data_preprocess.snapshot_store import SnapshotStore
+
+LEGACY_FILE = 'legacy.parquet'
+SNAPSHOTS = 'snapshots'
+VARIANTS = ('untyped', 'schema')
+
+
+def peak_rss() -> float:
+    """Peak resident set size of this process in MB"""
+    with open('/proc/self/status', 'r') as f:
+        line = next(line for line in f if line.startswith('VmHWM:'))
+    return int(line.split()[1]) / 2 ** 10
+
+
+def measure(variant: str, path: str) -> None:
+    """Loads the table the way of variant, builds a model on it and prints the measurements as one line"""
+    start = time.perf_counter()
+    if variant == 'untyped':
+        df = pd.read_parquet(os.path.join(path, LEGACY_FILE))
+    else:
+        df = SnapshotStore(os.path.join(path, SNAPSHOTS)).load('df_race_results_final')
+    load_seconds = time.perf_counter() - start
+    frame_mb, load_rss = memory_usage(df), peak_rss()
+
+    from data_train.models.velocity import VelocityModel
+    start = time.perf_counter()
+    VelocityModel(df, 'velocity_params.yaml')
+    model_seconds = time.perf_counter() - start
+    print(f'{frame_mb:.1f} {load_rss:.1f} {peak_rss():.1f} {load_seconds:.2f} {model_seconds:.2f}')
+
+
+def run(variant: str, path: str) -> list[float]:
+    out = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench_memory', '--measure', variant, '--path', path],
+        capture_output=True, text=True, check=True,
+    )
+    return [float(x) for x in out.stdout.strip().splitlines()[-1].split()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pigeons', type=int, default=20_000)
+    parser.add_argument('--races', type=int, default=400)
+    parser.add_argument('--per-race', type=int, default=1_500)
+    parser.add_argument('--measure', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.path)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as path:
+        df = race_results_final(args.pigeons, args.races, args.per_race)
+        print(f'{len(df):,} race results, {df.shape[1]} columns')
+        df.to_parquet(os.path.join(path, LEGACY_FILE), index=False)
+        SnapshotStore(os.path.join(path, SNAPSHOTS)).write_snapshot({'df_race_results_final': df})
+        del df
+
+        results = {variant: run(variant, path) for variant in VARIANTS}
+
+    base = results['untyped']
+    for variant, (frame_mb, load_rss, model_rss, load_seconds, model_seconds) in results.items():
+        print(
+            f'{variant:>8}: frame {frame_mb:,.0f} MB ({base[0] / frame_mb:.1f}x), peak RSS after load '
+            f'{load_rss:,.0f} MB, after VelocityModel {model_rss:,.0f} MB ({base[2] / model_rss:.1f}x), '
+            f'load {load_seconds:.2f}s, model {model_seconds:.2f}s'
+        )
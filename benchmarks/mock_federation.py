@@ -0,0 +1,336 @@
+"""
+Local stand-in for the federation API, serving synthetic payloads for every /unprot endpoint used by
+MaltaPigeonFederationAPI, and the Kp index endpoint of the geomagnetic loader, so that ingestion can be benchmarked
+without the latency and rate limits of the real BASE_URL.
+
+The federation is generated from a seed: pigeons spread over 26 clubs and owned by members with lofts in Malta,
+race points in Sicily, and races released over the 2016 to 2024 seasons, each with pigeons_per_race registrations of
+which about 40% arrive. Every response is delayed by a normally distributed latency, and a share of the federation
+requests can fail with a 500 to test error handling. Request and error counts per endpoint are served at /mock/stats.
+
+Usage (from the repository root, with src on PYTHONPATH):
+    python -m benchmarks.mock_federation --port 8765 --pigeons 20000 --races 400 --per-race 1500 --latency 0.05
+    BASE_URL=http://127.0.0.1:8765 GFZ_URL=http://127.0.0.1:8765 python -m src.data_preprocess.data_load
+"""
+import argparse
+import asyncio
+from collections import Counter
+import random
+
+from aiohttp import web
+import numpy as np
+import pandas as pd
+
+N_CLUBS = 26
+PIGEONS_PER_MEMBER = 20
+ARRIVAL_RATE = 0.4
+# races span the train and test seasons of the model configs
+FIRST_RELEASE = pd.Timestamp('2016-03-05 06:00')
+LAST_RELEASE = pd.Timestamp('2024-10-01 06:00')
+# Malta lofts and Sicilian race points, south, north, west, east
+LOFT_AREA = (35.82, 36.05, 14.2, 14.55)
+RACE_POINT_AREA = (36.7, 37.2, 14.2, 15.3)
+
+
+class MockFederation:
+
+    def __init__(
+            self,
+            n_pigeons: int = 20_000,
+            n_races: int = 400,
+            pigeons_per_race: int = 1_500,
+            n_race_points: int = 12,
+            seed: int = 0,
+    ):
+        """
+        Parameters
+        ----------
+        n_pigeons: int
+        n_races: int
+            Races, released between FIRST_RELEASE and LAST_RELEASE
+        pigeons_per_race: int
+            Registrations of every race
+        n_race_points: int
+        seed: int
+        """
+        rng = np.random.default_rng(seed)
+        pigeons_per_race = min(pigeons_per_race, n_pigeons)
+        self.pigeon_ids = 100_000 + np.arange(n_pigeons)
+        self.pigeon_club = np.arange(n_pigeons) % N_CLUBS + 1
+        self.pigeon_member = np.arange(n_pigeons) // PIGEONS_PER_MEMBER
+        n_members = self.pigeon_member.max() + 1 if n_pigeons else 0
+        self.member_club = np.arange(n_members) % N_CLUBS + 1
+        self.member_section = self.member_club % 3
+        self.member_loft = np.column_stack([
+            rng.uniform(*LOFT_AREA[:2], n_members), rng.uniform(*LOFT_AREA[2:], n_members)
+        ])
+
+        self.race_point_loc = np.column_stack([
+            rng.uniform(*RACE_POINT_AREA[:2], n_race_points), rng.uniform(*RACE_POINT_AREA[2:], n_race_points)
+        ])
+        self.race_ids = 1_000 + np.arange(n_races)
+        self.race_point = rng.integers(0, n_race_points, n_races)
+        days = np.sort(rng.integers(0, (LAST_RELEASE - FIRST_RELEASE).days, n_races))
+        hours = rng.integers(0, 3, n_races)
+        self.release = FIRST_RELEASE + pd.to_timedelta(days, unit='D') + pd.to_timedelta(hours, unit='h')
+        self.release_epoch = self.release.to_numpy('datetime64[ms]').astype('int64')
+        self.race_season = self.release.year.to_numpy()
+
+        self.registered = np.stack([rng.choice(n_pigeons, pigeons_per_race, replace=False) for _ in range(n_races)])
+        self.arrived = rng.random(self.registered.shape) < ARRIVAL_RATE
+        self.velocity = np.where(self.arrived, rng.normal(1_100, 150, self.registered.shape), np.nan)
+        self.race_index = {race_id: i for i, race_id in enumerate(self.race_ids.tolist())}
+        # registrations ordered by pigeon, for the race histories of pigeons
+        flat = self.registered.ravel()
+        self.by_pigeon = np.argsort(flat, kind='stable')
+        self.pigeon_starts = np.searchsorted(flat[self.by_pigeon], np.arange(n_pigeons + 1))
+
+    def races(self) -> list[dict]:
+        return [
+            {
+                'id': int(race_id),
+                'name': f'Race {race_id}',
+                'raceName': f'Race {race_id}',
+                'racePointName': f'Race point {self.race_point[i] + 1}',
+                'distance': float(100 + 40 * self.race_point[i]),
+                'status': 'RESULTS_CLOSED',
+                'seasonId': int(self.race_season[i]),
+                'releaseDatetime': int(self.release_epoch[i]),
+                'racePointId': int(self.race_point[i]) + 1,
+            }
+            for i, race_id in enumerate(self.race_ids)
+        ]
+
+    def race_points(self) -> list[dict]:
+        return [
+            {
+                'id': i + 1,
+                'name': f'Race point {i + 1}',
+                'latitude': float(lat),
+                'longitude': float(lon),
+                'distance': float(100 + 40 * i),
+                'racePointTypes': ['Old birds' if i % 2 else 'Young birds'],
+            }
+            for i, (lat, lon) in enumerate(self.race_point_loc)
+        ]
+
+    def members(self) -> list[dict]:
+        return [
+            {
+                'id': i,
+                'name': f'Member {i}',
+                'clubNumber': int(self.member_club[i]),
+                'sectionNumber': int(self.member_section[i]),
+                'state': 'ACTIVE',
+                'loftLatitude': float(lat),
+                'loftLongitude': float(lon),
+            }
+            for i, (lat, lon) in enumerate(self.member_loft)
+        ]
+
+    def pigeons(self, club: int = None) -> list[dict]:
+        index = np.arange(len(self.pigeon_ids)) if club is None else np.flatnonzero(self.pigeon_club == club)
+        return [
+            {
+                'id': int(self.pigeon_ids[i]),
+                'clubNumber': int(self.pigeon_club[i]),
+                'memberId': int(self.pigeon_member[i]),
+                'ownerName': f'Member {self.pigeon_member[i]}',
+                'seasonId': int(self.race_season[-1]) if len(self.race_season) else 0,
+                'state': 'ACTIVE',
+                'currentLevel': int(i % 5),
+                'lastYearLevel': int(i % 4),
+            }
+            for i in index
+        ]
+
+    def _registration(self, race: int, k: int) -> dict:
+        p = self.registered[race, k]
+        arrived = self.arrived[race, k]
+        return {
+            'raceId': int(self.race_ids[race]),
+            'pigeonId': int(self.pigeon_ids[p]),
+            'clubNumber': int(self.pigeon_club[p]),
+            'memberId': int(self.pigeon_member[p]),
+            'seasonId': int(self.race_season[race]),
+            'velocity': float(self.velocity[race, k]) if arrived else None,
+            'arrivalDatetime': int(self.release_epoch[race] + 4 * 3_600_000 + k * 1_000) if arrived else None,
+        }
+
+    def registers(self, race_id: int, club: int = None) -> list[dict]:
+        race = self.race_index.get(race_id)
+        if race is None:
+            return []
+        clubs = self.pigeon_club[self.registered[race]]
+        return [self._registration(race, k) for k in range(len(clubs)) if club is None or clubs[k] == club]
+
+    def results(self, race_id: int) -> dict:
+        race = self.race_index.get(race_id)
+        if race is None:
+            return {'results': [], 'participants': 0, 'memberParticipants': 0}
+        arrived = np.flatnonzero(self.arrived[race])
+        order = arrived[np.argsort(-self.velocity[race, arrived])]
+        results = []
+        club_positions, section_positions = Counter(), Counter()
+        for position, k in enumerate(order):
+            p = self.registered[race, k]
+            club, section = self.pigeon_club[p], self.member_section[self.pigeon_member[p]]
+            row = self._registration(race, k)
+            # get_all_data adds the race_id of the results itself
+            del row['raceId']
+            row.update({
+                'federationPoints': float(max(50 - position, 0)),
+                'clubPoints': float(max(10 - club_positions[club], 0)),
+                'sectionPoints': float(max(20 - section_positions[section], 0)),
+            })
+            club_positions[club] += 1
+            section_positions[section] += 1
+            results.append(row)
+        members = np.unique(self.pigeon_member[self.registered[race]])
+        return {'results': results, 'participants': int(self.registered.shape[1]), 'memberParticipants': len(members)}
+
+    def bookings(self, race_id: int) -> list[dict]:
+        race = self.race_index.get(race_id)
+        if race is None:
+            return []
+        clubs = self.pigeon_club[self.registered[race]]
+        registered = np.bincount(clubs, minlength=N_CLUBS + 1)
+        arrived = np.bincount(clubs[self.arrived[race]], minlength=N_CLUBS + 1)
+        return [
+            {
+                'raceId': int(race_id),
+                'clubNumber': club,
+                'registeredPigeons': int(registered[club]),
+                'arrivedPigeons': int(arrived[club]),
+            }
+            for club in range(1, N_CLUBS + 1) if registered[club]
+        ]
+
+    def pigeon_races(self, pigeon_id: int) -> list[dict]:
+        p = pigeon_id - 100_000
+        if not 0 <= p < len(self.pigeon_ids):
+            return []
+        rows = self.by_pigeon[self.pigeon_starts[p]:self.pigeon_starts[p + 1]]
+        races, ks = np.divmod(rows, self.registered.shape[1])
+        return [
+            {**self._registration(race, k), 'releaseDatetime': int(self.release_epoch[race])}
+            for race, k in zip(races, ks)
+        ]
+
+
+def kp_index(start: str, end: str, seed: int = 0) -> dict:
+    """Kp index of the 3-hour intervals from start to end, in the format of the GFZ json api"""
+    intervals = pd.date_range(pd.Timestamp(start).tz_localize(None), pd.Timestamp(end).tz_localize(None), freq='3h')
+    rng = np.random.default_rng(seed + int(intervals[0].value // 10 ** 9) if len(intervals) else seed)
+    return {
+        'datetime': [t.strftime('%Y-%m-%dT%H:%M:%SZ') for t in intervals],
+        'Kp': (np.round(rng.gamma(2, 1, len(intervals)).clip(0, 9) * 3) / 3).tolist(),
+        'status': ['def'] * len(intervals),
+    }
+
+
+def _limit(records: list, query) -> list:
+    # the client may send limit as a float, e.g. the default 10e100 of get_race_results
+    return records[:int(float(query.get('limit', len(records))))]
+
+
+def _page(records: list, query) -> list:
+    offset = int(query.get('offset', 0))
+    return _limit(records[offset:], query)
+
+
+def _club(query):
+    return int(query['club']) if 'club' in query else None
+
+
+def make_app(
+        federation: MockFederation,
+        latency: float = 0.0,
+        jitter: float = None,
+        error_rate: float = 0.0,
+        seed: int = 0,
+) -> web.Application:
+    """
+    Parameters
+    ----------
+    federation: MockFederation
+    latency: float
+        Mean seconds every response is delayed by
+    jitter: float
+        Standard deviation of the delay, defaults to a quarter of latency
+    error_rate: float
+        Share of the federation requests answered with a 500
+    seed: int
+        Seed of the delays and errors
+    """
+    jitter = latency / 4 if jitter is None else jitter
+    rng = random.Random(seed)
+    requests, errors = Counter(), Counter()
+
+    @web.middleware
+    async def simulate_network(request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        requests[route] += 1
+        if request.path.startswith('/mock/'):
+            return await handler(request)
+        if latency or jitter:
+            await asyncio.sleep(max(0.0, rng.gauss(latency, jitter)))
+        if request.path.startswith('/unprot/') and rng.random() < error_rate:
+            errors[route] += 1
+            raise web.HTTPInternalServerError(text='Injected error')
+        return await handler(request)
+
+    def race_id(request: web.Request) -> int:
+        return int(request.match_info['race_id'])
+
+    def json(data) -> web.Response:
+        return web.json_response(data)
+
+    app = web.Application(middlewares=[simulate_network])
+    app.add_routes([
+        web.get('/unprot/races/list.json', lambda r: json(_limit(federation.races(), r.query))),
+        web.get('/unprot/races/list/currentseason.json', lambda r: json(
+            [race for race in federation.races() if race['seasonId'] == federation.race_season.max()]
+        )),
+        web.get('/unprot/racepoints/list.json', lambda r: json(federation.race_points())),
+        web.get('/unprot/members/list.json', lambda r: json(_page(federation.members(), r.query))),
+        web.get('/unprot/pigeons/list.json', lambda r: json(_page(federation.pigeons(_club(r.query)), r.query))),
+        web.get('/unprot/pigeons/related/{pigeon_id}/races.json', lambda r: json(
+            _limit(federation.pigeon_races(int(r.match_info['pigeon_id'])), r.query)
+        )),
+        web.get('/unprot/races/related/{race_id}/results/federation.json', lambda r: json(
+            federation.results(race_id(r))
+        )),
+        web.get('/unprot/races/related/{race_id}/bookings.json', lambda r: json(federation.bookings(race_id(r)))),
+        web.get('/unprot/races/related/{race_id}/registers.json', lambda r: json(
+            _page(federation.registers(race_id(r), _club(r.query)), r.query)
+        )),
+        web.get('/app/json/', lambda r: json(kp_index(r.query['start'], r.query['end'], seed))),
+        web.get('/mock/stats', lambda r: json({'requests': dict(requests), 'errors': dict(errors)})),
+    ])
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local stand-in for the federation API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pigeons', type=int, default=20_000)
+    parser.add_argument('--races', type=int, default=400)
+    parser.add_argument('--per-race', type=int, default=1_500)
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean seconds every response is delayed by')
+    parser.add_argument('--jitter', type=float, default=None, help='Standard deviation of the delay')
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0, help='Share of federation requests answered with a 500'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    federation = MockFederation(args.pigeons, args.races, args.per_race, seed=args.seed)
+    print(f'Serving {args.pigeons} pigeons and {args.races} races on http://{args.host}:{args.port}', flush=True)
+    app = make_app(federation, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
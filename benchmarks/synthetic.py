@@ -0,0 +1,120 @@
+"""Synthetic race history for benchmarks, shaped like df_race_results_final"""
+import numpy as np
+import pandas as pd
+
+COMPASS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+def race_history(
+        n_pigeons: int = 20_000,
+        n_races: int = 400,
+        pigeons_per_race: int = 1_500,
+        arrival_rate: float = 0.4,
+        seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Parameters
+    ----------
+    n_pigeons: int
+        Number of distinct pigeons
+    n_races: int
+        Number of races, released over ten seasons
+    pigeons_per_race: int
+        Pigeons registered in every race
+    arrival_rate: float
+        Share of registered pigeons with an arrival, the rest have velocity 0
+    seed: int
+
+    Returns
+    -------
+    DataFrame with race_id, pigeon_id, release_datetime, arrival_datetime and velocity, one row per registration
+    """
+    rng = np.random.default_rng(seed)
+    release = pd.Timestamp('2014-03-01') + pd.to_timedelta(np.sort(rng.integers(0, 3650, n_races)), unit='D')
+    release = release + pd.to_timedelta(rng.integers(6, 9, n_races), unit='h')
+
+    race_idx = np.repeat(np.arange(n_races), pigeons_per_race)
+    pigeon_idx = np.concatenate([rng.choice(n_pigeons, pigeons_per_race, replace=False) for _ in range(n_races)])
+    arrived = rng.random(len(race_idx)) < arrival_rate
+    release_epoch = release.to_numpy('datetime64[ms]').astype('int64')[race_idx]
+
+    return pd.DataFrame({
+        'race_id': 1_000 + race_idx,
+        'pigeon_id': 10 ** 17 + pigeon_idx,
+        'release_datetime': release[race_idx],
+        'arrival_datetime': np.where(arrived, release_epoch + rng.integers(2, 10, len(race_idx)) * 3_600_000, np.nan),
+        'velocity': np.where(arrived, rng.normal(1_100, 150, len(race_idx)), 0.0),
+    })
+
+
+def add_categoricals(
+        df: pd.DataFrame,
+        n_race_points: int = 30,
+        missing_rate: float = 0.01,
+        seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Adds the race level categorical features of the model configs to a race_history frame: race_point_name,
+    race_name, wind_direction_compass_<location> and release_month, with a share of missing values
+    """
+    rng = np.random.default_rng(seed)
+    race_ids = df.race_id.unique()
+    n_races = len(race_ids)
+    points = np.array([f'Race point {i}' for i in range(n_race_points)], dtype=object)
+    races = pd.DataFrame({
+        'race_id': race_ids,
+        'race_point_name': points[rng.integers(0, n_race_points, n_races)],
+        'race_name': np.array([f'Race {i}' for i in range(n_races)], dtype=object),
+    })
+    for location in ('sicily', 'malta', 'departure'):
+        compass = np.array(COMPASS, dtype=object)[rng.integers(0, len(COMPASS), n_races)]
+        compass[rng.random(n_races) < missing_rate] = None
+        races[f'wind_direction_compass_{location}'] = compass
+
+    df = df.merge(races, on='race_id', how='left')
+    df['release_month'] = df.release_datetime.dt.month
+    return df
+
+
+def race_results_final(
+        n_pigeons: int = 20_000,
+        n_races: int = 400,
+        pigeons_per_race: int = 1_500,
+        seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Full width df_race_results_final, with the column types of an untyped load: int64 ids and counts, float64
+    points and weather, object strings and arrival_datetime as epoch milliseconds
+    """
+    rng = np.random.default_rng(seed)
+    df = add_categoricals(race_history(n_pigeons, n_races, pigeons_per_race, seed=seed), seed=seed)
+    race_ids = df.race_id.unique()
+    n_races = len(race_ids)
+
+    races = pd.DataFrame({
+        'race_id': race_ids,
+        'season_id_race': 2_000 + df.groupby('race_id').release_datetime.first().dt.year.to_numpy(),
+        'club_number_race': rng.integers(1, 27, n_races),
+        'race_point_types': np.array(['Young birds', 'Old birds'], dtype=object)[rng.integers(0, 2, n_races)],
+        'distance_race_points': rng.uniform(80, 600, n_races),
+        'registered_pigeons': np.full(n_races, pigeons_per_race),
+        'release_hour': rng.integers(6, 9, n_races),
+    })
+    for location in ('sicily', 'malta', 'departure'):
+        for c in ('temperature', 'dew_point', 'relative_humidity', 'precipitation', 'wind_direction_degrees',
+                  'wind_speed_kph', 'air_pressure', 'wind_speed_beaufort'):
+            races[f'{c}_{location}'] = rng.uniform(0, 40, n_races)
+    df = df.merge(races, on='race_id', how='left')
+
+    pigeon_idx = (df.pigeon_id - 10 ** 17).to_numpy()
+    owners = np.array([f'Owner {i}' for i in range(n_pigeons // 20 + 1)], dtype=object)
+    df['member_id'] = pigeon_idx // 20
+    df['owner_name'] = owners[pigeon_idx // 20]
+    df['club_number_race_results'] = df['club_number_race']
+    df['club_number_pigeon'] = df['club_number_race']
+    df['current_level'] = pigeon_idx % 5
+    df['last_year_level'] = pigeon_idx % 4
+    for c in ('club_points', 'section_points', 'federation_points'):
+        df[c] = np.where(df.velocity > 0, rng.uniform(0, 100, len(df)), 0.0)
+    df['release_epoch'] = df.release_datetime.to_numpy('datetime64[ms]').astype('int64')
+    return df
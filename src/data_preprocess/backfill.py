@@ -0,0 +1,281 @@
+"""Race history backfill
+Fetches the whole race history of every pigeon, so that pigeon form also covers races older than the race lists
+crawled by get_all_data.
+
+Pigeons are walked club by club from get_pigeon_list and their histories fetched with get_pigeon_races by a pool of
+workers, keeping at most pigeons_in_flight requests in flight. Races already stored in the snapshot are dropped, so
+only races missing from it are kept.
+
+Layout under DATA_PATH/backfill:
+    checkpoint.json         pigeons done, parts written and row count
+    part-<n>.parquet        race history rows of the pigeons done since the previous checkpoint
+
+A part is written, then the checkpoint, every checkpoint_pigeons pigeons. An interrupted run resumes with the
+pigeons not in the checkpoint. Pigeons whose request failed are left out of it and retried on the next run.
+Throughput is printed every REPORT_SECONDS.
+
+Usage (with src on PYTHONPATH):
+    python -m src.data_preprocess.backfill [--pigeons-in-flight 16] [--cache] [--restart]
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import os
+import shutil
+import time
+
+import aiohttp
+import pandas as pd
+
+from src import DATA_PATH
+from src.data_preprocess.loaders.malta_pigeon_federation import MaltaPigeonFederationAPI
+from src.data_preprocess.loaders.response_cache import CacheMiss, ResponseCache
+from src.data_preprocess.schema import apply_schema
+from src.data_preprocess.snapshot_store import SnapshotStore
+from src.data_preprocess.utils import camel_to_snake
+
+BACKFILL_PATH = os.path.join(DATA_PATH, 'backfill')
+PIGEONS_IN_FLIGHT = 16
+CHECKPOINT_PIGEONS = 1_000
+REPORT_SECONDS = 5
+
+
+def normalise_pigeon_races(records: list[dict], pigeon_id: int) -> pd.DataFrame:
+    """
+    Race history rows of a pigeon with race_id, pigeon_id and release_datetime. Nested race records are flattened
+    (race.releaseDatetime becomes race_release_datetime) and release epochs are parsed.
+    """
+    df = pd.json_normalize(records, sep='_') if records else pd.DataFrame()
+    df = df.rename(columns=camel_to_snake)
+    if 'race_id' not in df and 'id' in df:
+        df = df.rename(columns={'id': 'race_id'})
+    if 'release_datetime' not in df and 'race_release_datetime' in df:
+        df = df.rename(columns={'race_release_datetime': 'release_datetime'})
+    if 'race_id' not in df:
+        return pd.DataFrame(columns=['race_id', 'pigeon_id', 'release_datetime'])
+
+    df['pigeon_id'] = df['pigeon_id'].fillna(pigeon_id) if 'pigeon_id' in df else pigeon_id
+    if 'release_datetime' in df and pd.api.types.is_numeric_dtype(df['release_datetime']):
+        df['release_datetime'] = pd.to_datetime(df['release_datetime'], unit='ms')
+    # nested records, e.g. members_tosses, are not kept
+    df = df[[c for c in df.columns if not df[c].map(lambda x: isinstance(x, (list, dict))).any()]]
+    return apply_schema(df, 'df_pigeon_races')
+
+
+class Backfill:
+
+    def __init__(self, path: str = BACKFILL_PATH, restart: bool = False):
+        """
+        Parameters
+        ----------
+        path: str
+            Directory of the checkpoint and parts
+        restart: bool
+            Drop the checkpoint and parts of previous runs
+        """
+        self.path = path
+        if restart and os.path.exists(path):
+            shutil.rmtree(path)
+
+        self.pigeons_done = set()
+        self.parts = 0
+        self.rows = 0
+        checkpoint = os.path.join(path, 'checkpoint.json')
+        if os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as f:
+                meta = json.load(f)
+            self.pigeons_done = set(meta['pigeons_done'])
+            self.parts, self.rows = meta['parts'], meta['rows']
+
+        self._buffer = []
+        self._buffer_pigeons = []
+
+    def __len__(self):
+        return len(self.pigeons_done)
+
+    def add(self, pigeon_id: int, df: pd.DataFrame, checkpoint_pigeons: int = CHECKPOINT_PIGEONS) -> None:
+        """Buffers the history of a pigeon, writing a part and the checkpoint once checkpoint_pigeons are buffered"""
+        if len(df):
+            self._buffer.append(df)
+        self._buffer_pigeons.append(pigeon_id)
+        if len(self._buffer_pigeons) >= checkpoint_pigeons:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        if not self._buffer_pigeons:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        if self._buffer:
+            df = pd.concat(self._buffer, ignore_index=True)
+            file = os.path.join(self.path, f'part-{self.parts:05d}.parquet')
+            df.to_parquet(f'{file}.tmp', index=False)
+            os.replace(f'{file}.tmp', file)
+            self.parts += 1
+            self.rows += len(df)
+
+        self.pigeons_done.update(self._buffer_pigeons)
+        self._buffer, self._buffer_pigeons = [], []
+        meta = {
+            'pigeons_done': sorted(self.pigeons_done),
+            'parts': self.parts,
+            'rows': self.rows,
+            'updated': datetime.now().isoformat(timespec='seconds'),
+        }
+        with open(os.path.join(self.path, 'checkpoint.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(self.path, 'checkpoint.json.tmp'), os.path.join(self.path, 'checkpoint.json'))
+
+    async def run(
+            self,
+            club_list: list[int] = None,
+            pigeons_in_flight: int = PIGEONS_IN_FLIGHT,
+            checkpoint_pigeons: int = CHECKPOINT_PIGEONS,
+            snapshot: str = None,
+            cache: ResponseCache = None,
+            offline: bool = False,
+    ) -> int:
+        """
+        Fetches the race histories of the pigeons not done yet
+
+        Parameters
+        ----------
+        club_list: list[int]
+            Clubs whose pigeons are walked. Defaults to all clubs.
+        pigeons_in_flight: int
+            Race history requests kept in flight
+        checkpoint_pigeons: int
+            Pigeons done between two checkpoints
+        snapshot: str
+            Snapshot whose races are dropped from the histories, defaults to the latest snapshot
+        cache: ResponseCache
+            Cache federation responses on disk
+        offline: bool
+            Replay every response from the cache without touching the network
+
+        Returns
+        -------
+        Number of pigeons done by this run
+        """
+        club_list = club_list if club_list else range(1, 27)
+        stored_races = set()
+        store = SnapshotStore()
+        if snapshot or store.latest:
+            stored_races = set(store.load('df_races', columns=['race_id'], snapshot=snapshot)['race_id'].tolist())
+
+        queue = asyncio.Queue(maxsize=pigeons_in_flight * 4)
+        stats = {'done': 0, 'failed': 0, 'rows': 0, 'in_flight': 0}
+        start = time.perf_counter()
+
+        async def walk_pigeons(mpr: MaltaPigeonFederationAPI) -> None:
+            queued = set(self.pigeons_done)
+            for club in club_list:
+                async for page in mpr.get_pigeon_list(club=club):
+                    for pigeon in page:
+                        if pigeon['id'] not in queued:
+                            queued.add(pigeon['id'])
+                            await queue.put(pigeon['id'])
+            for _ in range(pigeons_in_flight):
+                await queue.put(None)
+
+        async def fetch_histories(mpr: MaltaPigeonFederationAPI) -> None:
+            while (pigeon_id := await queue.get()) is not None:
+                stats['in_flight'] += 1
+                try:
+                    records = await mpr.get_pigeon_races(pigeon_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError, CacheMiss) as e:
+                    print(f'Failed to fetch the races of pigeon {pigeon_id}: {e!r}')
+                    stats['failed'] += 1
+                    continue
+                finally:
+                    stats['in_flight'] -= 1
+
+                df = normalise_pigeon_races(records, pigeon_id)
+                df = df[~df['race_id'].isin(stored_races)]
+                self.add(pigeon_id, df, checkpoint_pigeons=checkpoint_pigeons)
+                stats['done'] += 1
+                stats['rows'] += len(df)
+
+        async def report() -> None:
+            while True:
+                await asyncio.sleep(REPORT_SECONDS)
+                elapsed = time.perf_counter() - start
+                print(
+                    f'Backfill: {stats["done"]} pigeons ({stats["done"] / elapsed:.1f}/s), '
+                    f'{stats["in_flight"]} requests in flight, {stats["rows"]} new rows, {stats["failed"]} failed'
+                )
+
+        print(f'Backfilling race histories, {len(self)} pigeons already done')
+        reporter = asyncio.create_task(report())
+        try:
+            async with MaltaPigeonFederationAPI(session_limit=pigeons_in_flight, cache=cache, offline=offline) as mpr:
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(walk_pigeons(mpr))
+                    for _ in range(pigeons_in_flight):
+                        tg.create_task(fetch_histories(mpr))
+        finally:
+            reporter.cancel()
+            self.checkpoint()
+
+        elapsed = time.perf_counter() - start
+        print(
+            f'Backfilled {stats["done"]} pigeons in {elapsed:.1f}s ({stats["done"] / max(elapsed, 1e-9):.1f}/s), '
+            f'{stats["rows"]} new rows, {stats["failed"]} failed'
+        )
+        return stats['done']
+
+
+def load_backfill(snapshot: str = None, path: str = BACKFILL_PATH) -> pd.DataFrame:
+    """
+    Backfilled race history rows of races missing from a snapshot, one row per race and pigeon
+
+    Parameters
+    ----------
+    snapshot: str
+        Snapshot id, defaults to the latest snapshot
+    path: str
+    """
+    files = sorted(f for f in os.listdir(path) if f.endswith('.parquet')) if os.path.exists(path) else []
+    if not files:
+        return pd.DataFrame(columns=['race_id', 'pigeon_id', 'release_datetime'])
+
+    df = pd.concat([pd.read_parquet(os.path.join(path, f)) for f in files], ignore_index=True)
+    df = df.drop_duplicates(['race_id', 'pigeon_id'], keep='last')
+    store = SnapshotStore()
+    if snapshot or store.latest:
+        # races stored since the backfill ran
+        stored_races = store.load('df_races', columns=['race_id'], snapshot=snapshot)['race_id']
+        df = df[~df['race_id'].isin(stored_races)]
+    return apply_schema(df.reset_index(drop=True), 'df_pigeon_races')
+
+
+def backfill_version(path: str = BACKFILL_PATH) -> str:
+    """Parts and rows of the backfill, changing whenever a part is added"""
+    checkpoint = os.path.join(path, 'checkpoint.json')
+    if not os.path.exists(checkpoint):
+        return '0-0'
+    with open(checkpoint, 'r') as f:
+        meta = json.load(f)
+    return f'{meta["parts"]}-{meta["rows"]}'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Backfill the race history of every pigeon')
+    parser.add_argument('--pigeons-in-flight', type=int, default=PIGEONS_IN_FLIGHT)
+    parser.add_argument('--checkpoint-pigeons', type=int, default=CHECKPOINT_PIGEONS)
+    parser.add_argument('--cache', action='store_true', help='Cache federation responses on disk')
+    parser.add_argument('--offline', action='store_true', help='Replay federation responses from the cache only')
+    parser.add_argument('--restart', action='store_true', help='Drop the progress of previous runs')
+    args = parser.parse_args()
+
+    response_cache = ResponseCache() if args.cache or args.offline else None
+    asyncio.run(Backfill(restart=args.restart).run(
+        pigeons_in_flight=args.pigeons_in_flight,
+        checkpoint_pigeons=args.checkpoint_pigeons,
+        cache=response_cache,
+        offline=args.offline,
+    ))
+
+
+if __name__ == '__main__':
+    main()
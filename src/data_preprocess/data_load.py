@@ -1,14 +1,30 @@
+import argparse
 import asyncio
-from functools import partial
 
-from datetime import datetime
+from typing import Optional
 import pandas as pd
 import itertools
-import os
-from src import DATA_PATH
-from src.data_load.loaders.malta_pigeon_federation import MaltaPigeonFederationAPI
-from src.data_load.loaders.meteostat import get_geo_weather, get_all_locations
-from src.data_load.utils import camel_to_snake, deg_to_compass, wind_speed_to_beaufort
+from src.data_preprocess.geo import GeoMatrix, add_geo_features
+from src.data_preprocess.loaders.geomagnetic import get_kp_for_races, include_kp_index
+from src.data_preprocess.loaders.malta_pigeon_federation import MaltaPigeonFederationAPI
+from src.data_preprocess.loaders.meteostat import get_all_locations
+from src.data_preprocess.loaders.weather_grid import WeatherGrid
+from src.data_preprocess.loaders.response_cache import ResponseCache
+from src.data_preprocess.manifest import RaceManifest
+from src.data_preprocess.schema import apply_schema, nullable_integers
+from src.data_preprocess.snapshot_store import SnapshotStore, TableWriter, CHUNK_ROWS, SEASON_COLUMN
+from src.data_preprocess.utils import camel_to_snake, deg_to_compass_array, wind_speed_to_beaufort_array
+
+TABLE_NAMES = (
+    'df_races',
+    'df_pigeons',
+    'df_members',
+    'df_race_results',
+    'df_race_participants',
+    'df_race_results_final',
+)
+# races streamed concurrently by stream_all_data, each holding at most a page window in memory
+RACES_IN_FLIGHT = 16
 
 
 async def get_raw_pigeon_list_club(club_id: int, mpr: MaltaPigeonFederationAPI):
@@ -47,6 +63,43 @@ async def get_raw_race_participants(race_id: int, mpr: MaltaPigeonFederationAPI)
     return race_participants
 
 
+def normalise_records(records: list[dict]) -> pd.DataFrame:
+    return pd.DataFrame(records).rename(columns=camel_to_snake)
+
+
+async def stream_raw_pigeon_list(mpr: MaltaPigeonFederationAPI, club_list: list[int], writer: TableWriter) -> None:
+    async def stream_club(club_id: int) -> None:
+        async for page in mpr.get_pigeon_list(club=club_id):
+            writer.write(normalise_records(page))
+
+    print(f'Streaming pigeons for clubs {club_list}...')
+    async with asyncio.TaskGroup() as tg:
+        for club_id in club_list:
+            tg.create_task(stream_club(club_id))
+
+
+async def stream_raw_race(
+        race_id: int,
+        season: int,
+        mpr: MaltaPigeonFederationAPI,
+        participants_writer: TableWriter,
+        results_writer: TableWriter,
+        semaphore: asyncio.Semaphore,
+) -> tuple[list[dict], int, int]:
+    """Streams the participants and results of a race to disk, returning its club stats and row counts"""
+    async with semaphore:
+        n_participants = 0
+        async for page in mpr.get_race_participants(race_id=race_id):
+            participants_writer.write(normalise_records(page), partition=season)
+            n_participants += len(page)
+
+        race_results = await get_raw_race_results(race_id, mpr)
+        results_writer.write(normalise_records(race_results), partition=season)
+
+        race_club_stats = await get_raw_race_club_stats(race_id, mpr)
+    return race_club_stats, n_participants, len(race_results)
+
+
 def get_weather_columns_location(loc: str) -> list[str]:
     return [
         f'temperature_{loc}',
@@ -60,15 +113,20 @@ def get_weather_columns_location(loc: str) -> list[str]:
 
 
 def include_weather_stats(df_races: pd.DataFrame) -> pd.DataFrame:
-
+    """
+    Weather at the release hour of every race at each location of get_all_locations, at the departure point, and
+    along the flight line from the departure point to Malta (route), interpolated from the weather grid
+    """
+    grid = WeatherGrid()
     location_metadata = get_all_locations()
     location_metadata.update({'departure': None})
 
-    for location, lat_lon in location_metadata.items():
+    weather = {location: grid.get_weather(df_races, lat_lon=lat_lon) for location, lat_lon in location_metadata.items()}
+    weather['route'] = grid.get_route_weather(df_races)
 
-        df_races[get_weather_columns_location(location)] = df_races.apply(
-            partial(get_geo_weather, lat_lon=lat_lon), axis=1, result_type='expand'
-        )
+    for location, df_weather in weather.items():
+
+        df_races[get_weather_columns_location(location)] = df_weather.values
 
         col_compass = f'wind_direction_compass_{location}'
         col_degrees = f'wind_direction_degrees_{location}'
@@ -76,8 +134,8 @@ def include_weather_stats(df_races: pd.DataFrame) -> pd.DataFrame:
         col_beafort = f'wind_speed_beaufort_{location}'
         col_speed = f'wind_speed_kph_{location}'
 
-        df_races[col_compass] = df_races[col_degrees].apply(deg_to_compass)
-        df_races[col_beafort] = df_races[col_speed].apply(wind_speed_to_beaufort)
+        df_races[col_compass] = deg_to_compass_array(df_races[col_degrees])
+        df_races[col_beafort] = wind_speed_to_beaufort_array(df_races[col_speed])
 
     return df_races
 
@@ -109,67 +167,272 @@ def clean_race_results(races: pd.DataFrame, race_points: pd.DataFrame, race_club
     return df_races
 
 
-async def get_all_data(club_list: list[int] = None) -> tuple[pd.DataFrame, ...]:
+def merge_race_results_final(
+        df_race_participants: pd.DataFrame,
+        df_pigeons: pd.DataFrame,
+        df_races: pd.DataFrame,
+        geo: GeoMatrix = None,
+) -> pd.DataFrame:
+    """Joins the participants with their pigeons and races, and the distance, bearing and wind of their lofts"""
+
+    # missing pigeons and races would otherwise turn their integer columns, ids included, into floats
+    df_race_results_final = df_race_participants.merge(
+        nullable_integers(df_pigeons),
+        left_on='pigeon_id',
+        right_on='id',
+        how='left',
+        suffixes=('_race_results', '_pigeon')
+    ).merge(
+        nullable_integers(df_races),
+        left_on=('race_id', 'club_number_race_results'),
+        right_on=('race_id', 'club_number'),
+        how='left',
+        suffixes=('_pigeon', '_race')
+    )
+
+    cols_fillna_0 = ['club_points', 'section_points', 'federation_points', 'velocity']
+    df_race_results_final = df_race_results_final.fillna({col: 0 for col in cols_fillna_0})
+    if geo is not None:
+        df_race_results_final = add_geo_features(df_race_results_final, geo)
+    return apply_schema(df_race_results_final, 'df_race_results_final')
+
+
+def merge_race_snapshot(df_old: pd.DataFrame, df_new: pd.DataFrame, race_ids: list[int]) -> pd.DataFrame:
+    """Replaces every row belonging to a re-fetched race in the old snapshot with the freshly fetched rows"""
+    if df_old is None or df_old.empty:
+        return df_new
+    if df_new.empty:
+        return df_old[~df_old['race_id'].isin(race_ids)].reset_index(drop=True)
+    df_old = df_old[~df_old['race_id'].isin(race_ids)]
+    return pd.concat([df_old, df_new], ignore_index=True)
+
+
+def load_snapshot() -> Optional[tuple[pd.DataFrame, ...]]:
+    store = SnapshotStore()
+    if store.latest is None:
+        return None
+    return store.load_all(TABLE_NAMES)
+
+
+async def get_all_data(
+        club_list: list[int] = None,
+        manifest: RaceManifest = None,
+        incremental: bool = False,
+        cache: ResponseCache = None,
+        offline: bool = False,
+) -> tuple[pd.DataFrame, ...]:
+    """
+    Parameters
+    ----------
+    club_list: list[int]
+        Clubs whose pigeons are loaded. Defaults to all clubs.
+    manifest: RaceManifest
+        Record of ingested races. It is updated in memory and should be saved once the data is stored.
+    incremental: bool
+        Only fetch races which are new or still open according to the manifest, and merge them into the latest
+        snapshot on disk. Falls back to a full load if there is no manifest or snapshot yet.
+    cache: ResponseCache
+        Cache federation responses on disk. Responses of races whose results are still open are always re-fetched.
+    offline: bool
+        Replay every response from the cache without touching the network
+    """
 
     club_list = club_list if club_list else range(1, 27)
-    async with MaltaPigeonFederationAPI() as mpr:
+    snapshot = load_snapshot() if incremental and manifest is not None and len(manifest) else None
+
+    async with MaltaPigeonFederationAPI(cache=cache, offline=offline) as mpr:
 
         pigeons = await get_raw_pigeon_list(mpr, club_list=club_list)
         print('Getting members, race_points, races...')
         members = await mpr.get_members_list()
         race_points = await mpr.get_race_points()
         races = await mpr.get_race_list()
+        if snapshot is not None:
+            races = manifest.races_to_fetch(races)
+        print(f'Fetching {len(races)} races...')
+        mpr.invalidate_races([race['id'] for race in races if not RaceManifest.is_closed(race)])
+
         async with asyncio.TaskGroup() as tg:
             race_club_stats = [tg.create_task(get_raw_race_club_stats(race['id'], mpr)) for race in races]
             race_participants = [tg.create_task(get_raw_race_participants(race['id'], mpr)) for race in races]
             raw_race_results = [tg.create_task(get_raw_race_results(race['id'], mpr)) for race in races]
 
-    race_club_stats = itertools.chain.from_iterable(task.result() for task in race_club_stats)
+    race_club_stats = list(itertools.chain.from_iterable(task.result() for task in race_club_stats))
     race_participants = itertools.chain.from_iterable(task.result() for task in race_participants)
     race_results_final = itertools.chain.from_iterable(task.result() for task in raw_race_results)
 
-    df_pigeons = pd.DataFrame(pigeons).rename(columns=camel_to_snake)
-    df_members = pd.DataFrame(members).rename(columns=camel_to_snake)
-    df_race_results = pd.DataFrame(race_results_final).rename(columns=camel_to_snake)
-    df_race_participants = pd.DataFrame(race_participants).rename(columns=camel_to_snake)
+    df_pigeons = apply_schema(normalise_records(pigeons), 'df_pigeons')
+    df_members = apply_schema(normalise_records(members), 'df_members')
+    df_race_results = apply_schema(normalise_records(race_results_final), 'df_race_results')
+    df_race_participants = apply_schema(normalise_records(race_participants), 'df_race_participants')
+
+    if race_club_stats:
+        df_races = include_weather_stats(clean_race_results(races, race_points, race_club_stats))
+        df_races = include_kp_index(df_races, await get_kp_for_races(df_races, offline=offline))
+        df_races = apply_schema(df_races, 'df_races')
+    else:
+        df_races = pd.DataFrame(columns=['race_id'])
+
+    if snapshot is not None:
+        df_races_old, _, _, df_race_results_old, df_race_participants_old, _ = snapshot
+        race_ids = [race['id'] for race in races]
+        df_races = merge_race_snapshot(df_races_old, df_races, race_ids)
+        df_race_results = merge_race_snapshot(df_race_results_old, df_race_results, race_ids)
+        df_race_participants = merge_race_snapshot(df_race_participants_old, df_race_participants, race_ids)
+        # categories of the old and new rows differ, and concatenating them falls back to object columns
+        df_races = apply_schema(df_races, 'df_races')
+        df_race_results = apply_schema(df_race_results, 'df_race_results')
+        df_race_participants = apply_schema(df_race_participants, 'df_race_participants')
+
+    geo = GeoMatrix(normalise_records(race_points), df_members)
+    df_race_results_final = merge_race_results_final(df_race_participants, df_pigeons, df_races, geo=geo)
+
+    if manifest is not None:
+        n_results = df_race_results.groupby('race_id').size() if len(df_race_results) else pd.Series()
+        n_participants = df_race_participants.groupby('race_id').size() if len(df_race_participants) else pd.Series()
+        manifest.update(races, n_results=n_results.to_dict(), n_participants=n_participants.to_dict())
 
-    df_races = clean_race_results(races, race_points, race_club_stats)
-    df_races = include_weather_stats(df_races)
+    return df_races, df_pigeons, df_members, df_race_results, df_race_participants, df_race_results_final
 
-    df_race_results_final = df_race_participants.merge(
-        df_pigeons,
-        left_on='pigeon_id',
-        right_on='id',
-        how='left',
-        suffixes=('_race_results', '_pigeon')
-    ).merge(
-        df_races,
-        left_on=('race_id', 'club_number_race_results'),
-        right_on=('race_id', 'club_number'),
-        how='left',
-        suffixes=('_pigeon', '_race')
-    )
 
-    cols_fillna_0 = ['club_points', 'section_points', 'federation_points', 'velocity']
-    df_race_results_final = df_race_results_final.fillna({col: 0 for col in cols_fillna_0})
+def join_race_results_final(
+        store: SnapshotStore,
+        snapshot: str,
+        df_races: pd.DataFrame,
+        seasons: list[int],
+        geo: GeoMatrix = None,
+) -> dict:
+    """
+    Builds df_race_results_final one season at a time from the participants already on disk, loading only the
+    pigeons taking part in that season. Returns the manifest entry of the table.
+    """
+    writer = store.table_writer(snapshot, 'df_race_results_final', partition_column='season_id_race')
+    for season in seasons:
+        df_participants = store.load('df_race_participants', snapshot=snapshot, partitions=[season])
+        pigeon_ids = df_participants['pigeon_id'].dropna().unique().tolist()
+        df_pigeons = store.load('df_pigeons', snapshot=snapshot, filters=[('id', 'in', pigeon_ids)])
+        df_races_season = df_races[df_races['race_id'].isin(df_participants['race_id'].unique())]
+        df_final = merge_race_results_final(df_participants, df_pigeons, df_races_season, geo=geo)
+        writer.write(df_final, partition=season)
+    return writer.close()
+
+
+async def stream_all_data(
+        club_list: list[int] = None,
+        manifest: RaceManifest = None,
+        cache: ResponseCache = None,
+        offline: bool = False,
+        chunk_rows: int = CHUNK_ROWS,
+) -> str:
+    """
+    Streaming variant of get_all_data for full loads. Every page is normalised and appended to on-disk partitions
+    of a new snapshot as it arrives, and df_race_results_final is joined one season at a time, so peak memory is
+    bounded by a season rather than by the whole federation history.
+
+    Parameters
+    ----------
+    club_list: list[int]
+        Clubs whose pigeons are loaded. Defaults to all clubs.
+    manifest: RaceManifest
+        Record of ingested races, updated in memory
+    cache: ResponseCache
+        Cache federation responses on disk
+    offline: bool
+        Replay every response from the cache without touching the network
+    chunk_rows: int
+        Rows buffered per table partition before being flushed to a Parquet file
+
+    Returns
+    -------
+    Id of the written snapshot
+    """
+    club_list = club_list if club_list else range(1, 27)
+    store = SnapshotStore()
+    snapshot = store.new_snapshot()
 
-    return df_races, df_pigeons, df_members, df_race_results, df_race_participants, df_race_results_final
+    pigeons_writer = store.table_writer(snapshot, 'df_pigeons', chunk_rows=chunk_rows)
+    participants_writer, results_writer = (
+        store.table_writer(
+            snapshot, name, partition_column=SEASON_COLUMN, derived_partition=True, chunk_rows=chunk_rows
+        )
+        for name in ('df_race_participants', 'df_race_results')
+    )
 
+    async with MaltaPigeonFederationAPI(cache=cache, offline=offline) as mpr:
+        await stream_raw_pigeon_list(mpr, club_list=club_list, writer=pigeons_writer)
+        print('Getting members, race_points, races...')
+        members = await mpr.get_members_list()
+        race_points = await mpr.get_race_points()
+        races = await mpr.get_race_list()
+        mpr.invalidate_races([race['id'] for race in races if not RaceManifest.is_closed(race)])
 
-def save_data(df_list: tuple[pd.DataFrame, ...]) -> None:
+        print(f'Streaming {len(races)} races...')
+        semaphore = asyncio.Semaphore(RACES_IN_FLIGHT)
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(stream_raw_race(
+                    race['id'], race.get('seasonId', -1), mpr, participants_writer, results_writer, semaphore
+                ))
+                for race in races
+            ]
+
+    race_club_stats = list(itertools.chain.from_iterable(task.result()[0] for task in tasks))
+    df_races = include_weather_stats(clean_race_results(races, race_points, race_club_stats))
+    df_races = include_kp_index(df_races, await get_kp_for_races(df_races, offline=offline))
+    df_races = apply_schema(df_races, 'df_races')
+    df_members = apply_schema(normalise_records(members), 'df_members')
+
+    tables = {
+        'df_races': store.write_table(snapshot, 'df_races', df_races),
+        'df_pigeons': pigeons_writer.close(),
+        'df_members': store.write_table(snapshot, 'df_members', df_members),
+        'df_race_results': results_writer.close(),
+        'df_race_participants': participants_writer.close(),
+    }
+    store.commit(snapshot, tables, latest=False)
+
+    seasons = sorted({p['value'] for p in tables['df_race_participants']['partitions']})
+    geo = GeoMatrix(normalise_records(race_points), df_members)
+    tables['df_race_results_final'] = join_race_results_final(store, snapshot, df_races, seasons, geo=geo)
+    store.commit(snapshot, tables)
+
+    if manifest is not None:
+        manifest.update(
+            races,
+            n_results={race['id']: task.result()[2] for race, task in zip(races, tasks)},
+            n_participants={race['id']: task.result()[1] for race, task in zip(races, tasks)},
+        )
+    return snapshot
 
-    dt = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    df_races, df_pigeons, df_members, df_race_results, df_race_participants, df_race_results_final = df_list
 
-    df_races.to_csv(os.path.join(DATA_PATH, f'df_race_results_{dt}.csv'), index=False)
-    df_pigeons.to_csv(os.path.join(DATA_PATH, f'df_pigeons_{dt}.csv'), index=False)
-    df_members.to_csv(os.path.join(DATA_PATH, f'df_members_{dt}.csv'), index=False)
-    df_race_results.to_csv(os.path.join(DATA_PATH, f'df_race_results_{dt}.csv'), index=False)
-    df_race_participants.to_csv(os.path.join(DATA_PATH, f'df_race_participants_{dt}.csv'), index=False)
-    df_race_results_final.to_csv(os.path.join(DATA_PATH, f'df_race_results_final_{dt}.csv'), index=False)
+def save_data(df_list: tuple[pd.DataFrame, ...]) -> str:
+    return SnapshotStore().write_snapshot(dict(zip(TABLE_NAMES, df_list)))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true', help='Only fetch new or still-open races')
+    parser.add_argument('--cache', action='store_true', help='Cache federation responses on disk')
+    parser.add_argument('--offline', action='store_true', help='Replay federation responses from the cache only')
+    parser.add_argument('--stream', action='store_true', help='Write pages to disk as they arrive (full loads only)')
+    args = parser.parse_args()
+    if args.stream and args.incremental:
+        parser.error('--stream cannot be combined with --incremental')
+
     club_list = None
-    df_list_out = asyncio.run(get_all_data(club_list=club_list))
-    save_data(df_list_out)
+    race_manifest = RaceManifest()
+    response_cache = ResponseCache() if args.cache or args.offline else None
+    if args.stream:
+        asyncio.run(stream_all_data(
+            club_list=club_list, manifest=race_manifest, cache=response_cache, offline=args.offline
+        ))
+    else:
+        df_list_out = asyncio.run(get_all_data(
+            club_list=club_list,
+            manifest=race_manifest,
+            incremental=args.incremental,
+            cache=response_cache,
+            offline=args.offline,
+        ))
+        save_data(df_list_out)
+    race_manifest.save()
@@ -0,0 +1,172 @@
+"""Geo Features
+Distance and initial bearing from every race point to every member loft, kept as dense matrices.
+
+The matrices are computed with one vectorised haversine over all (race point, loft) pairs and cached under
+DATA_PATH/geo, so that they are only recomputed when a race point or loft is added or moved. Rows of the results
+frame get their distance and bearing by looking up the indices of their race point and member, and the headwind
+and crosswind of every weather location are computed from the bearing as whole-column array operations:
+    * headwind_kph_<location>: wind speed along the flight heading, positive when flying into the wind
+    * crosswind_kph_<location>: wind speed across the flight heading, positive when the wind comes from the right
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import DATA_PATH
+
+GEO_PATH = os.path.join(DATA_PATH, 'geo')
+EARTH_RADIUS_KM = 6371.0088
+WIND_DIRECTION_PREFIX = 'wind_direction_degrees_'
+MEMBER_COLUMNS = ('member_id', 'member_id_race_results')
+
+
+def haversine_distance(lat0: np.ndarray, lon0: np.ndarray, lat1: np.ndarray, lon1: np.ndarray) -> np.ndarray:
+    """Great circle distance in km between points given in degrees, broadcast like numpy arrays"""
+    lat0, lon0, lat1, lon1 = (np.deg2rad(np.asarray(c, dtype='float64')) for c in (lat0, lon0, lat1, lon1))
+    a = np.sin((lat1 - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def initial_bearing(lat0: np.ndarray, lon0: np.ndarray, lat1: np.ndarray, lon1: np.ndarray) -> np.ndarray:
+    """Initial bearing in degrees clockwise from north, from the first to the second points"""
+    lat0, lon0, lat1, lon1 = (np.deg2rad(np.asarray(c, dtype='float64')) for c in (lat0, lon0, lat1, lon1))
+    x = np.sin(lon1 - lon0) * np.cos(lat1)
+    y = np.cos(lat0) * np.sin(lat1) - np.sin(lat0) * np.cos(lat1) * np.cos(lon1 - lon0)
+    return np.rad2deg(np.arctan2(x, y)) % 360
+
+
+def wind_components(
+        wind_direction: np.ndarray,
+        wind_speed: np.ndarray,
+        heading: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Headwind and crosswind of a flight heading
+
+    Parameters
+    ----------
+    wind_direction: np.ndarray
+        Direction the wind blows from, degrees clockwise from north
+    wind_speed: np.ndarray
+    heading: np.ndarray
+        Direction of flight, degrees clockwise from north
+
+    Returns
+    -------
+    Headwind, positive into the wind, and crosswind, positive from the right, in the unit of wind_speed
+    """
+    angle = np.deg2rad(np.asarray(wind_direction, dtype='float64') - np.asarray(heading, dtype='float64'))
+    wind_speed = np.asarray(wind_speed, dtype='float64')
+    return wind_speed * np.cos(angle), wind_speed * np.sin(angle)
+
+
+class GeoMatrix:
+
+    def __init__(self, df_race_points: pd.DataFrame, df_members: pd.DataFrame, path: str = GEO_PATH):
+        """
+        Distance and bearing matrices of the race points and lofts, read from the cache if it holds the same
+        coordinates and computed otherwise
+
+        Parameters
+        ----------
+        df_race_points: pd.DataFrame
+            Race points with id, latitude and longitude, as returned by get_race_points
+        df_members: pd.DataFrame
+            Members with id, loft_latitude and loft_longitude, as returned by get_members_list
+        path: str
+            Directory the matrices are cached in
+        """
+        self.path = path
+        points = self._coordinates(df_race_points, 'latitude', 'longitude')
+        lofts = self._coordinates(df_members, 'loft_latitude', 'loft_longitude')
+        self.point_ids, self.point_lat, self.point_lon = points
+        self.member_ids, self.loft_lat, self.loft_lon = lofts
+
+        cache = os.path.join(path, 'matrix.npz')
+        if os.path.exists(cache):
+            with np.load(cache) as data:
+                if all(np.array_equal(data[k], v, equal_nan=True) for k, v in self._coordinate_arrays().items()):
+                    self.distance, self.bearing = data['distance'], data['bearing']
+                    return
+
+        print(f'Computing distances of {len(self.point_ids)} race points to {len(self.member_ids)} lofts')
+        args = (self.point_lat[:, None], self.point_lon[:, None], self.loft_lat[None, :], self.loft_lon[None, :])
+        self.distance = haversine_distance(*args).astype('float32')
+        self.bearing = initial_bearing(*args).astype('float32')
+        self.save()
+
+    @staticmethod
+    def _coordinates(df: pd.DataFrame, lat: str, lon: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Ids sorted, with their coordinates, of the rows with an id. Missing coordinates are NaN."""
+        if df is None or 'id' not in df:
+            return np.array([], dtype='int64'), np.array([]), np.array([])
+        df = df.dropna(subset=['id']).drop_duplicates('id').sort_values('id')
+        coordinates = [
+            pd.to_numeric(df[c], errors='coerce').to_numpy('float64') if c in df else np.full(len(df), np.nan)
+            for c in (lat, lon)
+        ]
+        return df['id'].to_numpy('int64'), *coordinates
+
+    def _coordinate_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            'point_ids': self.point_ids,
+            'point_lat': self.point_lat,
+            'point_lon': self.point_lon,
+            'member_ids': self.member_ids,
+            'loft_lat': self.loft_lat,
+            'loft_lon': self.loft_lon,
+        }
+
+    def save(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, 'matrix.npz')
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f, distance=self.distance, bearing=self.bearing, **self._coordinate_arrays())
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def _index(ids: np.ndarray, values: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+        """Positions of values in the sorted ids, and whether each value was found"""
+        values = pd.to_numeric(values, errors='coerce').to_numpy('float64')
+        known = ~np.isnan(values)
+        index = np.zeros(len(values), dtype='int64')
+        if len(ids):
+            index[known] = np.searchsorted(ids, values[known].astype('int64')).clip(max=len(ids) - 1)
+            known[known] = ids[index[known]] == values[known]
+        else:
+            known[:] = False
+        return index, known
+
+    def lookup(self, race_point_ids: pd.Series, member_ids: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+        """Distance in km and initial bearing of every (race point, member) pair, NaN for unknown pairs"""
+        point_index, point_known = self._index(self.point_ids, race_point_ids)
+        member_index, member_known = self._index(self.member_ids, member_ids)
+        known = point_known & member_known
+        distance = np.full(len(known), np.nan, dtype='float32')
+        bearing = np.full(len(known), np.nan, dtype='float32')
+        distance[known] = self.distance[point_index[known], member_index[known]]
+        bearing[known] = self.bearing[point_index[known], member_index[known]]
+        return distance, bearing
+
+
+def add_geo_features(df: pd.DataFrame, geo: GeoMatrix) -> pd.DataFrame:
+    """
+    Adds loft_distance, loft_bearing and the headwind and crosswind of every wind_direction_degrees_<location>
+    column with its wind_speed_kph_<location> to a frame with race_point_id and member_id, e.g. the merged results
+    """
+    # the member of the participant is suffixed when the pigeons have a member column too
+    member = next((c for c in MEMBER_COLUMNS if c in df), None)
+    if 'race_point_id' not in df or member is None:
+        return df
+    distance, bearing = geo.lookup(df['race_point_id'], df[member])
+    columns = {'loft_distance': distance, 'loft_bearing': bearing}
+
+    for column in df.columns:
+        location = column.removeprefix(WIND_DIRECTION_PREFIX)
+        if location == column or f'wind_speed_kph_{location}' not in df:
+            continue
+        headwind, crosswind = wind_components(df[column], df[f'wind_speed_kph_{location}'], bearing)
+        columns[f'headwind_kph_{location}'] = headwind.astype('float32')
+        columns[f'crosswind_kph_{location}'] = crosswind.astype('float32')
+    return df.assign(**columns)
@@ -1,18 +1,181 @@
 """Geomagnetic Data
 We use the Kp index to measure the Earth's magnetic force.
 It is thought that this feature affects pigeons' homing ability.
+
+The Kp index of GFZ Potsdam is published for 3-hour intervals starting at 00:00 UTC. Fetched intervals are cached
+under DATA_PATH/geomagnetic and only the intervals missing from the cache are requested, with one request per run
+of missing intervals. Nowcast values are kept until their definitive value is published, and requested again
+until then.
+
+Usage (with src on PYTHONPATH):
+    python -m src.data_preprocess.loaders.geomagnetic 2024-01-01 2024-12-31
 """
-import requests
+import argparse
+import asyncio
+import os
+
+import aiohttp
+import numpy as np
 import pandas as pd
 
-BASE_URL = 'https://kp.gfz-potsdam.de/app/json/'
-index = 'Kp'
-start = '2010-01-01T00:00:00Z'
-end = '2025-01-01T00:00:00Z'
-url = f'{BASE_URL}?start={start}&end={end}&index={index}&status=def'
+from src import DATA_PATH
+
+# overridden e.g. by a local stand-in server, see benchmarks.mock_federation
+GFZ_URL = os.environ.get('GFZ_URL', 'https://kp.gfz-potsdam.de')
+KP_PATH = '/app/json/'
+KP_CACHE_PATH = os.path.join(DATA_PATH, 'geomagnetic')
+KP_INTERVAL = pd.Timedelta(hours=3)
+DEFINITIVE_STATUS = 'def'
+# missing intervals further apart than this are fetched in separate requests rather than one spanning request
+MAX_FETCH_GAP = pd.Timedelta(days=30)
+
+
+def empty_kp_index() -> pd.DataFrame:
+    return pd.DataFrame(
+        {'kp': pd.Series(dtype='float64'), 'status': pd.Series(dtype=object)},
+        index=pd.DatetimeIndex([], name='datetime'),
+    )
+
+
+class GeomagneticAPI:
+
+    def __init__(self, timeout: int = None, cache_path: str = KP_CACHE_PATH, offline: bool = False):
+        """
+        Parameters
+        ----------
+        timeout: int
+            aiohttp client timeout
+        cache_path: str
+            Directory of the cached Kp index
+        offline: bool
+            Only read the cache, intervals missing from it are NaN
+        """
+        self.timeout = timeout
+        self.session = None
+        self.cache_path = cache_path
+        self.offline = offline
+
+    async def __aenter__(self):
+        if not self.offline:
+            self.session = aiohttp.ClientSession(base_url=GFZ_URL, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        if self.session is not None:
+            await self.session.close()
+
+    def _cache_file(self) -> str:
+        return os.path.join(self.cache_path, 'kp.parquet')
+
+    def _load_cache(self) -> pd.DataFrame:
+        if not os.path.exists(self._cache_file()):
+            return empty_kp_index()
+        return pd.read_parquet(self._cache_file())
+
+    def _save_cache(self, df: pd.DataFrame) -> None:
+        os.makedirs(self.cache_path, exist_ok=True)
+        path = self._cache_file()
+        df.to_parquet(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+    async def fetch(self, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        """Kp index of the intervals starting between start and end, indexed by naive UTC interval start"""
+        print(f'Fetching Kp index {start} - {end}')
+        params = {
+            'start': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'end': end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'index': 'Kp',
+        }
+        res = await self.session.get(KP_PATH, params=params)
+        res_json = await res.json(content_type=None)
+
+        datetimes = pd.to_datetime(res_json.get('datetime', []), utc=True).tz_localize(None)
+        kp = np.asarray(res_json.get('Kp', []), dtype='float64')
+        status = res_json.get('status') or [DEFINITIVE_STATUS] * len(kp)
+        return pd.DataFrame({'kp': kp, 'status': status}, index=pd.DatetimeIndex(datetimes, name='datetime'))
+
+    async def get_kp_index(self, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        """
+        Kp index of every 3-hour interval overlapping start to end, read from the cache. Intervals missing from
+        the cache, or only holding a nowcast, are fetched.
+
+        Parameters
+        ----------
+        start: pd.Timestamp
+            Naive UTC
+        end: pd.Timestamp
+            Naive UTC
+
+        Returns
+        -------
+        DataFrame indexed by the naive UTC start of every interval with kp and status
+        """
+        end = min(pd.Timestamp(end), pd.Timestamp.now('UTC').tz_localize(None))
+        intervals = pd.date_range(pd.Timestamp(start).floor(KP_INTERVAL), end.floor(KP_INTERVAL), freq=KP_INTERVAL)
+        df_cache = self._load_cache()
+        definitive = df_cache.index[df_cache['status'] == DEFINITIVE_STATUS]
+        missing = intervals.difference(definitive)
+
+        if len(missing) and self.offline:
+            print(f'{len(missing)} Kp intervals missing from the cache or only nowcast, offline')
+        elif len(missing):
+            runs = missing.to_series()
+            fetched = await asyncio.gather(*(
+                self.fetch(run.min(), run.max()) for _, run in runs.groupby((runs.diff() > MAX_FETCH_GAP).cumsum())
+            ))
+            df_cache = pd.concat([df_cache, *fetched])
+            df_cache = df_cache[~df_cache.index.duplicated(keep='last')].sort_index()
+            self._save_cache(df_cache)
+
+        return df_cache[(df_cache.index >= intervals.min()) & (df_cache.index <= intervals.max())]
+
+
+def include_kp_index(df_races: pd.DataFrame, df_kp: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds kp_index, the Kp index of the 3-hour interval covering the release_datetime of every race, with an as-of
+    join on the interval starts. Races whose interval is missing get NaN.
+    """
+    df_keys = pd.DataFrame({'release_datetime': df_races['release_datetime'].to_numpy('datetime64[ns]')})
+    df_keys['position'] = np.arange(len(df_keys))
+    df_keys = df_keys.dropna().sort_values('release_datetime')
+
+    df_intervals = pd.DataFrame({'interval_start': df_kp.index.to_numpy('datetime64[ns]'), 'kp_index': df_kp['kp']})
+    df_joined = pd.merge_asof(
+        df_keys,
+        df_intervals.sort_values('interval_start'),
+        left_on='release_datetime',
+        right_on='interval_start',
+        direction='backward',
+    )
+    covered = df_joined['release_datetime'] - df_joined['interval_start'] < KP_INTERVAL
+
+    kp_index = np.full(len(df_races), np.nan)
+    kp_index[df_joined['position'].to_numpy()] = df_joined['kp_index'].where(covered).to_numpy('float64')
+    return df_races.assign(kp_index=kp_index)
+
+
+async def get_kp_for_races(df_races: pd.DataFrame, offline: bool = False) -> pd.DataFrame:
+    """Kp index of every interval from the first to the last release of df_races"""
+    releases = df_races['release_datetime'].dropna()
+    if releases.empty:
+        return empty_kp_index()
+    async with GeomagneticAPI(offline=offline) as api:
+        return await api.get_kp_index(releases.min(), releases.max())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Fetch the Kp index of a time range into the cache')
+    parser.add_argument('start', help='First day, e.g. 2024-01-01')
+    parser.add_argument('end', help='Last day, e.g. 2024-12-31')
+    args = parser.parse_args()
+
+    async def fetch() -> pd.DataFrame:
+        async with GeomagneticAPI() as api:
+            return await api.get_kp_index(pd.Timestamp(args.start), pd.Timestamp(args.end) + pd.Timedelta(hours=23))
+
+    df_kp = asyncio.run(fetch())
+    print(f'{len(df_kp)} intervals, {(df_kp.status != DEFINITIVE_STATUS).sum()} nowcast')
 
-res = requests.get(url).json()
-df_mag = pd.DataFrame({k: v for k, v in res.items() if k in ['datetime', 'Kp']})
-df_mag.datetime = df_mag.datetime.apply(pd.Timestamp)
 
-df_mag[df_mag.datetime >= '2024-01-01'].set_index('datetime').rolling(10).mean().plot(title='Planetory Kp Index')
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,172 @@
-from typing import AsyncGenerator
+from collections import deque
+from typing import AsyncGenerator, Any
 
+import asyncio
 import os
-import itertools
+import time
 import aiohttp
 
+from src.data_preprocess.loaders.response_cache import ResponseCache, CacheMiss
+
+# pages answering faster than half this grow back up to the requested size, pages slower than twice this shrink
+TARGET_PAGE_SECONDS = 1.0
+# transient failures are retried this many times, waiting RETRY_BACKOFF_SECONDS doubled on every attempt
+RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 class MaltaPigeonFederationAPI:
 
-    def __init__(self, timeout: int = None, session_limit: int = 5):
+    def __init__(
+            self,
+            timeout: int = None,
+            session_limit: int = 5,
+            cache: ResponseCache = None,
+            offline: bool = False,
+            page_window: int = 4,
+            retries: int = RETRIES,
+    ):
+        """
+        Parameters
+        ----------
+        timeout: int
+            aiohttp client timeout
+        session_limit: int
+            Maximum number of concurrent connections
+        cache: ResponseCache
+            If given, responses are read from and written to this on-disk cache
+        offline: bool
+            Replay responses from the cache only, ignoring their time to live. No connection is opened and
+            requests missing from the cache raise CacheMiss.
+        page_window: int
+            Number of page requests kept in flight by paginated endpoints, capped at session_limit
+        retries: int
+            Retries of a request failing with a status of RETRY_STATUSES, a connection error or a timeout
+        """
         self.base_url = os.environ['BASE_URL']
         self.timeout = timeout
         self.session = None
         self.session_limit = session_limit
+        self.offline = offline
+        self.page_window = page_window
+        self.retries = retries
+        self.cache = cache if cache is not None or not offline else ResponseCache()
 
     async def __aenter__(self):
-        connector = aiohttp.TCPConnector(limit=self.session_limit)
-        self.session = aiohttp.ClientSession(connector=connector, base_url=self.base_url, timeout=self.timeout)
+        if not self.offline:
+            connector = aiohttp.TCPConnector(limit=self.session_limit)
+            self.session = aiohttp.ClientSession(connector=connector, base_url=self.base_url, timeout=self.timeout)
         return self
 
     async def __aexit__(self, *args, **kwargs):
-        await self.session.close()
+        if self.session is not None:
+            await self.session.close()
+        if self.cache is not None:
+            print(f'Response cache: {self.cache.hits} hits, {self.cache.misses} misses')
 
     @staticmethod
     def params(**kwargs):
         return {k: v for k, v in kwargs.items() if v is not None}
 
+    async def get_json(self, url: str, params: dict = None) -> Any:
+        if self.cache is not None:
+            try:
+                return self.cache.get(url, params, ignore_ttl=self.offline)
+            except CacheMiss:
+                if self.offline:
+                    raise
+
+        res_json = await self._request_json(url, params)
+        if self.cache is not None:
+            self.cache.put(url, params, res_json)
+        return res_json
+
+    async def _request_json(self, url: str, params: dict = None) -> Any:
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.get(url, params=params) as res:
+                    # error bodies must not be parsed as data, nor cached: races/related responses are replayed forever
+                    res.raise_for_status()
+                    return await res.json()
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRY_STATUSES or attempt == self.retries:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+    async def _timed_get_json(self, url: str, params: dict) -> tuple[Any, float]:
+        start = time.perf_counter()
+        res_json = await self.get_json(url, params=params)
+        return res_json, time.perf_counter() - start
+
+    async def paginate(
+            self,
+            url: str,
+            params: dict,
+            limit: float,
+            offset: int,
+            batch: int,
+    ) -> AsyncGenerator:
+        """
+        Yields the pages of a paginated endpoint in order, keeping up to page_window requests in flight.
+        Stops at the first page shorter than requested or once limit records are returned.
+
+        Without a response cache the page size adapts to response times, between a quarter of batch and batch: never
+        above it, as a server capping its page size would answer a larger page short and end the pagination early.
+        With a cache the page size is fixed, so that the same offsets are requested on every run.
+
+        Parameters
+        ----------
+        url: str
+        params: dict
+            Query parameters other than limit and offset
+        limit: float
+            Maximum number of records to return
+        offset: int
+            Offset of the first record
+        batch: int
+            Initial page size
+        """
+        window = max(1, min(self.page_window, self.session_limit))
+        adaptive = self.cache is None
+        min_batch, max_batch = max(1, batch // 4), batch
+
+        pending = deque()
+        next_offset = offset
+        try:
+            while True:
+                while len(pending) < window and next_offset - offset < limit:
+                    size = int(min(batch, limit - (next_offset - offset)))
+                    page_params = {**params, 'limit': size, 'offset': next_offset}
+                    pending.append((asyncio.create_task(self._timed_get_json(url, page_params)), size))
+                    next_offset += size
+
+                if not pending:
+                    return
+
+                task, size = pending.popleft()
+                page, elapsed = await task
+                if page:
+                    yield page
+                if len(page) < size:
+                    return
+
+                if adaptive and elapsed < TARGET_PAGE_SECONDS / 2:
+                    batch = min(batch * 2, max_batch)
+                elif adaptive and elapsed > TARGET_PAGE_SECONDS * 2:
+                    batch = max(batch // 2, min_batch)
+        finally:
+            for task, _ in pending:
+                task.cancel()
+
+    def invalidate_races(self, race_ids: list[int]) -> None:
+        """Drops cached results, bookings and registrations of races whose results are still open"""
+        if self.cache is not None and not self.offline:
+            self.cache.invalidate(*(f'/unprot/races/related/{race_id}/' for race_id in race_ids))
+
     async def get_race_results(
             self,
             race_id: int,
@@ -36,8 +178,7 @@ class MaltaPigeonFederationAPI:
         limit = limit or 10e100
         print(f'Getting race results for {race_id}')
         params = self.params(**{'club': club, 'section': section, 'limit': limit})
-        res = await self.session.get(url, params=params)
-        res_json = await res.json()
+        res_json = await self.get_json(url, params=params)
 
         return res_json
 
@@ -49,8 +190,7 @@ class MaltaPigeonFederationAPI:
         limit = limit or 1_000
         url = '/unprot/races/list/currentseason.json' if current_season else '/unprot/races/list.json'
         params = self.params(**{'limit': limit})
-        res = await self.session.get(url, params=params)
-        res_json = await res.json()
+        res_json = await self.get_json(url, params=params)
         return res_json
 
     async def get_pigeon_list(
@@ -70,26 +210,19 @@ class MaltaPigeonFederationAPI:
         tot_returned = 0
         prepend = f'of club {club}' if club else ''
         print(f' Loading pigeons {prepend}...')
-        for req_num in itertools.count():
-            params = self.params(**{'club': club, 'section': section, 'state': state, 'limit': batch,
-                                    'offset': offset + req_num * batch})
-
-            res_partial = await self.session.get(url, params=params)
-            res_json = await res_partial.json()
+        params = self.params(**{'club': club, 'section': section, 'state': state})
+        async for res_json in self.paginate(url, params, limit=limit, offset=offset, batch=batch):
             tot_returned += len(res_json)
-
-            is_exhausted = len(res_json) == 0
-            is_limit_reached = tot_returned >= limit
-            if is_exhausted or is_limit_reached:
-                if is_limit_reached:
-                    yield res_json
-                print(f'[Request {req_num + 1}] Loaded {tot_returned} pigeons {prepend}...')
-                return
-
             yield res_json
+        print(f'Loaded {tot_returned} pigeons {prepend}...')
 
     async def get_all_pigeons(self) -> list[dict]:
-        return [res for club in range(1, 27) async for res in self.get_pigeon_list(club=club)]
+        async def get_club_pigeons(club: int) -> list:
+            return [res async for res in self.get_pigeon_list(club=club)]
+
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(get_club_pigeons(club)) for club in range(1, 27)]
+        return [res for task in tasks for res in task.result()]
 
     async def get_members_list(
             self,
@@ -99,8 +232,7 @@ class MaltaPigeonFederationAPI:
     ) -> list[dict]:
         url = '/unprot/members/list.json'
         params = self.params(**{'club': club, 'section': section, 'limit': limit})
-        res = await self.session.get(url, params=params)
-        res_json = await res.json()
+        res_json = await self.get_json(url, params=params)
         return res_json
 
     async def get_pigeon_races(
@@ -111,8 +243,7 @@ class MaltaPigeonFederationAPI:
         limit = limit or 10e100
         url = f'/unprot/pigeons/related/{pigeon_id}/races.json'
         params = self.params(**{'limit': limit})
-        res = await self.session.get(url, params=params)
-        res_json = await res.json()
+        res_json = await self.get_json(url, params=params)
         return res_json
 
     async def get_race_club_stats(
@@ -122,8 +253,7 @@ class MaltaPigeonFederationAPI:
     ) -> list[dict]:
         url = f'/unprot/races/related/{race_id}/bookings.json'
         params = self.params(**{'club': club})
-        res = await self.session.get(url, params=params)
-        res_json = await res.json()
+        res_json = await self.get_json(url, params=params)
         return res_json
 
     async def get_race_participants(
@@ -140,25 +270,14 @@ class MaltaPigeonFederationAPI:
 
         tot_returned = 0
         print(f'Load race participants for {race_id=}')
-        for req_num in itertools.count():
-            url = f'/unprot/races/related/{race_id}/registers.json'
-            params = self.params(**{'club': club, 'limit': batch, 'offset': offset + req_num * batch})
-            res_partial = await self.session.get(url, params=params)
-            res = await res_partial.json()
+        url = f'/unprot/races/related/{race_id}/registers.json'
+        params = self.params(**{'club': club})
+        async for res in self.paginate(url, params, limit=limit, offset=offset, batch=batch):
             tot_returned += len(res)
-
-            is_exhausted = len(res) == 0
-            is_limit_reached = tot_returned >= limit
-            if is_exhausted or is_limit_reached:
-                if is_limit_reached:
-                    yield res
-                print(f'[Request {req_num + 1}] Loaded {tot_returned} race participants for {race_id=}...')
-                return
-
             yield res
+        print(f'Loaded {tot_returned} race participants for {race_id=}...')
 
     async def get_race_points(self) -> list[dict]:
         url = f'/unprot/racepoints/list.json'
-        res = await self.session.get(url)
-        res_json = await res.json()
+        res_json = await self.get_json(url)
         return res_json
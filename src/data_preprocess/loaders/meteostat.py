@@ -1,11 +1,21 @@
 from datetime import datetime
-from functools import cache
+import os
 
+import pandas as pd
 from meteostat import Point, Hourly
 
+from src import DATA_PATH
+
 HOME_LAT_LON = 35.935069, 14.491261
 SICILY_LAT_LON = 36.7228304, 14.8160372
 
+WEATHER_CACHE_PATH = os.path.join(DATA_PATH, 'weather_cache')
+WEATHER_FIELDS = ['temp', 'dwpt', 'rhum', 'prcp', 'wdir', 'wspd', 'pres']
+# missing hours further apart than this are fetched in separate requests rather than one spanning request
+MAX_FETCH_GAP = pd.Timedelta(days=30)
+# hours without data this recent may not be published yet, they are not cached so that they are fetched again
+PUBLISH_DELAY = pd.Timedelta(days=7)
+
 
 def get_all_locations():
     return {
@@ -14,19 +24,111 @@ def get_all_locations():
     }
 
 
-@cache
-def _get_weather(lat, lon, dt) -> tuple:
-    loc = Point(lat, lon, 70)
-    dt = datetime(dt.year, dt.month, dt.day, dt.hour)
-    try:
-        res = Hourly(loc, dt, dt).fetch().iloc[0]
-    except IndexError:
-        print(f'No weather data for on {dt}@{lat},{lon}')
-        return None, None, None, None, None, None, None
-    return res.temp, res.dwpt, res.rhum, res.prcp, res.wdir, res.wspd, res.pres
+def _cache_file(lat: float, lon: float) -> str:
+    return os.path.join(WEATHER_CACHE_PATH, f'{lat:.4f}_{lon:.4f}.parquet')
+
+
+def _load_cache(lat: float, lon: float) -> pd.DataFrame:
+    path = _cache_file(lat, lon)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=WEATHER_FIELDS, index=pd.DatetimeIndex([], name='time'), dtype=float)
+    return pd.read_parquet(path)
+
+
+def _save_cache(lat: float, lon: float, df: pd.DataFrame) -> None:
+    os.makedirs(WEATHER_CACHE_PATH, exist_ok=True)
+    path = _cache_file(lat, lon)
+    df.to_parquet(f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+
+
+def _fetch_hourly(lat: float, lon: float, start: datetime, end: datetime) -> pd.DataFrame:
+    print(f'Fetching hourly weather {start} - {end}@{lat},{lon}')
+    hours = pd.date_range(start, end, freq='h', name='time')
+    df = Hourly(Point(lat, lon, 70), start, end).fetch()
+    if df.empty:
+        print(f'No weather data for {start} - {end}@{lat},{lon}')
+    # hours without data are kept as NaN so that they are not fetched again, unless recent, see get_hourly_weather
+    return df.reindex(columns=WEATHER_FIELDS).reindex(hours).astype(float)
+
+
+def unpublished_since() -> pd.Timestamp:
+    """Naive UTC time from which hours without data may still be published"""
+    return pd.Timestamp.now('UTC').tz_localize(None) - PUBLISH_DELAY
+
+
+def get_hourly_weather(lat: float, lon: float, hours: pd.DatetimeIndex) -> pd.DataFrame:
+    """
+    Hourly weather at a location, read from the on-disk cache. Only hours missing from the cache are fetched,
+    with one request per run of missing hours. Hours without data within PUBLISH_DELAY of now are not cached, so
+    that they are fetched again once meteostat publishes them.
+
+    Parameters
+    ----------
+    lat: float
+    lon: float
+    hours: pd.DatetimeIndex
+        Naive UTC timestamps, floored to the hour
+
+    Returns
+    -------
+    DataFrame indexed by hours with the meteostat columns temp, dwpt, rhum, prcp, wdir, wspd, pres
+    """
+    hours = pd.DatetimeIndex(hours).unique().sort_values()
+    df_cache = _load_cache(lat, lon)
+    missing = hours.difference(df_cache.index)
+
+    if len(missing):
+        run_ids = (missing.to_series().diff() > MAX_FETCH_GAP).cumsum()
+        fetched = [
+            _fetch_hourly(lat, lon, run.min().to_pydatetime(), run.max().to_pydatetime())
+            for _, run in missing.to_series().groupby(run_ids)
+        ]
+        df_cache = pd.concat([df_cache, *fetched])
+        df_cache = df_cache[~df_cache.index.duplicated(keep='last')].sort_index()
+        unpublished = df_cache.isna().all(axis=1) & (df_cache.index >= unpublished_since())
+        _save_cache(lat, lon, df_cache[~unpublished])
+
+    return df_cache.reindex(hours)
+
+
+def get_weather(df_races: pd.DataFrame, lat_lon: tuple[float, float] = None) -> pd.DataFrame:
+    """
+    Weather at the release hour of every race, either at a fixed location or at each race's departure point.
+
+    Parameters
+    ----------
+    df_races: pd.DataFrame
+        Races with release_datetime, and latitude/longitude if lat_lon is not given
+    lat_lon: tuple[float, float]
+        Fixed location. Defaults to the departure coordinates of each race.
+
+    Returns
+    -------
+    DataFrame aligned to df_races.index with the meteostat columns temp, dwpt, rhum, prcp, wdir, wspd, pres
+    """
+    df_keys = pd.DataFrame({'time': df_races['release_datetime'].dt.floor('h')}, index=df_races.index)
+    if lat_lon is None:
+        df_keys['latitude'], df_keys['longitude'] = df_races['latitude'], df_races['longitude']
+    else:
+        df_keys['latitude'], df_keys['longitude'] = lat_lon
+
+    weather = []
+    for (lat, lon), df_loc in df_keys.dropna().groupby(['latitude', 'longitude']):
+        df_weather = get_hourly_weather(lat, lon, pd.DatetimeIndex(df_loc['time']))
+        weather.append(df_weather.reset_index().assign(latitude=lat, longitude=lon))
+
+    if not weather:
+        return pd.DataFrame(index=df_races.index, columns=WEATHER_FIELDS, dtype=float)
+
+    df_weather = pd.concat(weather, ignore_index=True)
+    df_out = df_keys.merge(df_weather, on=['latitude', 'longitude', 'time'], how='left')[WEATHER_FIELDS]
+    df_out.index = df_keys.index
+    return df_out
 
 
 def get_geo_weather(x, lat_lon: tuple[float, float] = None) -> tuple:
     release_dt = x['release_datetime']
     lat, lon = lat_lon or (x['latitude'], x['longitude'])
-    return _get_weather(lat, lon, release_dt)
+    hour = pd.Timestamp(release_dt).floor('h')
+    return tuple(get_hourly_weather(lat, lon, pd.DatetimeIndex([hour])).iloc[0])
@@ -0,0 +1,114 @@
+"""Response Cache
+On-disk cache of federation API responses, keyed by request path and normalised query parameters.
+Each endpoint has its own time to live: results of finished races never change, whereas the race list of the
+current season changes every week. Responses are stored as gzipped JSON, one directory per request path, so
+that all cached pages of a race can be invalidated at once.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from typing import Any
+
+from src import DATA_PATH
+
+HTTP_CACHE_PATH = os.path.join(DATA_PATH, 'http_cache')
+
+# (path pattern, time to live in seconds), first match wins. None means the response never expires.
+ENDPOINT_TTLS = [
+    (r'^/unprot/races/list/currentseason\.json$', 15 * 60),
+    (r'^/unprot/races/list\.json$', 60 * 60),
+    (r'^/unprot/races/related/\d+/', None),
+    (r'^/unprot/pigeons/related/\d+/races\.json$', 24 * 60 * 60),
+    (r'^/unprot/pigeons/list\.json$', 24 * 60 * 60),
+    (r'^/unprot/members/list\.json$', 24 * 60 * 60),
+    (r'^/unprot/racepoints/list\.json$', 7 * 24 * 60 * 60),
+]
+DEFAULT_TTL = 60 * 60
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+def _normalise_param(value: Any) -> str:
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class ResponseCache:
+
+    def __init__(self, path: str = HTTP_CACHE_PATH, ttls: list[tuple[str, int]] = None):
+        self.path = path
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or ENDPOINT_TTLS)]
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self, url: str):
+        return next((ttl for pattern, ttl in self.ttls if pattern.search(url)), DEFAULT_TTL)
+
+    @staticmethod
+    def _url_dir(url: str) -> str:
+        return re.sub(r'[^0-9A-Za-z.]+', '_', url).lstrip('_')
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        params = sorted((k, _normalise_param(v)) for k, v in (params or {}).items() if v is not None)
+        return hashlib.sha1(json.dumps([url, params]).encode()).hexdigest()
+
+    def _file(self, url: str, params: dict = None) -> str:
+        return os.path.join(self.path, self._url_dir(url), f'{self.key(url, params)}.json.gz')
+
+    def get(self, url: str, params: dict = None, ignore_ttl: bool = False) -> Any:
+        """
+        Parameters
+        ----------
+        url: str
+            Request path relative to BASE_URL
+        params: dict
+            Query parameters
+        ignore_ttl: bool
+            Return the cached response even if expired, used for offline replay
+
+        Raises
+        ------
+        CacheMiss if the response is not cached or has expired
+        """
+        file = self._file(url, params)
+        try:
+            with gzip.open(file, 'rt') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            raise CacheMiss(url)
+
+        ttl = self.ttl(url)
+        if not ignore_ttl and ttl is not None and time.time() - entry['fetched_at'] > ttl:
+            self.misses += 1
+            raise CacheMiss(url)
+
+        self.hits += 1
+        return entry['body']
+
+    def put(self, url: str, params: dict, body: Any) -> None:
+        file = self._file(url, params)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with gzip.open(f'{file}.tmp', 'wt', compresslevel=6) as f:
+            json.dump({'url': url, 'params': params, 'fetched_at': time.time(), 'body': body}, f)
+        os.replace(f'{file}.tmp', file)
+
+    def invalidate(self, *url_prefixes: str) -> None:
+        """Drops every cached response whose request path starts with one of url_prefixes, listing the cache once"""
+        if not url_prefixes or not os.path.isdir(self.path):
+            return
+        prefixes = {self._url_dir(url_prefix) for url_prefix in url_prefixes}
+        lengths = {len(prefix) for prefix in prefixes}
+        for url_dir in os.listdir(self.path):
+            if any(url_dir[:length] in prefixes for length in lengths):
+                shutil.rmtree(os.path.join(self.path, url_dir), ignore_errors=True)
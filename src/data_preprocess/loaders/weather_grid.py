@@ -0,0 +1,286 @@
+"""Weather Grid
+Hourly weather on a regular latitude/longitude grid over the Malta-Sicily flight corridor.
+
+Every node of the grid is fetched once per hour through the hourly cache of meteostat, and the grid is kept as one
+float32 array with time, latitude, longitude and field axes. Weather anywhere in the corridor, e.g. at a loft, a
+race point or along the flight line, is then interpolated from the grid for many locations at once instead of being
+fetched per location:
+    * bilinear in latitude and longitude, and linear in time between consecutive stored hours
+    * wind direction is interpolated as a unit vector, so that 350 and 10 degrees average to 0 and not 180
+    * nodes without data are left out of the interpolation, the remaining weights are renormalised
+
+Locations outside the corridor fall back to the weather of their own coordinates, see meteostat.get_weather.
+
+The grid is saved under DATA_PATH/weather_grid as an uncompressed npz, and extended with the hours it is missing.
+
+Usage (with src on PYTHONPATH):
+    python -m src.data_preprocess.loaders.weather_grid 2024-03-01 2024-03-31
+"""
+import argparse
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from src import DATA_PATH
+from src.data_preprocess.loaders.meteostat import HOME_LAT_LON, WEATHER_FIELDS, get_hourly_weather, get_weather
+from src.data_preprocess.loaders.meteostat import unpublished_since
+
+WEATHER_GRID_PATH = os.path.join(DATA_PATH, 'weather_grid')
+# south, north, west, east, covering Malta, Gozo and the south east of Sicily
+CORRIDOR = (35.75, 37.25, 14.0, 15.5)
+GRID_STEP = 0.25
+ROUTE_POINTS = 16
+WIND_DIRECTION = WEATHER_FIELDS.index('wdir')
+
+
+class WeatherGrid:
+
+    def __init__(self, path: str = WEATHER_GRID_PATH, bounds: tuple = CORRIDOR, step: float = GRID_STEP):
+        """
+        Parameters
+        ----------
+        path: str
+            Directory the grid is saved to
+        bounds: tuple
+            South, north, west and east edges of the grid in degrees
+        step: float
+            Spacing of the grid nodes in degrees
+        """
+        self.path = path
+        south, north, west, east = bounds
+        self.lats = np.round(np.arange(south, north + step / 2, step), 6)
+        self.lons = np.round(np.arange(west, east + step / 2, step), 6)
+        self.step = step
+        self.times = np.array([], dtype='datetime64[ns]')
+        self.values = np.empty((0, len(self.lats), len(self.lons), len(WEATHER_FIELDS)), dtype='float32')
+
+        grid_path = os.path.join(path, 'grid.npz')
+        if not os.path.exists(grid_path):
+            return
+        with np.load(grid_path) as data:
+            if np.array_equal(data['lats'], self.lats) and np.array_equal(data['lons'], self.lons):
+                self.times, self.values = data['times'], data['values']
+            else:
+                print(f'Weather grid at {path} has other nodes, it is fetched again')
+
+    def __len__(self):
+        return len(self.times)
+
+    def save(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, 'grid.npz')
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f, times=self.times, lats=self.lats, lons=self.lons, values=self.values)
+        os.replace(f'{path}.tmp', path)
+
+    def contains(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Whether every location is inside the grid"""
+        lat, lon = np.asarray(lat, dtype='float64'), np.asarray(lon, dtype='float64')
+        return (
+            (lat >= self.lats[0]) & (lat <= self.lats[-1]) &
+            (lon >= self.lons[0]) & (lon <= self.lons[-1])
+        )
+
+    def ensure(self, hours: pd.DatetimeIndex, save: bool = True) -> int:
+        """
+        Fetches the hours missing from the grid at every node, with one request per run of missing hours per node.
+        Recent hours without data at some node, which meteostat may not have published yet (see
+        meteostat.PUBLISH_DELAY), are fetched again.
+
+        Parameters
+        ----------
+        hours: pd.DatetimeIndex
+            Naive UTC timestamps, floored to the hour
+        save: bool
+
+        Returns
+        -------
+        Number of hours fetched
+        """
+        hours = pd.DatetimeIndex(hours).dropna().floor('h').unique().sort_values()
+        times = pd.DatetimeIndex(self.times)
+        unpublished = (times >= unpublished_since()) & np.isnan(self.values).all(axis=3).any(axis=(1, 2))
+        missing = hours.difference(times).union(hours.intersection(times[unpublished]))
+        if missing.empty:
+            return 0
+
+        print(f'Fetching {len(missing)} hours of weather for {len(self.lats) * len(self.lons)} grid nodes')
+        values = np.empty((len(missing), len(self.lats), len(self.lons), len(WEATHER_FIELDS)), dtype='float32')
+        for i, lat in enumerate(self.lats):
+            for j, lon in enumerate(self.lons):
+                values[:, i, j] = get_hourly_weather(float(lat), float(lon), missing)[WEATHER_FIELDS].to_numpy()
+
+        keep = ~times.isin(missing)
+        times = np.concatenate([self.times[keep], missing.to_numpy('datetime64[ns]')])
+        order = np.argsort(times, kind='stable')
+        self.times, self.values = times[order], np.concatenate([self.values[keep], values])[order]
+        if save:
+            self.save()
+        return len(missing)
+
+    def sample(self, lat: np.ndarray, lon: np.ndarray, time: np.ndarray) -> pd.DataFrame:
+        """
+        Weather interpolated at many locations and times at once
+
+        Parameters
+        ----------
+        lat: np.ndarray
+        lon: np.ndarray
+        time: np.ndarray
+            Naive UTC timestamps. Times between two stored hours that are not consecutive, or outside the stored
+            hours, are NaN.
+
+        Returns
+        -------
+        DataFrame with the meteostat columns temp, dwpt, rhum, prcp, wdir, wspd, pres, NaN outside the grid
+        """
+        lat, lon = np.asarray(lat, dtype='float64'), np.asarray(lon, dtype='float64')
+        time = pd.DatetimeIndex(np.asarray(time, dtype='datetime64[ns]')).to_numpy('datetime64[ns]')
+        n = len(lat)
+        out = np.full((n, len(WEATHER_FIELDS)), np.nan)
+        if n == 0 or len(self.times) == 0:
+            return pd.DataFrame(out, columns=WEATHER_FIELDS)
+
+        hour = np.timedelta64(1, 'h')
+        t0 = np.clip(np.searchsorted(self.times, time, side='right') - 1, 0, len(self.times) - 1)
+        t1 = np.minimum(t0 + 1, len(self.times) - 1)
+        wt = (time - self.times[t0]) / hour
+        exact = wt == 0
+        valid = self.contains(lat, lon) & ~np.isnat(time) & (
+            exact | ((wt > 0) & (wt < 1) & (self.times[t1] - self.times[t0] == hour))
+        )
+
+        y = (np.clip(lat, self.lats[0], self.lats[-1]) - self.lats[0]) / self.step
+        x = (np.clip(lon, self.lons[0], self.lons[-1]) - self.lons[0]) / self.step
+        i0 = np.minimum(y.astype('int64'), len(self.lats) - 2).clip(0)
+        j0 = np.minimum(x.astype('int64'), len(self.lons) - 2).clip(0)
+        wy, wx = y - i0, x - j0
+
+        # wind direction is interpolated as its sine and cosine, appended as two extra fields
+        total = np.zeros((n, len(WEATHER_FIELDS) + 2))
+        weights = np.zeros((n, len(WEATHER_FIELDS) + 2))
+        for t, w_t in ((t0, 1 - wt), (t1, wt)):
+            for di, w_y in ((0, 1 - wy), (1, wy)):
+                for dj, w_x in ((0, 1 - wx), (1, wx)):
+                    corner = self.values[t, i0 + di, j0 + dj]
+                    radians = np.deg2rad(corner[:, WIND_DIRECTION])
+                    corner = np.column_stack([corner, np.sin(radians), np.cos(radians)])
+                    w = (w_t * w_y * w_x)[:, None] * ~np.isnan(corner)
+                    total += w * np.nan_to_num(corner)
+                    weights += w
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / weights
+        direction = np.rad2deg(np.arctan2(mean[:, -2], mean[:, -1])) % 360
+        mean[:, WIND_DIRECTION] = np.where(np.isnan(mean[:, WIND_DIRECTION]), np.nan, direction)
+        out[valid] = mean[valid, :len(WEATHER_FIELDS)]
+        return pd.DataFrame(out, columns=WEATHER_FIELDS)
+
+    def sample_route(
+            self,
+            start: tuple[np.ndarray, np.ndarray],
+            end: tuple[np.ndarray, np.ndarray],
+            time: np.ndarray,
+            n_points: int = ROUTE_POINTS,
+    ) -> pd.DataFrame:
+        """
+        Mean weather along the straight lines from start to end, at n_points evenly spaced points of each line.
+        Points outside the grid are left out of the mean, wind direction is the direction of the mean wind vector.
+
+        Parameters
+        ----------
+        start: tuple[np.ndarray, np.ndarray]
+            Latitudes and longitudes of the start of every line, e.g. race points
+        end: tuple[np.ndarray, np.ndarray]
+            Latitudes and longitudes of the end of every line, e.g. lofts
+        time: np.ndarray
+            Naive UTC timestamp of every line
+        n_points: int
+        """
+        lat0, lon0, lat1, lon1, time = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(c, dtype='float64')) for c in (*start, *end)],
+            np.atleast_1d(np.asarray(time, dtype='datetime64[ns]')),
+        )
+        n = len(lat0)
+        s = np.linspace(0, 1, n_points)
+        points = self.sample(
+            (lat0[:, None] + s * (lat1 - lat0)[:, None]).ravel(),
+            (lon0[:, None] + s * (lon1 - lon0)[:, None]).ravel(),
+            np.repeat(time, n_points),
+        ).to_numpy().reshape(n, n_points, len(WEATHER_FIELDS))
+
+        radians = np.deg2rad(points[:, :, WIND_DIRECTION])
+        with warnings.catch_warnings():
+            # lines entirely outside the grid are NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(points, axis=1)
+            direction = np.rad2deg(np.arctan2(np.nanmean(np.sin(radians), axis=1), np.nanmean(np.cos(radians), axis=1)))
+        mean[:, WIND_DIRECTION] = np.where(np.isnan(mean[:, WIND_DIRECTION]), np.nan, direction % 360)
+        return pd.DataFrame(mean, columns=WEATHER_FIELDS)
+
+    def get_weather(self, df_races: pd.DataFrame, lat_lon: tuple[float, float] = None) -> pd.DataFrame:
+        """
+        Weather at the release hour of every race, like meteostat.get_weather, interpolated from the grid. Races
+        whose location is outside the grid are fetched at their own coordinates.
+
+        Parameters
+        ----------
+        df_races: pd.DataFrame
+            Races with release_datetime, and latitude/longitude if lat_lon is not given
+        lat_lon: tuple[float, float]
+            Fixed location. Defaults to the departure coordinates of each race.
+
+        Returns
+        -------
+        DataFrame aligned to df_races.index with the meteostat columns temp, dwpt, rhum, prcp, wdir, wspd, pres
+        """
+        hours = df_races['release_datetime'].dt.floor('h')
+        if lat_lon is None:
+            lat, lon = df_races['latitude'].to_numpy('float64'), df_races['longitude'].to_numpy('float64')
+        else:
+            lat, lon = np.full(len(df_races), lat_lon[0]), np.full(len(df_races), lat_lon[1])
+
+        inside = self.contains(lat, lon)
+        self.ensure(pd.DatetimeIndex(hours[inside]))
+        df_out = self.sample(lat, lon, hours.to_numpy('datetime64[ns]'))
+        df_out.index = df_races.index
+        if not inside.all():
+            df_outside = df_races[~inside]
+            df_out.loc[~inside] = get_weather(df_outside, lat_lon=lat_lon).to_numpy()
+        return df_out
+
+    def get_route_weather(self, df_races: pd.DataFrame, lat_lon: tuple[float, float] = HOME_LAT_LON) -> pd.DataFrame:
+        """
+        Mean weather at the release hour of every race along its flight line, from its departure coordinates to
+        lat_lon, see sample_route. Only the part of the line inside the grid is sampled.
+
+        Returns
+        -------
+        DataFrame aligned to df_races.index with the meteostat columns temp, dwpt, rhum, prcp, wdir, wspd, pres
+        """
+        hours = df_races['release_datetime'].dt.floor('h')
+        self.ensure(pd.DatetimeIndex(hours))
+        df_out = self.sample_route(
+            (df_races['latitude'].to_numpy('float64'), df_races['longitude'].to_numpy('float64')),
+            lat_lon,
+            hours.to_numpy('datetime64[ns]'),
+        )
+        df_out.index = df_races.index
+        return df_out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Fetch the weather grid of a time range')
+    parser.add_argument('start', help='First day, e.g. 2024-03-01')
+    parser.add_argument('end', help='Last day, e.g. 2024-03-31')
+    args = parser.parse_args()
+    grid = WeatherGrid()
+    hours = pd.date_range(args.start, pd.Timestamp(args.end) + pd.Timedelta(hours=23), freq='h')
+    added = grid.ensure(hours)
+    print(f'Added {added} hours, the grid holds {len(grid)} hours of {grid.values.nbytes / 2 ** 20:.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
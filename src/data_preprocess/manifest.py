@@ -0,0 +1,78 @@
+"""Race ingestion manifest
+Keeps a record of every race already pulled into the local snapshot, so that
+incremental runs only fetch races which are new or whose results are still open.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+
+from src import DATA_PATH
+
+MANIFEST_PATH = os.path.join(DATA_PATH, 'race_manifest.json')
+CLOSED_STATUS = 'RESULTS_CLOSED'
+OPEN_RACE_DAYS = 7
+
+
+class RaceManifest:
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.races = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.races = {int(race_id): entry for race_id, entry in json.load(f).items()}
+
+    def __len__(self):
+        return len(self.races)
+
+    def __contains__(self, race_id: int):
+        return race_id in self.races
+
+    @staticmethod
+    def is_closed(race: dict) -> bool:
+        """
+        A race is considered closed once the federation marks its results as closed and
+        enough time has passed since release for late clockings to have been processed.
+        """
+        release_epoch = race.get('releaseDatetime')
+        if release_epoch is None:
+            return False
+
+        released_long_ago = datetime.fromtimestamp(release_epoch / 1000) < datetime.now() - timedelta(OPEN_RACE_DAYS)
+        return race.get('status') == CLOSED_STATUS and released_long_ago
+
+    def races_to_fetch(self, races: list[dict]) -> list[dict]:
+        """
+        Parameters
+        ----------
+        races: list[dict]
+            Raw race list as returned by MaltaPigeonFederationAPI.get_race_list
+
+        Returns
+        -------
+        Races which were never ingested, were still open when last ingested, or whose release changed since.
+        """
+        to_fetch = []
+        for race in races:
+            entry = self.races.get(race['id'])
+            if entry is None or not entry['closed'] or entry['release_epoch'] != race.get('releaseDatetime'):
+                to_fetch.append(race)
+        return to_fetch
+
+    def update(self, races: list[dict], n_results: dict, n_participants: dict) -> None:
+        ingested_at = datetime.now().isoformat(timespec='seconds')
+        for race in races:
+            self.races[race['id']] = {
+                'release_epoch': race.get('releaseDatetime'),
+                'status': race.get('status'),
+                'closed': self.is_closed(race),
+                'n_results': int(n_results.get(race['id'], 0)),
+                'n_participants': int(n_participants.get(race['id'], 0)),
+                'ingested_at': ingested_at,
+            }
+
+    def save(self) -> None:
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({str(race_id): entry for race_id, entry in self.races.items()}, f, indent=1)
+        os.replace(tmp_path, self.path)
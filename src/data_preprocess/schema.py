@@ -0,0 +1,211 @@
+"""Schema
+Declared column types of the tables produced by get_all_data.
+
+Every table is cast to its schema as soon as it is normalised from the federation responses, again after merging
+and when it is written to or read from the snapshot store, so that no table lives in memory as int64, float64 or
+object strings for longer than it takes to cast it:
+    * ids, club numbers, counts and levels are the narrowest integer type holding the federation's values
+    * points, velocities, distances and weather are float32
+    * repeated strings such as race point names, compass directions, owners and pigeon states are categories,
+      compass directions with the fixed categories of COMPASS_POINTS
+    * epochs in milliseconds stay int64, datetimes are datetime64[ns]
+
+df_races and df_race_results_final take the types of the tables they are merged from, including the suffixed
+columns of the merges (e.g. distance_race_points, club_number_pigeon). Weather columns are typed by their prefix,
+for every location. Columns not declared anywhere keep the type they were read with.
+
+An integer column holding a value out of range of its declared type is widened to int64, and one with missing
+values, e.g. pigeon attributes of a pigeon missing from df_pigeons, becomes the pandas nullable integer of the same
+width (Int16, Int32, Int64), as a float would round ids above 2 ** 53. The integer columns of the tables left-merged
+into df_race_results_final are made nullable before the merge (see nullable_integers), for the same reason.
+"""
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from src.data_preprocess.utils import COMPASS_POINTS
+
+COMPASS = pd.CategoricalDtype(list(COMPASS_POINTS))
+
+RACES = {
+    'id': 'int32',
+    'race_id': 'int32',
+    'race_point_id': 'int32',
+    'season_id': 'int16',
+    'club_number': 'int16',
+    'status': 'category',
+    'release_epoch': 'int64',
+    'release_datetime': 'datetime64[ns]',
+    'release_month': 'int8',
+    'release_hour': 'int8',
+    'name': 'category',
+    'race_name': 'category',
+    'race_point_name': 'category',
+    'race_point_types': 'category',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'distance': 'float32',
+    'registered_pigeons': 'int32',
+    'arrived_pigeons': 'int32',
+    'arrival_rate': 'float32',
+    'kp_index': 'float32',
+}
+PIGEONS = {
+    'id': 'int32',
+    'club_number': 'int16',
+    'season_id': 'int16',
+    'member_id': 'int32',
+    'current_level': 'int16',
+    'last_year_level': 'int16',
+    'owner_name': 'category',
+    'state': 'category',
+}
+MEMBERS = {
+    'id': 'int32',
+    'club_number': 'int16',
+    'section_number': 'int16',
+    'state': 'category',
+    'loft_latitude': 'float64',
+    'loft_longitude': 'float64',
+}
+RACE_RESULTS = {
+    'race_id': 'int32',
+    'pigeon_id': 'int32',
+    'member_id': 'int32',
+    'club_number': 'int16',
+    'season_id': 'int16',
+    'velocity': 'float32',
+    'arrival_datetime': 'datetime64[ns]',
+    'club_points': 'float32',
+    'section_points': 'float32',
+    'federation_points': 'float32',
+    'participants': 'int32',
+    'member_participants': 'int32',
+}
+RACE_PARTICIPANTS = {
+    'race_id': 'int32',
+    'pigeon_id': 'int32',
+    'member_id': 'int32',
+    'club_number': 'int16',
+    'season_id': 'int16',
+    'velocity': 'float32',
+    'arrival_datetime': 'datetime64[ns]',
+}
+# distance and bearing of the loft from the race point, see data_preprocess.geo
+GEO = {
+    'loft_distance': 'float32',
+    'loft_bearing': 'float32',
+}
+# weather of every location (malta, sicily, departure, route), see include_weather_stats, and its wind components
+# along the flight heading, see data_preprocess.geo
+WEATHER_PREFIXES = {
+    'temperature_': 'float32',
+    'dew_point_': 'float32',
+    'relative_humidity_': 'float32',
+    'precipitation_': 'float32',
+    'wind_direction_degrees_': 'float32',
+    'wind_speed_kph_': 'float32',
+    'air_pressure_': 'float32',
+    'wind_speed_beaufort_': 'float32',
+    'wind_direction_compass_': COMPASS,
+    'headwind_kph_': 'float32',
+    'crosswind_kph_': 'float32',
+}
+
+SCHEMAS = {
+    'df_races': RACES,
+    'df_pigeons': PIGEONS,
+    'df_members': MEMBERS,
+    'df_race_results': RACE_RESULTS,
+    'df_race_participants': RACE_PARTICIPANTS,
+    'df_race_results_final': {**RACE_PARTICIPANTS, **PIGEONS, **RACES, **GEO},
+    'df_pigeon_races': {**RACE_RESULTS, **RACE_PARTICIPANTS, 'release_datetime': 'datetime64[ns]'},
+}
+# suffixes of the columns shared between the tables merged into df_races and df_race_results_final
+MERGE_SUFFIXES = ('_race_results', '_race_points', '_pigeon', '_race')
+
+# columns already reported as too wide for their declared type
+_widened = set()
+
+
+def column_type(table: str, column: str) -> Optional[Union[str, pd.CategoricalDtype]]:
+    """Declared type of a column of a table, None if it is not declared"""
+    schema = SCHEMAS.get(table, {})
+    if column in schema:
+        return schema[column]
+    for suffix in MERGE_SUFFIXES:
+        if column.endswith(suffix) and column.removesuffix(suffix) in schema:
+            return schema[column.removesuffix(suffix)]
+    for prefix, dtype in WEATHER_PREFIXES.items():
+        if column.startswith(prefix):
+            return dtype
+    return None
+
+
+def _cast_integer(values: pd.Series, dtype: str) -> pd.Series:
+    if values.dtype == object:
+        values = pd.to_numeric(values, errors='coerce', dtype_backend='numpy_nullable')
+
+    info = np.iinfo(dtype)
+    present = values.dropna()
+    if len(present) and (present.min() < info.min or present.max() > info.max):
+        if values.name not in _widened:
+            print(f'Column {values.name} does not fit in {dtype}, keeping it as int64')
+            _widened.add(values.name)
+        dtype = 'int64'
+    if values.isna().any():
+        # int32 -> Int32, holding missing values without going through a float
+        dtype = dtype.capitalize()
+    return values if values.dtype == dtype else values.astype(dtype)
+
+
+def _cast(values: pd.Series, dtype: Union[str, pd.CategoricalDtype]) -> pd.Series:
+    if isinstance(dtype, pd.CategoricalDtype) or dtype == 'category':
+        if isinstance(values.dtype, pd.CategoricalDtype) and (dtype == 'category' or values.dtype == dtype):
+            return values
+        return values.astype(dtype)
+    if values.dtype == dtype:
+        return values
+    if dtype.startswith('datetime64'):
+        if pd.api.types.is_numeric_dtype(values):
+            return pd.to_datetime(values, unit='ms')
+        return pd.to_datetime(values)
+    if np.dtype(dtype).kind == 'i':
+        return _cast_integer(values, dtype)
+    return pd.to_numeric(values, errors='coerce').astype(dtype)
+
+
+def nullable_integers(df: pd.DataFrame) -> pd.DataFrame:
+    """df with its integer columns as pandas nullable integers, which a left merge keeps exact where rows are missing"""
+    casts = {c: df[c].astype(f'Int{df[c].dtype.itemsize * 8}') for c in df.columns if df[c].dtype.kind == 'i'}
+    return df.assign(**casts) if casts else df
+
+
+def apply_schema(df: pd.DataFrame, table: str) -> pd.DataFrame:
+    """
+    Casts the columns of df to the declared types of table
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+    table: str
+        Table name, e.g. df_race_results_final
+
+    Returns
+    -------
+    df with its declared columns cast, other columns unchanged
+    """
+    casts = {}
+    for c in df.columns:
+        dtype = column_type(table, c)
+        if dtype is not None:
+            cast = _cast(df[c], dtype)
+            if cast is not df[c]:
+                casts[c] = cast
+    return df.assign(**casts) if casts else df
+
+
+def memory_usage(df: pd.DataFrame) -> float:
+    """Memory of df in MB, including the strings of object columns"""
+    return df.memory_usage(deep=True).sum() / 2 ** 20
@@ -0,0 +1,317 @@
+"""Snapshot Store
+Columnar (Parquet) storage for the tables produced by get_all_data.
+
+Layout under DATA_PATH/snapshots:
+    catalog.json                                           latest snapshot id and list of all snapshots
+    <snapshot_id>/manifest.json                            files, row counts and statistics per table
+    <snapshot_id>/<table>/season_id=<id>/part-<n>.parquet  race-keyed tables, one directory per season
+    <snapshot_id>/<table>/part-<n>.parquet                 unpartitioned tables (pigeons, members)
+
+Race-keyed tables without a season column are partitioned by the season of their race, looked up from df_races.
+The manifest keeps min/max statistics per file, so filters prune whole files before any of them is opened,
+and the remaining filters are pushed down to the Parquet row groups.
+Tables are cast to their declared column types (see schema) when they are written and when they are loaded.
+"""
+from collections import defaultdict
+from datetime import datetime
+import json
+import operator
+import os
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import DATA_PATH
+from src.data_preprocess.schema import apply_schema
+
+SNAPSHOT_PATH = os.path.join(DATA_PATH, 'snapshots')
+CATALOG_FILE = 'catalog.json'
+MANIFEST_FILE = 'manifest.json'
+
+SEASON_COLUMN = 'season_id'
+PARTITION_COLUMNS = {
+    'df_races': 'season_id',
+    'df_race_results': SEASON_COLUMN,
+    'df_race_participants': SEASON_COLUMN,
+    'df_race_results_final': 'season_id_race',
+}
+STATS_COLUMNS = ('race_id', 'release_datetime', 'release_epoch')
+CHUNK_ROWS = 200_000
+
+_OPERATORS = {
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def _to_arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Serialises nested (e.g. members_tosses, clubs_to_book) and mixed-type object columns as strings"""
+    df = df.copy(deep=False)
+    for col in df.columns[df.dtypes == object]:
+        if df[col].map(lambda x: isinstance(x, (dict, list))).any():
+            df[col] = df[col].map(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else x)
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[col] = df[col].map(lambda x: x if isinstance(x, str) or pd.isna(x) else str(x))
+    return df
+
+
+def _partition_stats(df: pd.DataFrame) -> dict:
+    stats = {}
+    for col in STATS_COLUMNS:
+        if col not in df.columns or df[col].isna().all():
+            continue
+        lo, hi = df[col].min(), df[col].max()
+        if isinstance(lo, pd.Timestamp):
+            lo, hi = lo.isoformat(), hi.isoformat()
+        stats[col] = [lo.item() if hasattr(lo, 'item') else lo, hi.item() if hasattr(hi, 'item') else hi]
+    return stats
+
+
+def _may_match(stats: dict, filters: list[tuple]) -> bool:
+    """False only if the partition statistics prove that no row in the partition can satisfy the filters"""
+    for col, op, value in filters:
+        if col not in stats or op not in _OPERATORS:
+            continue
+        lo, hi = stats[col]
+        if isinstance(value, (pd.Timestamp, datetime)):
+            lo, hi, value = pd.Timestamp(lo), pd.Timestamp(hi), pd.Timestamp(value)
+        if op in ('==', '=') and not lo <= value <= hi:
+            return False
+        if op in ('<', '<=') and not _OPERATORS[op](lo, value):
+            return False
+        if op in ('>', '>=') and not _OPERATORS[op](hi, value):
+            return False
+    return True
+
+
+class TableWriter:
+    """
+    Appends DataFrame chunks to one table of a snapshot. Rows are buffered per partition and flushed to a new
+    Parquet file every chunk_rows rows, so memory is bounded by the buffers rather than by the table.
+    """
+
+    def __init__(
+            self,
+            snapshot_dir: str,
+            name: str,
+            partition_column: str = None,
+            derived_partition: bool = False,
+            chunk_rows: int = CHUNK_ROWS,
+    ):
+        self.snapshot_dir = snapshot_dir
+        self.name = name
+        self.partition_column = partition_column
+        self.derived_partition = derived_partition
+        self.chunk_rows = chunk_rows
+        self.columns = {}
+        self.num_rows = 0
+        self.partitions = []
+        self._buffers = defaultdict(list)
+        self._buffered_rows = defaultdict(int)
+        self._file_count = defaultdict(int)
+
+    def write(self, df: pd.DataFrame, partition: int = None) -> None:
+        if df.empty:
+            return
+        self._buffers[partition].append(df)
+        self._buffered_rows[partition] += len(df)
+        if self._buffered_rows[partition] >= self.chunk_rows:
+            self._flush(partition)
+
+    def _flush(self, partition: int = None) -> None:
+        df = pd.concat(self._buffers.pop(partition), ignore_index=True)
+        df = _to_arrow_safe(apply_schema(df, self.name))
+        self._buffered_rows.pop(partition, None)
+
+        part_dir = self.name if partition is None else os.path.join(self.name, f'{self.partition_column}={partition}')
+        os.makedirs(os.path.join(self.snapshot_dir, part_dir), exist_ok=True)
+        file = os.path.join(part_dir, f'part-{self._file_count[partition]}.parquet')
+        self._file_count[partition] += 1
+
+        df.to_parquet(os.path.join(self.snapshot_dir, file), index=False)
+        self.columns.update(dict.fromkeys(df.columns))
+        self.num_rows += len(df)
+        self.partitions.append({
+            'file': file, 'value': partition, 'num_rows': len(df), 'stats': _partition_stats(df),
+        })
+
+    def close(self, empty_like: pd.DataFrame = None) -> dict:
+        """Flushes all buffers and returns the manifest entry of the table"""
+        for partition in list(self._buffers):
+            self._flush(partition)
+        if not self.partitions and empty_like is not None:
+            self._buffers[None].append(empty_like)
+            self._flush()
+
+        return {
+            'partition_column': self.partition_column,
+            'derived_partition': self.derived_partition,
+            'columns': list(self.columns),
+            'num_rows': self.num_rows,
+            'partitions': sorted(self.partitions, key=lambda p: (p['value'] is not None, p['value'] or 0, p['file'])),
+        }
+
+
+class SnapshotStore:
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self.catalog_path = os.path.join(path, CATALOG_FILE)
+
+    def catalog(self) -> dict:
+        if not os.path.exists(self.catalog_path):
+            return {'latest': None, 'snapshots': []}
+        with open(self.catalog_path, 'r') as f:
+            return json.load(f)
+
+    @property
+    def latest(self) -> Optional[str]:
+        return self.catalog()['latest']
+
+    def manifest(self, snapshot: str = None) -> dict:
+        snapshot = snapshot or self.latest
+        if snapshot is None:
+            raise FileNotFoundError(f'No snapshots in {self.path}')
+        with open(os.path.join(self.path, snapshot, MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+
+    def new_snapshot(self) -> str:
+        snapshot = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+        os.makedirs(os.path.join(self.path, snapshot), exist_ok=True)
+        return snapshot
+
+    def table_writer(self, snapshot: str, name: str, **kwargs) -> TableWriter:
+        return TableWriter(os.path.join(self.path, snapshot), name, **kwargs)
+
+    def commit(self, snapshot: str, tables: dict[str, dict], latest: bool = True) -> None:
+        """
+        Writes the manifest of a snapshot from the manifest entries of its tables. The snapshot only becomes
+        visible through the catalog once latest is set, so a partially written snapshot is never picked up.
+        """
+        manifest_path = os.path.join(self.path, snapshot, MANIFEST_FILE)
+        with open(f'{manifest_path}.tmp', 'w') as f:
+            json.dump({'snapshot': snapshot, 'tables': tables}, f, indent=1, default=str)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+        if not latest:
+            return
+
+        catalog = self.catalog()
+        catalog['snapshots'].append({'id': snapshot, 'created': datetime.now().isoformat(timespec='seconds')})
+        catalog['latest'] = snapshot
+        with open(f'{self.catalog_path}.tmp', 'w') as f:
+            json.dump(catalog, f, indent=1)
+        os.replace(f'{self.catalog_path}.tmp', self.catalog_path)
+        print(f'Saved snapshot {snapshot}')
+
+    def write_table(self, snapshot: str, name: str, df: pd.DataFrame, season_map: pd.Series = None) -> dict:
+        """
+        Writes an in-memory table to a snapshot, partitioned by season if it is race-keyed.
+        Returns the manifest entry of the table.
+        """
+        partition_col = PARTITION_COLUMNS.get(name)
+        derived = False
+        if partition_col and partition_col not in df.columns and season_map is not None and 'race_id' in df:
+            partition_values = df['race_id'].map(season_map)
+            derived = True
+        elif partition_col and partition_col in df.columns:
+            partition_values = df[partition_col]
+        else:
+            partition_col, partition_values = None, None
+
+        writer = self.table_writer(
+            snapshot, name, partition_column=partition_col, derived_partition=derived, chunk_rows=len(df) + 1
+        )
+        if partition_col is None:
+            writer.write(df)
+        else:
+            for value, df_part in df.groupby(partition_values.fillna(-1).astype('int64'), sort=True):
+                writer.write(df_part, partition=int(value))
+        return writer.close(empty_like=df)
+
+    def write_snapshot(self, tables: dict[str, pd.DataFrame]) -> str:
+        """
+        Parameters
+        ----------
+        tables: dict[str, pd.DataFrame]
+            Table name to data. Race-keyed tables are partitioned by season, using df_races to map race to season.
+
+        Returns
+        -------
+        Id of the written snapshot, which also becomes the latest snapshot in the catalog.
+        """
+        snapshot = self.new_snapshot()
+
+        season_map = None
+        if 'df_races' in tables and SEASON_COLUMN in tables['df_races'].columns:
+            season_map = tables['df_races'].drop_duplicates('race_id').set_index('race_id')[SEASON_COLUMN]
+
+        manifest = {name: self.write_table(snapshot, name, df, season_map) for name, df in tables.items()}
+        self.commit(snapshot, manifest)
+        return snapshot
+
+    def load(
+            self,
+            table: str,
+            columns: list[str] = None,
+            filters: list[tuple] = None,
+            snapshot: str = None,
+            partitions: list[int] = None,
+    ) -> pd.DataFrame:
+        """
+        Parameters
+        ----------
+        table: str
+            Table name, e.g. df_race_results_final
+        columns: list[str]
+            Columns to read. Columns not present in the table are ignored. Defaults to all columns.
+        filters: list[tuple]
+            Conjunction of (column, op, value) predicates, with op one of ==, !=, <, <=, >, >=, in, not in.
+            Used to skip whole files via the manifest statistics and then pushed down to the Parquet reader.
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot in the catalog.
+        partitions: list[int]
+            Only read these partition (season) values
+        """
+        snapshot = snapshot or self.latest
+        table_manifest = self.manifest(snapshot)['tables'][table]
+        filters = filters or None
+
+        if columns is not None:
+            columns = [c for c in dict.fromkeys(columns) if c in table_manifest['columns']]
+
+        files = [
+            os.path.join(self.path, snapshot, partition['file']) for partition in table_manifest['partitions']
+            if (filters is None or _may_match(partition['stats'], filters))
+            and (partitions is None or partition['value'] in partitions)
+        ]
+        print(f'Loading {table} from snapshot {snapshot} ({len(files)}/{len(table_manifest["partitions"])} files)')
+
+        if not files:
+            schema = pq.read_schema(os.path.join(self.path, snapshot, table_manifest['partitions'][0]['file']))
+            df = schema.empty_table().to_pandas()[columns or table_manifest['columns']]
+            return apply_schema(df, table)
+
+        tables = []
+        for file in files:
+            file_columns = columns
+            if columns is not None:
+                file_columns = [c for c in columns if c in pq.read_schema(file).names]
+            tables.append(pq.read_table(file, columns=file_columns, filters=filters))
+        # snapshots written before the schema are cast on load
+        table_data = pa.concat_tables(tables, promote_options='permissive')
+        del tables
+        # arrow buffers are released column by column as they are converted, instead of after the whole table
+        return apply_schema(table_data.to_pandas(split_blocks=True, self_destruct=True), table)
+
+    def load_all(self, tables: tuple[str, ...], snapshot: str = None) -> tuple[pd.DataFrame, ...]:
+        return tuple(self.load(table, snapshot=snapshot) for table in tables)
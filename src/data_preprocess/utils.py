@@ -1,14 +1,52 @@
-from functools import cache
 import re
 from typing import Optional
 
 import numpy as np
+from numpy.typing import ArrayLike
+
+COMPASS_POINTS = np.array(
+    ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"],
+    dtype=object,
+)
+# lower bound (kmph) of Beaufort forces 1 to 12, force 0 being anything below 1 kmph
+BEAUFORT_EDGES = np.array([1, 6, 12, 20, 29, 38, 50, 62, 75, 89, 103, 118], dtype=float)
 
 
 def camel_to_snake(name: str) -> str:
     return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
 
 
+def deg_to_compass_array(degrees: ArrayLike) -> np.ndarray:
+    """
+    Converts an array of wind directions in degrees to the corresponding compass directions.
+
+    Args:
+      degrees (ArrayLike): Wind directions in degrees (0 to 360). Missing values may be None or NaN.
+
+    Returns:
+      np.ndarray: Object array of compass directions (e.g., "N", "NE", "SW"), None where the input is missing.
+    """
+    degrees = np.asarray(degrees, dtype=float)
+    is_missing = np.isnan(degrees)
+    idx = np.trunc(np.where(is_missing, 0, degrees) / 22.5 + .5).astype(np.int64) % 16
+    return np.where(is_missing, None, COMPASS_POINTS[idx])
+
+
+def wind_speed_to_beaufort_array(wind_speed: ArrayLike) -> np.ndarray:
+    """
+    Converts an array of wind speeds in kilometers per hour (kmph) to Beaufort scale forces.
+
+    Args:
+      wind_speed (ArrayLike): Wind speeds in kilometers per hour (kmph). Missing values may be None or NaN.
+
+    Returns:
+      np.ndarray: Float array of Beaufort forces, NaN where the wind speed is missing or negative.
+    """
+    wind_speed = np.asarray(wind_speed, dtype=float)
+    force = np.searchsorted(BEAUFORT_EDGES, wind_speed, side='right').astype(float)
+    return np.where(np.isnan(wind_speed) | (wind_speed < 0), np.nan, force)
+
+
 def deg_to_compass(degrees: float) -> Optional[str]:
     """
     Converts a wind direction in degrees to the corresponding compass direction.
@@ -19,16 +57,9 @@ def deg_to_compass(degrees: float) -> Optional[str]:
     Returns:
       str: The compass direction (e.g., "N", "NE", "SW").
     """
-
-    if degrees is None or np.isnan(degrees):
-        return None
-
-    val = int((degrees / 22.5) + .5)
-    arr = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-    return arr[(val % 16)]
+    return deg_to_compass_array([degrees])[0]
 
 
-@cache
 def wind_speed_to_beaufort(wind_speed) -> Optional[int]:
     """
     This function converts wind speed in kilometers per hour (kmph) to the Beaufort scale force.
@@ -39,23 +70,5 @@ def wind_speed_to_beaufort(wind_speed) -> Optional[int]:
     Returns:
     The Beaufort scale force (integer) or None if wind speed is negative.
     """
-    if wind_speed is None or np.isnan(wind_speed) or wind_speed < 0:
-        return None
-
-    beaufort_scale = {
-        0: (0, 1),
-        1: (1, 6),
-        2: (6, 12),
-        3: (12, 20),
-        4: (20, 29),
-        5: (29, 38),
-        6: (38, 50),
-        7: (50, 62),
-        8: (62, 75),
-        9: (75, 89),
-        10: (89, 103),
-        11: (103, 118),
-        12: (118, float('inf')),
-    }
-
-    return next(force for force, (lb, ub) in beaufort_scale.items() if lb <= wind_speed < ub)
+    force = wind_speed_to_beaufort_array([wind_speed])[0]
+    return None if np.isnan(force) else int(force)
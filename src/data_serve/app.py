@@ -0,0 +1,133 @@
+"""Prediction service
+
+Usage (with src on PYTHONPATH):
+    uvicorn data_serve.app:app --host 0.0.0.0 --port 8000
+
+Models, feature lookups and pigeon form are loaded once at startup (see data_serve.predictor), so a request only
+resolves its features from memory. Startup fails if the pigeon form store is empty, build it first with
+python -m data_train.form_store. Concurrent requests to a model are coalesced by a MicroBatcher into one
+booster call, configured with the environment variables BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS and BATCH_THREADS.
+Leaderboards of the fastest pigeons are answered from a precomputed index (see data_serve.leaderboard), brought up
+to date with the latest snapshot at startup.
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime
+import os
+from typing import Optional, Union
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel, Field
+
+from data_serve.batcher import MAX_BATCH_SIZE, MAX_WAIT_MS, THREADS, MicroBatcher
+from data_serve.leaderboard import LeaderboardIndex
+from data_serve.predictor import load_predictors
+
+
+class PigeonEntry(BaseModel):
+    pigeon_id: int
+    release_datetime: datetime
+    race_id: Optional[int] = None
+    club_number: Optional[int] = None
+    features: dict[str, Union[float, str, None]] = Field(
+        default_factory=dict, description='Feature values overriding the looked up ones, e.g. forecast weather'
+    )
+
+
+class BatchRequest(BaseModel):
+    entries: list[PigeonEntry]
+
+
+class Prediction(BaseModel):
+    pigeon_id: int
+    prediction: float
+
+
+class BatchPrediction(BaseModel):
+    predictions: list[Prediction]
+
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    pigeon_id: int
+    velocity: float
+    race_id: int
+
+
+class Leaderboard(BaseModel):
+    entries: list[LeaderboardEntry]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.predictors = load_predictors()
+    app.state.batchers = {
+        name: MicroBatcher(
+            predictor,
+            max_batch_size=int(os.environ.get('BATCH_MAX_SIZE', MAX_BATCH_SIZE)),
+            max_wait_ms=float(os.environ.get('BATCH_MAX_WAIT_MS', MAX_WAIT_MS)),
+            threads=int(os.environ.get('BATCH_THREADS', THREADS)),
+        )
+        for name, predictor in app.state.predictors.items()
+    }
+    app.state.leaderboard = LeaderboardIndex()
+    app.state.leaderboard.refresh()
+    for batcher in app.state.batchers.values():
+        await batcher.start()
+    yield
+    for batcher in app.state.batchers.values():
+        await batcher.stop()
+
+
+app = FastAPI(title='Pigeon Racing', lifespan=lifespan)
+
+
+async def _score(request: Request, model: str, entries: list[PigeonEntry]) -> list[Prediction]:
+    batcher = request.app.state.batchers.get(model)
+    if batcher is None:
+        raise HTTPException(status_code=404, detail=f'Unknown model {model}')
+    predictions = await batcher.predict([entry.model_dump() for entry in entries])
+    return [Prediction(pigeon_id=entry.pigeon_id, prediction=p) for entry, p in zip(entries, predictions)]
+
+
+@app.get('/health')
+async def health(request: Request) -> dict:
+    return {'models': list(request.app.state.predictors)}
+
+
+@app.get('/metrics')
+async def metrics(request: Request) -> dict:
+    """Queue depth, batch sizes and queueing time of every model's micro-batcher"""
+    return {name: batcher.metrics() for name, batcher in request.app.state.batchers.items()}
+
+
+@app.post('/predict/{model}')
+async def predict(request: Request, model: str, entry: PigeonEntry) -> Prediction:
+    """Arrival probability (model=arrival) or velocity forecast (model=velocity) of one pigeon"""
+    return (await _score(request, model, [entry]))[0]
+
+
+@app.post('/predict/{model}/batch')
+async def predict_batch(request: Request, model: str, batch: BatchRequest) -> BatchPrediction:
+    """Predictions for many pigeons, e.g. every pigeon registered in a race, in one booster call"""
+    return BatchPrediction(predictions=await _score(request, model, batch.entries))
+
+
+@app.get('/leaderboard/{dimension}')
+async def leaderboard(
+        request: Request,
+        dimension: str,
+        key: Optional[int] = Query(None, description='Club number, owner (member id) or section number'),
+        season: Optional[int] = None,
+        last_races: Optional[int] = Query(None, ge=1, description='Only the latest races, of season if given'),
+        limit: int = Query(10, ge=1),
+) -> Leaderboard:
+    """Fastest pigeons overall (dimension=overall) or of a club, owner or section, by their best velocity"""
+    try:
+        entries = request.app.state.leaderboard.top(
+            dimension, key=key, season=season, last_races=last_races, limit=limit
+        )
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Leaderboard(entries=[LeaderboardEntry(**entry) for entry in entries])
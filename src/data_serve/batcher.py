@@ -0,0 +1,164 @@
+"""Micro-batcher
+Coalesces concurrent scoring requests into one booster call.
+
+LightGBM's per-call overhead is about the same for one row as for hundreds, so requests are queued and flushed
+together once max_batch_size rows are waiting or the oldest request has waited max_wait_ms. A batch never holds
+more than max_batch_size rows: requests larger than that are split into chunks scored in consecutive batches, and a
+request which would overflow a batch waits for the next one. Each flush builds a single contiguous float32 matrix,
+scores it on a worker thread (the booster releases the GIL) and hands every caller its own slice of the
+predictions.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import numpy as np
+
+from data_serve.predictor import Predictor
+
+MAX_BATCH_SIZE = 256
+MAX_WAIT_MS = 2.0
+THREADS = 1
+METRICS_WINDOW = 1_000
+
+
+class MicroBatcher:
+
+    def __init__(
+            self,
+            predictor: Predictor,
+            max_batch_size: int = MAX_BATCH_SIZE,
+            max_wait_ms: float = MAX_WAIT_MS,
+            threads: int = THREADS,
+    ):
+        """
+        Parameters
+        ----------
+        predictor: Predictor
+        max_batch_size: int
+            Flush as soon as this many rows are queued, and never score more at once. Larger requests are split.
+        max_wait_ms: float
+            Flush once the oldest queued request has waited this long
+        threads: int
+            Worker threads scoring batches, i.e. maximum number of batches in flight
+        """
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1_000
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='batcher')
+        self._slots = asyncio.Semaphore(threads)
+        self._queue = asyncio.Queue()
+        self._queued_rows = 0
+        # request which would have overflowed the previous batch, first of the next one
+        self._held = None
+        self._task = None
+        self._in_flight = set()
+
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self._batch_sizes = deque(maxlen=METRICS_WINDOW)
+        self._waits = deque(maxlen=METRICS_WINDOW)
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def predict(self, entries: list[dict]) -> np.ndarray:
+        """Queues entries, in chunks of at most max_batch_size, and waits for their predictions"""
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        futures = []
+        for start in range(0, max(len(entries), 1), self.max_batch_size):
+            future = loop.create_future()
+            self._queue.put_nowait((entries[start:start + self.max_batch_size], future, queued_at))
+            futures.append(future)
+        self._queued_rows += len(entries)
+        self.requests += 1
+        if len(futures) == 1:
+            return await futures[0]
+        return np.concatenate(await asyncio.gather(*futures))
+
+    async def _run(self) -> None:
+        while True:
+            if self._held is not None:
+                pending, self._held = [self._held], None
+            else:
+                pending = [await self._queue.get()]
+            rows = len(pending[0][0])
+            deadline = pending[0][2] + self.max_wait
+
+            while rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0 and self._queue.empty():
+                    break
+                try:
+                    if timeout <= 0:
+                        item = self._queue.get_nowait()
+                    else:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if rows + len(item[0]) > self.max_batch_size:
+                    self._held = item
+                    break
+                pending.append(item)
+                rows += len(item[0])
+
+            self._queued_rows -= rows
+            await self._slots.acquire()
+            task = asyncio.create_task(self._score(pending, rows))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _score(self, pending: list[tuple], rows: int) -> None:
+        flushed_at = time.perf_counter()
+        entries = [entry for request_entries, _, _ in pending for entry in request_entries]
+        try:
+            predictions = await asyncio.get_running_loop().run_in_executor(self._executor, self._predict, entries)
+        except Exception as e:
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        self.batches += 1
+        self.rows += rows
+        self._batch_sizes.append(rows)
+        start = 0
+        for request_entries, future, queued_at in pending:
+            self._waits.append(flushed_at - queued_at)
+            if not future.done():
+                future.set_result(predictions[start:start + len(request_entries)])
+            start += len(request_entries)
+
+    def _predict(self, entries: list[dict]) -> np.ndarray:
+        features = self.predictor.resolver.resolve(entries)
+        x = self.predictor.matrix(features, len(entries), dtype=np.float32)
+        return self.predictor.booster.predict(x)
+
+    def metrics(self) -> dict:
+        waits_ms = np.array(self._waits) * 1_000
+        return {
+            'queue_depth': self._queued_rows,
+            'requests': self.requests,
+            'rows': self.rows,
+            'batches': self.batches,
+            'batch_size_mean': float(np.mean(self._batch_sizes)) if self._batch_sizes else None,
+            'batch_size_max': max(self._batch_sizes, default=None),
+            'wait_ms_mean': float(waits_ms.mean()) if len(waits_ms) else None,
+            'wait_ms_p99': float(np.percentile(waits_ms, 99)) if len(waits_ms) else None,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1_000,
+            'threads': self.threads,
+        }
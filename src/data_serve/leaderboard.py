@@ -0,0 +1,322 @@
+"""Leaderboard Index
+Precomputed rankings of the fastest pigeons overall, by club, by owner and by section.
+
+A board holds the top_k pigeons of one dimension value (e.g. club 5) over one period, fastest first, with the best
+velocity of each pigeon and the race it was flown in. Boards are kept for all time, for every season and for every
+race. A query for a season or all time reads one board, and a query for the last N races merges the N race boards,
+so every query is answered from memory in well under a millisecond.
+
+The season and all time boards only keep the best velocity of every pigeon, so new race results are merged into
+them without rescanning the history: a pigeon outside the top_k can only enter it with a faster result. The boards
+of a race are replaced whenever the race is indexed again, e.g. while its results are still open. Corrections that
+lower a velocity need a rebuild (--rebuild).
+
+The index is saved under DATA_PATH/leaderboard as an uncompressed npz of fixed-width arrays, which is read back
+without parsing, and a meta.json.
+
+Usage (with src on PYTHONPATH):
+    python -m data_serve.leaderboard [--rebuild]
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_train.utils import load_data
+from src import DATA_PATH
+from src.data_preprocess.manifest import OPEN_RACE_DAYS
+from src.data_preprocess.snapshot_store import SnapshotStore
+
+LEADERBOARD_PATH = os.path.join(DATA_PATH, 'leaderboard')
+TOP_K = 100
+
+# dimension to its column in the frame given to LeaderboardIndex.update, None for the overall ranking
+DIMENSIONS = {
+    'overall': None,
+    'club': 'club_number',
+    'owner': 'member_id',
+    'section': 'section_number',
+}
+OVERALL_KEY = 0
+ALL_TIME, SEASON, RACE = 0, 1, 2
+
+ENTRY = np.dtype([('velocity', 'f4'), ('pigeon_id', 'i8'), ('race_id', 'i4')])
+
+
+def _top(entries: np.ndarray, k: int) -> np.ndarray:
+    """The k fastest entries, keeping the fastest of every pigeon"""
+    entries = entries[np.argsort(-entries['velocity'], kind='stable')]
+    _, first = np.unique(entries['pigeon_id'], return_index=True)
+    return entries[np.sort(first)[:k]]
+
+
+def results_frame(snapshot: str = None, race_ids: list[int] = None) -> pd.DataFrame:
+    """
+    Race results of a snapshot in the form LeaderboardIndex.update expects, with the section of every owner
+    looked up from df_members
+
+    Parameters
+    ----------
+    snapshot: str
+        Snapshot id, defaults to the latest snapshot
+    race_ids: list[int]
+        Only these races. Defaults to all races.
+    """
+    columns = [
+        'race_id', 'pigeon_id', 'velocity', 'release_datetime', 'season_id', 'season_id_race',
+        'club_number_race_results', 'member_id', 'member_id_race_results',
+    ]
+    filters = [('race_id', 'in', list(race_ids))] if race_ids is not None else None
+    df = load_data('df_race_results_final', columns=columns, filters=filters, snapshot=snapshot)
+    # the season of the race, and the owner of the participant, are suffixed when the pigeons have them too
+    if 'season_id_race' in df:
+        df['season_id'] = df.pop('season_id_race')
+    if 'member_id_race_results' in df:
+        df['member_id'] = df.pop('member_id_race_results')
+    df = df.rename(columns={'club_number_race_results': 'club_number'})
+
+    df_members = load_data('df_members', columns=['id', 'section_number'], snapshot=snapshot)
+    if 'section_number' not in df_members:
+        raise ValueError('df_members has no section_number, the section leaderboard cannot be built')
+    if 'member_id' in df:
+        df['section_number'] = df['member_id'].map(df_members.drop_duplicates('id').set_index('id')['section_number'])
+    return df
+
+
+class LeaderboardIndex:
+
+    def __init__(self, path: str = LEADERBOARD_PATH, top_k: int = TOP_K, load: bool = True):
+        """
+        Parameters
+        ----------
+        path: str
+            Directory the index is saved to
+        top_k: int
+            Pigeons kept per board, the largest limit a query can ask for
+        load: bool
+            Load the saved index if there is one, otherwise start empty and index every race on refresh
+        """
+        self.path = path
+        self.top_k = top_k
+        self.snapshot = None
+        # (dimension index, key, period kind, period value) to entries, fastest first
+        self.boards = {}
+        # indexed races ordered by release, with their season
+        self.race_ids = np.array([], dtype='int64')
+        self.race_release = np.array([], dtype='datetime64[ns]')
+        self.race_season = np.array([], dtype='int64')
+
+        meta_path = os.path.join(path, 'meta.json')
+        if not load or not os.path.exists(meta_path):
+            return
+
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['top_k'] != top_k:
+            raise ValueError(f'Leaderboard at {path} was built with top_k {meta["top_k"]}, rebuild it')
+
+        self.snapshot = meta['snapshot']
+        with np.load(os.path.join(path, 'index.npz')) as data:
+            entries, keys, offsets = data['entries'], data['keys'], data['offsets']
+            self.race_ids, self.race_release = data['race_ids'], data['race_release']
+            self.race_season = data['race_season']
+        self.boards = {
+            tuple(key): entries[start:end] for key, start, end in zip(keys.tolist(), offsets[:-1], offsets[1:])
+        }
+
+    def __len__(self):
+        return len(self.boards)
+
+    def save(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        keys = list(self.boards)
+        offsets = np.cumsum([0] + [len(self.boards[key]) for key in keys])
+        entries = np.concatenate([self.boards[key] for key in keys]) if keys else np.array([], dtype=ENTRY)
+
+        with open(os.path.join(self.path, 'index.npz.tmp'), 'wb') as f:
+            np.savez(
+                f,
+                entries=entries,
+                keys=np.array(keys, dtype='int64').reshape(-1, 4),
+                offsets=offsets,
+                race_ids=self.race_ids,
+                race_release=self.race_release,
+                race_season=self.race_season,
+            )
+        os.replace(os.path.join(self.path, 'index.npz.tmp'), os.path.join(self.path, 'index.npz'))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({
+                'top_k': self.top_k, 'snapshot': self.snapshot, 'n_boards': len(keys), 'n_races': len(self.race_ids),
+            }, f)
+
+    def update(self, df: pd.DataFrame) -> int:
+        """
+        Indexes race results, replacing the boards of the races in df and merging them into the season and all
+        time boards
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            Race results with race_id, pigeon_id, velocity, release_datetime and season_id, and the columns of
+            DIMENSIONS. Results without an arrival are ignored.
+
+        Returns
+        -------
+        Number of boards updated
+        """
+        missing = [column for column in DIMENSIONS.values() if column is not None and column not in df]
+        if missing:
+            raise ValueError(f'Race results have no {", ".join(missing)}, their leaderboards cannot be indexed')
+
+        races = df.groupby('race_id').agg(
+            release_datetime=('release_datetime', 'first'), season_id=('season_id', 'first')
+        )
+        races = pd.concat([
+            pd.DataFrame(
+                {'release_datetime': self.race_release, 'season_id': self.race_season},
+                index=pd.Index(self.race_ids, name='race_id'),
+            ).drop(races.index, errors='ignore'),
+            races,
+        ]).sort_values(['release_datetime', 'season_id'], kind='stable')
+        self.race_ids = races.index.to_numpy('int64')
+        self.race_release = races['release_datetime'].to_numpy('datetime64[ns]')
+        self.race_season = races['season_id'].to_numpy('int64')
+
+        # races indexed again get new boards, including the boards their results no longer reach
+        indexed_races = set(df['race_id'].unique().tolist())
+        self.boards = {
+            key: entries for key, entries in self.boards.items() if key[2] != RACE or key[3] not in indexed_races
+        }
+
+        df = df[df['velocity'] > 0].sort_values('velocity', ascending=False, kind='stable')
+        entries = np.empty(len(df), dtype=ENTRY)
+        entries['velocity'] = df['velocity'].to_numpy('float32')
+        entries['pigeon_id'] = df['pigeon_id'].to_numpy('int64')
+        entries['race_id'] = df['race_id'].to_numpy('int32')
+
+        n_updated = 0
+        for dimension, (name, column) in enumerate(DIMENSIONS.items()):
+            keys = pd.Series(OVERALL_KEY, index=df.index) if column is None else df[column]
+            periods = ((ALL_TIME, pd.Series(0, index=df.index)), (SEASON, df['season_id']), (RACE, df['race_id']))
+            for kind, values in periods:
+                boards = pd.DataFrame({'key': keys, 'value': values, 'pigeon_id': df['pigeon_id']})
+                boards['row'] = np.arange(len(df))
+                # fastest result of every pigeon, then the top_k pigeons, of every board
+                boards = boards.dropna(subset=['key', 'value']).drop_duplicates(['key', 'value', 'pigeon_id'])
+                boards = boards[boards.groupby(['key', 'value'], sort=False).cumcount() < self.top_k]
+                boards = boards.sort_values(['key', 'value'], kind='stable')
+
+                board_keys = boards[['key', 'value']].to_numpy('int64')
+                board_entries = entries[boards['row'].to_numpy()]
+                starts = np.flatnonzero(np.r_[True, (board_keys[1:] != board_keys[:-1]).any(axis=1)])
+                ends = np.r_[starts[1:], len(board_keys)]
+                for (key, value), start, end in zip(board_keys[starts].tolist(), starts, ends):
+                    board = (dimension, key, kind, value)
+                    previous = self.boards.get(board)
+                    new = board_entries[start:end]
+                    if previous is not None:
+                        new = _top(np.concatenate([previous, new]), self.top_k)
+                    self.boards[board] = new
+                n_updated += len(starts)
+        return n_updated
+
+    def refresh(self, snapshot: str = None, save: bool = True) -> int:
+        """
+        Indexes the races of a snapshot which are not indexed yet, and those released within OPEN_RACE_DAYS of the
+        latest indexed race, whose results may have changed since
+
+        Returns
+        -------
+        Number of races indexed
+        """
+        snapshot = snapshot or SnapshotStore().latest
+        if snapshot is None or snapshot == self.snapshot:
+            return 0
+
+        start = time.perf_counter()
+        race_ids = None
+        if len(self.race_ids):
+            df_races = load_data('df_races', columns=['race_id', 'release_datetime'], snapshot=snapshot)
+            open_since = self.race_release.max() - np.timedelta64(OPEN_RACE_DAYS, 'D')
+            new = ~df_races['race_id'].isin(self.race_ids) | (df_races['release_datetime'] >= open_since)
+            race_ids = df_races.loc[new, 'race_id'].unique().tolist()
+
+        n_races = 0
+        if race_ids is None or race_ids:
+            df = results_frame(snapshot, race_ids)
+            n_boards = self.update(df)
+            n_races = df['race_id'].nunique()
+            print(f'Indexed {n_races} races of snapshot {snapshot} into {n_boards} leaderboards')
+        self.snapshot = snapshot
+        if save:
+            self.save()
+        print(f'Leaderboard up to date with snapshot {snapshot} in {time.perf_counter() - start:.1f}s')
+        return n_races
+
+    def top(
+            self,
+            dimension: str,
+            key: int = None,
+            season: int = None,
+            last_races: int = None,
+            limit: int = 10,
+    ) -> list[dict]:
+        """
+        Fastest pigeons of a dimension value, by their best velocity in the period
+
+        Parameters
+        ----------
+        dimension: str
+            One of DIMENSIONS
+        key: int
+            Club number, owner (member id) or section number. Not used for overall.
+        season: int
+            Only races of this season
+        last_races: int
+            Only the latest last_races races, of season if given
+        limit: int
+            Number of pigeons, at most top_k
+
+        Returns
+        -------
+        Rank, pigeon_id, velocity and race_id of the fastest pigeons, fastest first
+        """
+        if dimension not in DIMENSIONS:
+            raise KeyError(f'Unknown leaderboard dimension {dimension}, use one of {list(DIMENSIONS)}')
+        if limit > self.top_k:
+            raise ValueError(f'limit {limit} is larger than the {self.top_k} pigeons kept per leaderboard')
+        if DIMENSIONS[dimension] is None:
+            key = OVERALL_KEY
+        elif key is None:
+            raise ValueError(f'The {dimension} leaderboard needs a key')
+        board = (list(DIMENSIONS).index(dimension), int(key))
+
+        if last_races:
+            race_ids = self.race_ids if season is None else self.race_ids[self.race_season == season]
+            race_boards = [self.boards.get((*board, RACE, race_id)) for race_id in race_ids[-last_races:].tolist()]
+            race_boards = [entries for entries in race_boards if entries is not None]
+            entries = _top(np.concatenate(race_boards), limit) if race_boards else np.array([], dtype=ENTRY)
+        elif season is not None:
+            entries = self.boards.get((*board, SEASON, int(season)), np.array([], dtype=ENTRY))
+        else:
+            entries = self.boards.get((*board, ALL_TIME, 0), np.array([], dtype=ENTRY))
+
+        return [
+            {'rank': rank, 'pigeon_id': pigeon_id, 'velocity': velocity, 'race_id': race_id}
+            for rank, (velocity, pigeon_id, race_id) in enumerate(entries[:limit].tolist(), start=1)
+        ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Build or refresh the leaderboard index')
+    parser.add_argument('--snapshot', default=None, help='Snapshot id, defaults to the latest snapshot')
+    parser.add_argument('--rebuild', action='store_true', help='Index every race again from scratch')
+    args = parser.parse_args()
+    LeaderboardIndex(load=not args.rebuild).refresh(snapshot=args.snapshot)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Predictor
+In-memory feature resolution and scoring for the prediction service.
+
+Everything needed to build a feature row is loaded once: pigeon attributes and race conditions from the latest
+snapshot, and the form state of every pigeon from the form store, as last updated by ingestion or training. Models are
+loaded from their artifacts (see data_train.artifact), which also encode the categorical features. Scoring a
+request is then a handful of dictionary lookups and numpy operations followed by a call to the native booster.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_train.artifact import ModelArtifact
+from data_train.form import FormLookup, halflives_from_features
+from data_train.form_store import PigeonFormStore
+from data_train.utils import load_data
+from src import MODEL_PATH
+
+MODELS = {
+    'arrival': 'arrival',
+    'velocity': 'velocity',
+}
+PIGEON_KEY = 'id'
+RACE_KEYS = ['race_id', 'club_number']
+
+
+def _lookup_table(
+        df: pd.DataFrame,
+        keys: list[str],
+        columns: list[str],
+        categorical: set[str],
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Row position of every key, keeping the last row of duplicated keys, and the columns as numpy arrays:
+    float for numeric features and object for categorical ones, which are encoded later
+    """
+    df = df.drop_duplicates(keys, keep='last')
+    key_values = df[keys[0]] if len(keys) == 1 else pd.MultiIndex.from_frame(df[keys])
+    positions = {key: i for i, key in enumerate(key_values)}
+    arrays = {
+        c: df[c].to_numpy(object) if c in categorical else pd.to_numeric(df[c], errors='coerce').to_numpy(float)
+        for c in columns
+    }
+    return positions, arrays
+
+
+class FeatureResolver:
+
+    def __init__(
+            self,
+            features: list[str],
+            categorical: set[str],
+            snapshot: str = None,
+            form_store: PigeonFormStore = None,
+    ):
+        """
+        Parameters
+        ----------
+        features: list[str]
+            Features needed by all served models
+        categorical: set[str]
+            Features whose raw values are kept, to be encoded by each model
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot
+        form_store: PigeonFormStore
+            Pigeon form state, only read: the store is updated by ingestion and training, see data_train.form_store.
+            An empty store raises FileNotFoundError, as every pigeon would get the form of a first race.
+        """
+        self.categorical = set(categorical)
+
+        halflives = halflives_from_features(features)
+        form_store = form_store or PigeonFormStore(halflives=halflives)
+        if not len(form_store.state):
+            raise FileNotFoundError(
+                f'Form store at {form_store.path} is empty, build it with python -m data_train.form_store'
+            )
+        self.form = FormLookup(form_store.state, halflives)
+
+        df_pigeons = load_data('df_pigeons', snapshot=snapshot)
+        df_races = load_data('df_races', snapshot=snapshot)
+        computed = list(self.form.features([], np.array([]))) + ['pigeon_id', 'release_hour', 'release_month']
+        pigeon_columns = [c for c in features if c in df_pigeons.columns and c not in computed]
+        race_columns = [c for c in features if c in df_races.columns and c not in computed + pigeon_columns]
+        self.pigeons, self.pigeon_columns = _lookup_table(df_pigeons, [PIGEON_KEY], pigeon_columns, self.categorical)
+        self.races, self.race_columns = _lookup_table(df_races, RACE_KEYS, race_columns, self.categorical)
+        print(f'Feature resolver ready: {len(self.form)} pigeons with form, {len(self.races)} races')
+
+    def resolve(self, entries: list[dict]) -> dict[str, np.ndarray]:
+        """
+        Parameters
+        ----------
+        entries: list[dict]
+            Each with pigeon_id and release_datetime, optionally race_id and club_number to look up the race
+            conditions, and features overriding any looked up value (e.g. weather forecasts of an upcoming race)
+
+        Returns
+        -------
+        Feature name to values, NaN (None for categorical features) where unknown
+        """
+        n = len(entries)
+        pigeon_ids = [entry['pigeon_id'] for entry in entries]
+        release_times = np.fromiter(
+            (pd.Timestamp(entry['release_datetime']).value / 1e9 for entry in entries), dtype=float, count=n
+        )
+        features = self.form.features(pigeon_ids, release_times)
+        features['pigeon_id'] = np.array(pigeon_ids, dtype=object)
+        features['release_hour'] = release_times // 3600 % 24
+        features['release_month'] = release_times.astype('datetime64[s]').astype('datetime64[M]').astype(float) % 12 + 1
+
+        race_keys = [(entry.get('race_id'), entry.get('club_number')) for entry in entries]
+        for positions, columns, keys in (
+                (self.pigeons, self.pigeon_columns, pigeon_ids),
+                (self.races, self.race_columns, race_keys),
+        ):
+            if not positions:
+                continue
+            pos = np.fromiter((positions.get(key, -1) for key in keys), dtype='int64', count=n)
+            for c, values in columns.items():
+                features[c] = np.where(pos >= 0, values[pos], None if values.dtype == object else np.nan)
+
+        for c in {c for entry in entries for c in entry.get('features') or {}}:
+            override = [(entry.get('features') or {}).get(c) for entry in entries]
+            override = np.array(override, dtype=object if c in self.categorical else float)
+            current = features.get(c, np.full(n, np.nan))
+            features[c] = np.where(pd.isna(override), current, override)
+        return features
+
+
+class Predictor:
+
+    def __init__(self, artifact: ModelArtifact, resolver: FeatureResolver):
+        """
+        Parameters
+        ----------
+        artifact: ModelArtifact
+        resolver: FeatureResolver
+            Shared by all predictors of the service
+        """
+        self.artifact = artifact
+        self.booster = artifact.booster
+        self.feature_names = artifact.feature_names
+        self.resolver = resolver
+
+    def matrix(self, features: dict[str, np.ndarray], n: int, dtype: type = np.float64) -> np.ndarray:
+        """Contiguous row-major matrix of the encoded features in the order of the booster"""
+        return self.artifact.matrix(self.artifact.encode(features), n, dtype=dtype)
+
+    def predict(self, entries: list[dict]) -> np.ndarray:
+        """Arrival probability or velocity of every entry"""
+        features = self.resolver.resolve(entries)
+        return self.booster.predict(self.matrix(features, len(entries)))
+
+
+def load_predictors(model_path: str = MODEL_PATH, snapshot: str = None) -> dict[str, Predictor]:
+    """Loads every model artifact in MODELS found in model_path, sharing one FeatureResolver"""
+    paths = {name: os.path.join(model_path, artifact) for name, artifact in MODELS.items()}
+    artifacts = {name: ModelArtifact(path) for name, path in paths.items() if os.path.isdir(path)}
+    if not artifacts:
+        raise FileNotFoundError(f'No model artifacts in {model_path}, train the models first')
+
+    features = list(dict.fromkeys(c for artifact in artifacts.values() for c in artifact.feature_names))
+    categorical = {c for artifact in artifacts.values() for c in artifact.categorical}
+    resolver = FeatureResolver(features, categorical, snapshot=snapshot)
+    return {name: Predictor(artifact, resolver) for name, artifact in artifacts.items()}
@@ -0,0 +1,368 @@
+"""Race Simulator
+Monte Carlo simulation of the finishing order of a race, from the arrival and velocity models.
+
+In every scenario each registered pigeon arrives with the probability of the arrival model, at the velocity of the
+velocity model plus a residual drawn from the residual quantiles kept in the velocity artifact (inverse transform
+sampling). Scenarios are drawn in batches of (scenarios, pigeons) arrays and ranked by velocity within every club,
+section and the whole federation. Only the positions that score points, and the top ten of the federation, are
+ordered, with a partial sort.
+
+Points of every finishing position are estimated from past races: the median club_points, section_points and
+federation_points of the pigeons finishing in that position of their club, section or the federation.
+
+Large scenario counts can be split across a process pool, every worker drawing from its own random stream, so
+results are reproducible for a given seed and number of workers.
+
+Usage (with src on PYTHONPATH):
+    python -m data_serve.simulator <race_id> [--scenarios 2000] [--workers 4]
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_serve.predictor import Predictor, load_predictors
+from data_train.artifact import RESIDUAL_PROBS
+from data_train.utils import load_data
+from src.data_preprocess.data_load import normalise_records
+from src.data_preprocess.loaders.malta_pigeon_federation import MaltaPigeonFederationAPI
+from src.data_preprocess.loaders.response_cache import ResponseCache
+
+SCENARIOS = 2_000
+BATCH_SCENARIOS = 500
+TOP_N = 10
+
+# level to the column grouping its pigeons, None for the whole federation
+LEVELS = {
+    'club': 'club_number',
+    'section': 'section_number',
+    'federation': None,
+}
+
+
+def points_tables(df: pd.DataFrame) -> dict[str, np.ndarray]:
+    """
+    Median points of every finishing position (0 for the winner) of each level, estimated from past race results
+    with race_id, velocity, <level>_points and the columns of LEVELS. Positions after the last one scoring points
+    are dropped.
+    """
+    required = [f'{level}_points' for level in LEVELS] + [column for column in LEVELS.values() if column is not None]
+    missing = [c for c in required if c not in df]
+    if missing:
+        raise ValueError(f'Race results have no {", ".join(missing)}, the points tables cannot be estimated')
+
+    df = df[df['velocity'] > 0]
+    tables = {}
+    for level, column in LEVELS.items():
+        points = f'{level}_points'
+        df_level = df if column is None else df.dropna(subset=[column])
+        groups = ['race_id'] if column is None else ['race_id', column]
+        position = df_level.groupby(groups)['velocity'].rank(method='first', ascending=False).astype('int64') - 1
+        table = df_level[points].groupby(position).median()
+        scoring = np.flatnonzero(table.to_numpy() > 0)
+        n_positions = scoring[-1] + 1 if len(scoring) else 0
+        tables[level] = table.reindex(range(n_positions), fill_value=0).to_numpy('float64')
+    return tables
+
+
+def finishing_order(velocity: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k fastest pigeons of every scenario (row), fastest first"""
+    k = min(k, velocity.shape[1])
+    if k < velocity.shape[1]:
+        top = np.argpartition(-velocity, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(k), velocity.shape)
+    order = np.argsort(-np.take_along_axis(velocity, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def simulate_batch(
+        arrival: np.ndarray,
+        velocity: np.ndarray,
+        residual_quantiles: np.ndarray,
+        groups: dict[str, list[np.ndarray]],
+        tables: dict[str, np.ndarray],
+        n_scenarios: int,
+        seed: np.random.SeedSequence,
+) -> dict[str, np.ndarray]:
+    """
+    Draws n_scenarios scenarios, BATCH_SCENARIOS at a time
+
+    Parameters
+    ----------
+    arrival: np.ndarray
+        Arrival probability of every pigeon
+    velocity: np.ndarray
+        Velocity forecast of every pigeon, given that it arrives
+    residual_quantiles: np.ndarray
+        Quantiles of the velocity residuals at RESIDUAL_PROBS
+    groups: dict[str, list[np.ndarray]]
+        Level to the pigeon indices of each of its groups (e.g. clubs)
+    tables: dict[str, np.ndarray]
+        Level to the points of every finishing position, see points_tables
+    n_scenarios: int
+    seed: np.random.SeedSequence
+
+    Returns
+    -------
+    Sums over the scenarios of the arrivals, wins, top ten finishes and points of each level of every pigeon
+    """
+    rng = np.random.default_rng(seed)
+    n = len(arrival)
+    sums = {name: np.zeros(n) for name in ['arrived', 'win', f'top_{TOP_N}'] + [f'{level}_points' for level in tables]}
+    if n == 0:
+        return sums
+
+    quantiles = np.asarray(residual_quantiles, dtype=np.float32)
+    slopes = np.diff(quantiles)
+    steps = len(RESIDUAL_PROBS) - 1
+    velocity = np.asarray(velocity, dtype=np.float32)
+    for start in range(0, n_scenarios, BATCH_SCENARIOS):
+        size = min(BATCH_SCENARIOS, n_scenarios - start)
+        arrived = rng.random((size, n), dtype=np.float32) < arrival
+        # RESIDUAL_PROBS is a uniform grid, so the quantile below a draw is found by its index instead of a search
+        position = rng.random((size, n), dtype=np.float32) * steps
+        index = np.minimum(position.astype(np.int32), steps - 1)
+        residuals = quantiles[index] + np.subtract(position, index, dtype=np.float32) * slopes[index]
+        # pigeons that do not arrive finish behind every pigeon that does
+        scenario = np.where(arrived, velocity + residuals, np.float32(-np.inf))
+        sums['arrived'] += arrived.sum(axis=0)
+
+        top = finishing_order(scenario, TOP_N)
+        scored = np.isfinite(np.take_along_axis(scenario, top, axis=1))
+        sums['win'] += np.bincount(top[:, 0][scored[:, 0]], minlength=n)
+        sums[f'top_{TOP_N}'] += np.bincount(top[scored], minlength=n)
+
+        for level, table in tables.items():
+            for members in groups[level]:
+                scenario_group = scenario[:, members]
+                top = finishing_order(scenario_group, len(table))
+                scored = np.isfinite(np.take_along_axis(scenario_group, top, axis=1))
+                points = np.broadcast_to(table[:top.shape[1]], top.shape)
+                sums[f'{level}_points'] += np.bincount(members[top[scored]], weights=points[scored], minlength=n)
+    return sums
+
+
+def simulate(
+        arrival: np.ndarray,
+        velocity: np.ndarray,
+        residual_quantiles: np.ndarray,
+        groups: dict[str, list[np.ndarray]],
+        tables: dict[str, np.ndarray],
+        n_scenarios: int = SCENARIOS,
+        workers: int = 1,
+        seed: int = 0,
+) -> dict[str, np.ndarray]:
+    """
+    Arrival, win and top ten probabilities and expected points of each level of every pigeon, see simulate_batch.
+    With more than one worker the scenarios are split evenly across a process pool.
+    """
+    workers = max(1, min(workers or 1, -(-n_scenarios // BATCH_SCENARIOS)))
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    counts = [n_scenarios // workers + (i < n_scenarios % workers) for i in range(workers)]
+    args = (arrival, velocity, residual_quantiles, groups, tables)
+
+    if workers == 1:
+        parts = [simulate_batch(*args, n_scenarios, seeds[0])]
+    else:
+        jobs = [(*args, count, worker_seed) for count, worker_seed in zip(counts, seeds)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            parts = list(pool.map(simulate_batch, *zip(*jobs)))
+    return {name: sum(part[name] for part in parts) / n_scenarios for name in parts[0]}
+
+
+def _group_indices(values: np.ndarray) -> list[np.ndarray]:
+    """Pigeon indices of every distinct value, pigeons with a missing value are in no group"""
+    codes, _ = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    return np.split(order, np.flatnonzero(np.diff(codes[order])) + 1) if len(order) else []
+
+
+class RaceSimulator:
+
+    def __init__(
+            self,
+            arrival: Predictor,
+            velocity: Predictor,
+            tables: dict[str, np.ndarray],
+            sections: dict[int, int] = None,
+    ):
+        """
+        Parameters
+        ----------
+        arrival: Predictor
+            Arrival probability model
+        velocity: Predictor
+            Velocity model, whose artifact keeps its residual quantiles
+        tables: dict[str, np.ndarray]
+            Points of every finishing position of each level, see points_tables
+        sections: dict[int, int]
+            Section number of every member, for entries without a section_number
+        """
+        if velocity.artifact.residual_quantiles is None:
+            raise ValueError(f'Velocity artifact {velocity.artifact.path} has no residuals, save it again')
+        self.arrival = arrival
+        self.velocity = velocity
+        self.tables = tables
+        self.sections = sections or {}
+
+    @classmethod
+    def from_snapshot(cls, predictors: dict[str, Predictor] = None, snapshot: str = None):
+        """
+        Estimates the points tables from the race results of a snapshot and reads the sections of the members.
+        The points are only kept in df_race_results and are joined to the participants of df_race_results_final.
+
+        Parameters
+        ----------
+        predictors: dict[str, Predictor]
+            With arrival and velocity, defaults to load_predictors
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot
+        """
+        predictors = predictors or load_predictors(snapshot=snapshot)
+        columns = ['race_id', 'pigeon_id', 'velocity', 'club_number_race_results', 'member_id_race_results']
+        df = load_data('df_race_results_final', columns=columns, snapshot=snapshot)
+        # the club and owner of the participant, suffixed as the pigeons have them too
+        df = df.rename(columns={'club_number_race_results': 'club_number', 'member_id_race_results': 'member_id'})
+
+        points = ['club_points', 'section_points', 'federation_points']
+        df_points = load_data('df_race_results', columns=['race_id', 'pigeon_id', *points], snapshot=snapshot)
+        missing = [c for c in points if c not in df_points]
+        if missing:
+            raise ValueError(f'df_race_results has no {", ".join(missing)}, the points tables cannot be estimated')
+        df_points = df_points.drop_duplicates(['race_id', 'pigeon_id'], keep='last')
+        df = df.merge(df_points, on=['race_id', 'pigeon_id'], how='left')
+        # participants without a result scored no points, as in merge_race_results_final
+        df[points] = df[points].fillna(0)
+
+        df_members = load_data('df_members', columns=['id', 'section_number'], snapshot=snapshot)
+        if 'section_number' not in df_members:
+            raise ValueError('df_members has no section_number, the section points cannot be estimated')
+        sections = df_members.dropna().drop_duplicates('id').set_index('id')['section_number'].to_dict()
+        if 'member_id' in df:
+            df['section_number'] = df['member_id'].map(sections)
+        return cls(predictors['arrival'], predictors['velocity'], points_tables(df), sections=sections)
+
+    def simulate(
+            self,
+            entries: list[dict],
+            n_scenarios: int = SCENARIOS,
+            workers: int = 1,
+            seed: int = 0,
+    ) -> pd.DataFrame:
+        """
+        Parameters
+        ----------
+        entries: list[dict]
+            Every pigeon registered in the race, as in the prediction service (pigeon_id, release_datetime, race_id,
+            club_number and optionally features), with member_id or section_number for the section points
+        n_scenarios: int
+        workers: int
+            Size of the process pool the scenarios are split across
+        seed: int
+
+        Returns
+        -------
+        Per pigeon: arrival probability, velocity forecast, probability to win and to finish in the top ten, and
+        expected club, section and federation points, most likely winner first
+        """
+        start = time.perf_counter()
+        arrival = self.arrival.predict(entries)
+        velocity = self.velocity.predict(entries)
+
+        df = pd.DataFrame({
+            'pigeon_id': [entry['pigeon_id'] for entry in entries],
+            'club_number': [entry.get('club_number') for entry in entries],
+            'section_number': [
+                entry.get('section_number', self.sections.get(entry.get('member_id'))) for entry in entries
+            ],
+        })
+        groups = {
+            level: [np.arange(len(df))] if column is None else _group_indices(df[column].to_numpy())
+            for level, column in LEVELS.items()
+        }
+        sums = simulate(
+            arrival,
+            velocity,
+            self.velocity.artifact.residual_quantiles,
+            groups,
+            self.tables,
+            n_scenarios=n_scenarios,
+            workers=workers,
+            seed=seed,
+        )
+
+        df['arrival_probability'] = arrival
+        df['velocity_forecast'] = velocity
+        df['win_probability'] = sums['win']
+        df[f'top_{TOP_N}_probability'] = sums[f'top_{TOP_N}']
+        for level in self.tables:
+            df[f'expected_{level}_points'] = sums[f'{level}_points']
+        print(f'Simulated {n_scenarios} scenarios of {len(df)} pigeons in {time.perf_counter() - start:.2f}s')
+        return df.sort_values(['win_probability', f'top_{TOP_N}_probability'], ascending=False, ignore_index=True)
+
+
+async def race_entries(
+        race_id: int,
+        release_datetime: str = None,
+        cache: ResponseCache = None,
+        offline: bool = False,
+) -> list[dict]:
+    """
+    Entries of every pigeon registered in a race, from get_race_participants
+
+    Parameters
+    ----------
+    race_id: int
+    release_datetime: str
+        Defaults to the release of the race in the race list
+    cache: ResponseCache
+    offline: bool
+    """
+    async with MaltaPigeonFederationAPI(cache=cache, offline=offline) as mpr:
+        pages = [page async for page in mpr.get_race_participants(race_id=race_id)]
+        if release_datetime is None:
+            race = next((race for race in await mpr.get_race_list() if race['id'] == race_id), None)
+            if race is None or race.get('releaseDatetime') is None:
+                raise ValueError(f'Race {race_id} has no release time, pass it explicitly')
+            release_datetime = pd.Timestamp(race['releaseDatetime'], unit='ms')
+
+    df = normalise_records(list(itertools.chain.from_iterable(pages)))
+    return [
+        {
+            'pigeon_id': int(row['pigeon_id']),
+            'release_datetime': pd.Timestamp(release_datetime),
+            'race_id': race_id,
+            'club_number': row.get('club_number'),
+            'member_id': row.get('member_id'),
+        }
+        for row in df.to_dict('records')
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Monte Carlo simulation of a race')
+    parser.add_argument('race_id', type=int)
+    parser.add_argument('--release-datetime', default=None, help='Defaults to the release in the race list')
+    parser.add_argument('--scenarios', type=int, default=SCENARIOS)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help='Cache federation responses on disk')
+    args = parser.parse_args()
+
+    entries = asyncio.run(race_entries(
+        args.race_id, args.release_datetime, cache=ResponseCache() if args.cache else None
+    ))
+    simulator = RaceSimulator.from_snapshot()
+    df = simulator.simulate(entries, n_scenarios=args.scenarios, workers=args.workers, seed=args.seed)
+    print(df.head(20).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Model Artifact
+Self-contained, versioned on-disk format of a trained model, loaded without unpickling.
+
+Layout of an artifact directory:
+    meta.json           format version, feature order, categorical columns, prediction column, config hash and
+                        training history
+    model.txt           native LightGBM model
+    vocab/<column>.npy  sorted vocabulary of a categorical column, int64 or float64 for numeric categories and
+                        fixed-width unicode otherwise, so that it is memory-mapped on load
+    residuals.npy       regression models only: quantiles of the residuals (actual minus predicted) on the test
+                        set, at the probabilities RESIDUAL_PROBS, see data_serve.simulator
+
+Categorical features are encoded as in training (see data_train.categorical): the code of a category is its
+position in the vocabulary plus one, and values missing from the vocabulary get the reserved code UNSEEN_CODE.
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+from data_train.categorical import UNSEEN_CODE, encode, fit_vocab
+
+ARTIFACT_FORMAT = 2
+RESIDUAL_PROBS = np.linspace(0, 1, 1001)
+
+
+def config_hash(config: dict) -> str:
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_artifact(
+        path: str,
+        booster: lgb.Booster,
+        vocab: dict[str, np.ndarray],
+        config: dict,
+        name: str = None,
+        training: dict = None,
+        residuals: np.ndarray = None,
+) -> None:
+    """
+    Parameters
+    ----------
+    path: str
+        Artifact directory, replaced if it exists
+    booster: lgb.Booster
+        Trained booster, its feature names give the feature order
+    vocab: dict[str, np.ndarray]
+        Vocabulary of every encoded categorical column, in code order
+    config: dict
+        Model config the booster was trained with
+    name: str
+        Model name, defaults to the directory name
+    training: dict
+        Training history, e.g. when the booster was last fully refitted, kept in the metadata
+    residuals: np.ndarray
+        Residuals of a regression booster, kept as quantiles
+    """
+    os.makedirs(os.path.join(path, 'vocab'), exist_ok=True)
+    for file in os.listdir(os.path.join(path, 'vocab')):
+        os.remove(os.path.join(path, 'vocab', file))
+
+    booster.save_model(os.path.join(path, 'model.txt'))
+    if os.path.exists(os.path.join(path, 'residuals.npy')):
+        os.remove(os.path.join(path, 'residuals.npy'))
+    if residuals is not None and len(residuals):
+        np.save(os.path.join(path, 'residuals.npy'), np.quantile(residuals, RESIDUAL_PROBS), allow_pickle=False)
+    for c, values in vocab.items():
+        np.save(os.path.join(path, 'vocab', f'{c}.npy'), fit_vocab(values), allow_pickle=False)
+
+    meta = {
+        'format': ARTIFACT_FORMAT,
+        'name': name or os.path.basename(os.path.normpath(path)),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'lightgbm_version': lgb.__version__,
+        'feature_names': booster.feature_name(),
+        'categorical': list(vocab),
+        'unseen_code': UNSEEN_CODE,
+        'pred_col': config['pred_col'],
+        'objective': config['model_params']['objective'],
+        'config_hash': config_hash(config),
+        'training': training or {},
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    print(f'Saved model artifact to {path}')
+
+
+class ModelArtifact:
+
+    def __init__(self, path: str):
+        """
+        Loads an artifact written by save_artifact. Vocabularies are memory-mapped.
+
+        Raises
+        ------
+        ValueError if the artifact was written in another format version
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != ARTIFACT_FORMAT:
+            raise ValueError(f'Artifact {path} has format {self.meta["format"]}, expected {ARTIFACT_FORMAT}')
+
+        self.path = path
+        self.name = self.meta['name']
+        self.feature_names = self.meta['feature_names']
+        self.categorical = self.meta['categorical']
+        self.booster = lgb.Booster(model_file=os.path.join(path, 'model.txt'))
+        self.vocab = {
+            c: np.load(os.path.join(path, 'vocab', f'{c}.npy'), mmap_mode='r', allow_pickle=False)
+            for c in self.categorical
+        }
+        residuals_path = os.path.join(path, 'residuals.npy')
+        self.residual_quantiles = np.load(residuals_path) if os.path.exists(residuals_path) else None
+
+    def encode(self, features: dict) -> dict:
+        """Replaces the raw values of the categorical columns of features by their codes"""
+        return {c: encode(self.vocab[c], values) if c in self.vocab else values for c, values in features.items()}
+
+    def matrix(self, features: dict, n: int, dtype: type = np.float64) -> np.ndarray:
+        """Contiguous row-major matrix of encoded features in the order of the booster, NaN for missing features"""
+        x = np.full((n, len(self.feature_names)), np.nan, dtype=dtype)
+        for j, c in enumerate(self.feature_names):
+            if c in features:
+                x[:, j] = features[c]
+        return x
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        """Predictions for raw (not encoded) feature rows"""
+        features = self.encode({c: df[c].to_numpy() for c in self.feature_names if c in df})
+        return self.booster.predict(self.matrix(features, len(df)))
@@ -0,0 +1,76 @@
+"""Categorical encoding
+Fixed-vocabulary encoding of categorical features into compact integer codes.
+
+A vocabulary is the sorted array of the known values of a column. The code of a value is its position in the
+vocabulary plus one, and UNSEEN_CODE (0) is reserved for missing values and values not in the vocabulary, so that
+rows at inference time never fall outside the categories LightGBM was trained on. Encoded columns are pandas
+category dtypes whose categories are the codes themselves, which LightGBM uses as native categorical features.
+"""
+import numpy as np
+import pandas as pd
+
+UNSEEN_CODE = 0
+# above this many values, distinct values are found by hashing first and only those are looked up
+FACTORIZE_MIN_ROWS = 1_000
+
+
+def fit_vocab(values) -> np.ndarray:
+    """Sorted unique non-missing values, as an int64, float64 or fixed-width unicode array"""
+    values = pd.Series(pd.Series(values).unique()).dropna()
+    if pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return np.sort(values.to_numpy('int64'))
+    if pd.api.types.is_numeric_dtype(values):
+        return np.sort(values.to_numpy(float))
+    return np.sort(values.astype(str).to_numpy(str))
+
+
+def _to_int(value):
+    try:
+        return int(value) if float(value).is_integer() else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _as_vocab_dtype(vocab: np.ndarray, values) -> tuple[np.ndarray, np.ndarray]:
+    """values converted to the dtype of vocab, and a mask of the non-missing values which could be converted"""
+    if vocab.dtype.kind in 'iu':
+        try:
+            ints = pd.Series(values, dtype='Int64')
+        except (TypeError, ValueError):
+            ints = pd.Series(pd.array([_to_int(value) for value in values], dtype='Int64'))
+        return ints.fillna(0).to_numpy('int64'), ints.notna().to_numpy()
+    if vocab.dtype.kind == 'f':
+        floats = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(float)
+        return floats, ~np.isnan(floats)
+    strings = pd.Series(values, dtype=object)
+    return strings.astype(str).to_numpy(str), strings.notna().to_numpy()
+
+
+def encode(vocab: np.ndarray, values) -> np.ndarray:
+    """
+    Vectorised encoding of values with a vocabulary from fit_vocab
+
+    Returns
+    -------
+    int32 codes, UNSEEN_CODE for missing values and values not in the vocabulary
+    """
+    if len(values) > FACTORIZE_MIN_ROWS:
+        # missing values are factorized to -1, i.e. to the appended UNSEEN_CODE
+        positions, uniques = pd.factorize(pd.Series(values))
+        return np.append(_lookup(vocab, uniques), np.int32(UNSEEN_CODE))[positions]
+    return _lookup(vocab, values)
+
+
+def _lookup(vocab: np.ndarray, values) -> np.ndarray:
+    values, valid = _as_vocab_dtype(vocab, values)
+    if not len(vocab):
+        return np.full(len(values), UNSEEN_CODE, dtype='int32')
+
+    positions = np.searchsorted(vocab, values).clip(0, len(vocab) - 1)
+    found = valid & (vocab[positions] == values)
+    return np.where(found, positions + 1, UNSEEN_CODE).astype('int32')
+
+
+def to_categorical(codes: np.ndarray, vocab: np.ndarray) -> pd.Categorical:
+    """Codes from encode as a category dtype with one category per code, stored in the smallest integer type"""
+    return pd.Categorical.from_codes(codes, categories=pd.RangeIndex(len(vocab) + 1))
@@ -0,0 +1,146 @@
+"""Dataset Cache
+Binned LightGBM train and test datasets, built once per snapshot and feature set and reused across fits.
+
+Constructing an lgb.Dataset bins every feature, which dominates the start-up of a fit. The binned datasets are saved
+as LightGBM binaries under DATA_PATH/dataset_cache/<snapshot_id>/<key>, with a meta.json written last. The key
+hashes everything that determines the binned data: the version of the data the model was loaded from, the model
+class (whose clean() filters the rows), the target, features and train/test split of the config, the parameters in
+BINNING_PARAMS and the LightGBM version. Changing any other parameter, e.g. learning_rate or num_leaves, reuses the
+cached datasets.
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+
+import lightgbm as lgb
+
+from src import DATA_PATH
+from src.data_preprocess.snapshot_store import SnapshotStore
+
+DATASET_CACHE_PATH = os.path.join(DATA_PATH, 'dataset_cache')
+
+# parameters, with their aliases, that LightGBM fixes when a dataset is constructed. min_data_in_leaf is one of them
+# because feature_pre_filter drops the features that cannot be split with it.
+BINNING_PARAMS = frozenset({
+    'max_bin', 'max_bins',
+    'max_bin_by_feature',
+    'min_data_in_bin',
+    'bin_construct_sample_cnt', 'subsample_for_bin',
+    'data_random_seed', 'data_seed',
+    'seed', 'random_seed', 'random_state',
+    'use_missing',
+    'zero_as_missing',
+    'feature_pre_filter',
+    'min_data_in_leaf', 'min_data', 'min_child_samples', 'min_samples_leaf', 'min_data_per_leaf',
+    'enable_bundle', 'is_enable_bundle', 'bundle',
+    'max_conflict_rate',
+    'is_enable_sparse', 'is_sparse', 'enable_sparse', 'sparse',
+    'forcedbins_filename',
+    'linear_tree', 'linear_trees',
+    'precise_float_parser',
+})
+
+
+def binning_params(params: dict) -> dict:
+    return {k: v for k, v in sorted(params.items()) if k in BINNING_PARAMS}
+
+
+class DatasetCache:
+
+    def __init__(self, snapshot: str = None, data_version: str = 'snapshot', path: str = DATASET_CACHE_PATH):
+        """
+        Parameters
+        ----------
+        snapshot: str
+            Snapshot id the model data was loaded from, defaults to the latest snapshot
+        data_version: str
+            Identifies how the data was derived from the snapshot, e.g. the feature group versions of the feature
+            store, so that rebuilt features invalidate the cache
+        path: str
+        """
+        self.snapshot = snapshot or SnapshotStore().latest
+        self.data_version = data_version
+        self.path = os.path.join(path, self.snapshot)
+
+    def key(self, model: str, config: dict, encoded: bool) -> str:
+        """
+        Parameters
+        ----------
+        model: str
+            Name of the model class
+        config: dict
+            Model config
+        encoded: bool
+            Whether the model was loaded from the feature store
+        """
+        key = {
+            'data_version': self.data_version,
+            'model': model,
+            'encoded': encoded,
+            'pred_col': config['pred_col'],
+            'history_start': str(config.get('history_start')),
+            'train_start': str(config['train_start']),
+            'train_end': str(config['train_end']),
+            'features': config['features'],
+            'binning': binning_params(config['model_params']),
+            'lightgbm_version': lgb.__version__,
+        }
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return f'{model}-{digest}'
+
+    def load(
+            self,
+            key: str,
+            feature_names: list[str],
+            num_train: int,
+            num_test: int,
+            params: dict = None,
+    ) -> tuple[lgb.Dataset, lgb.Dataset] | None:
+        """
+        Cached train and test datasets of key, None if they are missing or do not match the expected features and
+        row counts
+
+        Parameters
+        ----------
+        key: str
+        feature_names: list[str]
+            Feature columns of the train data, in order
+        num_train: int
+        num_test: int
+        params: dict
+            Dataset parameters
+        """
+        key_dir = os.path.join(self.path, key)
+        meta_path = os.path.join(key_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if (meta['feature_names'], meta['num_train'], meta['num_test']) != (feature_names, num_train, num_test):
+            print(f'Dataset cache {key_dir} does not match the model data, rebuilding it')
+            return None
+
+        train = lgb.Dataset(os.path.join(key_dir, 'train.bin'), params=params).construct()
+        test = lgb.Dataset(os.path.join(key_dir, 'test.bin'), reference=train, params=params).construct()
+        print(f'Loaded binned datasets from {key_dir}')
+        return train, test
+
+    def save(self, key: str, train: lgb.Dataset, test: lgb.Dataset) -> None:
+        """Constructs and saves the train and test datasets of key, replacing any cached ones"""
+        key_dir = os.path.join(self.path, key)
+        shutil.rmtree(key_dir, ignore_errors=True)
+        os.makedirs(key_dir)
+
+        train.save_binary(os.path.join(key_dir, 'train.bin'))
+        test.save_binary(os.path.join(key_dir, 'test.bin'))
+        meta = {
+            'feature_names': train.get_feature_name(),
+            'num_train': train.num_data(),
+            'num_test': test.num_data(),
+            'created': datetime.now().isoformat(timespec='seconds'),
+        }
+        with open(os.path.join(key_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        print(f'Saved binned datasets to {key_dir}')
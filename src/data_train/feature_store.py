@@ -0,0 +1,260 @@
+"""Feature Store
+Model-ready features of every (race_id, pigeon_id), built once per snapshot from df_race_results_final.
+
+Layout under DATA_PATH/feature_store/<snapshot_id>:
+    manifest.json           version, columns and row count of every feature group
+    <group>.parquet         race_id, pigeon_id, release_datetime and the columns of the group, sorted by race and
+                            pigeon so that race filters skip whole row groups
+    vocab/<column>.parquet  sorted vocabulary of an encoded categorical column, see data_train.categorical
+
+Feature groups:
+    base         targets and parsed datetimes, always built
+    form         pigeon form, see data_train.form, also over the backfilled race histories of races missing from the
+                 snapshot (see data_preprocess.backfill)
+    raw          covariates read as they are from the snapshot
+    categorical  categorical columns encoded as int32 codes, UNSEEN_CODE for missing values
+
+The columns of each group come from the features sections of the model configs. A group is rebuilt only when its
+version changes, i.e. when its columns change or its GROUP_VERSIONS entry is bumped, and the form group also
+when the backfill grows.
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from data_train.categorical import encode, fit_vocab
+from data_train.form import FORM_COLUMNS, halflives_from_features, form_column, rolling_form
+from data_train.utils import load_config, load_data
+from src import DATA_PATH
+from src.data_preprocess.backfill import backfill_version, load_backfill
+from src.data_preprocess.snapshot_store import SnapshotStore
+
+FEATURE_STORE_PATH = os.path.join(DATA_PATH, 'feature_store')
+MODEL_CONFIGS = ('arrival_params.yaml', 'velocity_params.yaml')
+KEY_COLUMNS = ['race_id', 'pigeon_id', 'release_datetime']
+BASE_COLUMNS = ['arrival_datetime', 'velocity', 'arrived']
+ROW_GROUP_SIZE = 100_000
+
+# bump to rebuild a group whose computation changed without its columns changing
+GROUP_VERSIONS = {
+    'base': 1,
+    'form': 1,
+    'raw': 1,
+    'categorical': 2,
+}
+
+
+def feature_groups(configs: tuple[str, ...] = MODEL_CONFIGS) -> dict[str, list[str]]:
+    """Columns of every feature group needed by the model configs"""
+    covariates, categorical = [], []
+    for config in configs:
+        features = load_config(config)['features']
+        covariates += features['covariates']
+        categorical += features['categorical']
+
+    halflives = halflives_from_features(covariates)
+    form = FORM_COLUMNS + [form_column(halflife) for halflife in halflives if form_column(halflife) not in FORM_COLUMNS]
+    return {
+        'base': BASE_COLUMNS,
+        'form': form,
+        'raw': [c for c in dict.fromkeys(covariates) if c not in form + BASE_COLUMNS + KEY_COLUMNS],
+        'categorical': list(dict.fromkeys(categorical)),
+    }
+
+
+def group_version(group: str, columns: list[str]) -> str:
+    return f'{GROUP_VERSIONS[group]}-{hashlib.sha1(json.dumps(columns).encode()).hexdigest()[:10]}'
+
+
+class FeatureStore:
+
+    def __init__(self, path: str = FEATURE_STORE_PATH, configs: tuple[str, ...] = MODEL_CONFIGS):
+        self.path = path
+        self.configs = configs
+        self.groups = feature_groups(configs)
+
+    def _snapshot_dir(self, snapshot: str = None) -> str:
+        return os.path.join(self.path, snapshot or SnapshotStore().latest)
+
+    def manifest(self, snapshot: str = None) -> dict:
+        manifest_path = os.path.join(self._snapshot_dir(snapshot), 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return {'groups': {}}
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def version(self, group: str) -> str:
+        version = group_version(group, self.groups[group])
+        if group == 'form':
+            version = f'{version}-backfill-{backfill_version()}'
+        return version
+
+    def stale_groups(self, snapshot: str = None) -> list[str]:
+        built = self.manifest(snapshot)['groups']
+        return [group for group in self.groups if built.get(group, {}).get('version') != self.version(group)]
+
+    def build(self, snapshot: str = None, force: bool = False) -> list[str]:
+        """
+        Builds the feature groups of a snapshot which are missing or have an outdated version.
+
+        Parameters
+        ----------
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot
+        force: bool
+            Rebuild every group
+
+        Returns
+        -------
+        Names of the rebuilt groups
+        """
+        snapshot = snapshot or SnapshotStore().latest
+        stale = list(self.groups) if force else self.stale_groups(snapshot)
+        if not stale:
+            print(f'Feature store of snapshot {snapshot} is up to date')
+            return []
+
+        history_start = min(
+            pd.Timestamp(load_config(config).get('history_start') or '1900-01-01') for config in self.configs
+        )
+        columns = KEY_COLUMNS + ['arrival_datetime', 'velocity']
+        for group in ('raw', 'categorical'):
+            if group in stale:
+                columns += self.groups[group]
+
+        df = load_data(
+            'df_race_results_final',
+            columns=columns,
+            filters=[('release_datetime', '>=', history_start)],
+            snapshot=snapshot,
+        )
+        df['release_datetime'] = pd.to_datetime(df['release_datetime'])
+        df = df.sort_values(['race_id', 'pigeon_id']).reset_index(drop=True)
+
+        snapshot_dir = self._snapshot_dir(snapshot)
+        os.makedirs(os.path.join(snapshot_dir, 'vocab'), exist_ok=True)
+        manifest = self.manifest(snapshot)
+        for group in stale:
+            if group == 'form':
+                df_history = load_backfill(snapshot)
+                df_history = df_history[df_history['release_datetime'] >= history_start]
+                df_group = self._build_form(df, snapshot_dir, df_history=df_history)
+            else:
+                df_group = getattr(self, f'_build_{group}')(df, snapshot_dir)
+            file = os.path.join(snapshot_dir, f'{group}.parquet')
+            df_group.to_parquet(file, index=False, row_group_size=ROW_GROUP_SIZE)
+            manifest['groups'][group] = {
+                'version': self.version(group),
+                'columns': self.groups[group],
+                'num_rows': len(df_group),
+                'built': datetime.now().isoformat(timespec='seconds'),
+            }
+            print(f'Built feature group {group} of snapshot {snapshot} ({len(df_group)} rows)')
+
+        manifest['snapshot'] = snapshot
+        with open(os.path.join(snapshot_dir, 'manifest.json.tmp'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(os.path.join(snapshot_dir, 'manifest.json.tmp'), os.path.join(snapshot_dir, 'manifest.json'))
+        return stale
+
+    def _build_base(self, df: pd.DataFrame, snapshot_dir: str) -> pd.DataFrame:
+        df_base = df[KEY_COLUMNS + ['velocity']].copy()
+        df_base['arrived'] = df['arrival_datetime'].notna()
+        arrival = df['arrival_datetime']
+        df_base['arrival_datetime'] = arrival if arrival.dtype.kind == 'M' else pd.to_datetime(arrival, unit='ms')
+        return df_base[KEY_COLUMNS + self.groups['base']]
+
+    def _build_form(self, df: pd.DataFrame, snapshot_dir: str, df_history: pd.DataFrame = None) -> pd.DataFrame:
+        halflives = halflives_from_features(self.groups['form'])
+        df_form = df[KEY_COLUMNS + ['velocity']].assign(backfilled=False)
+        if df_history is not None and len(df_history):
+            # velocity of the races a pigeon did not arrive in is 0, as in df_race_results_final
+            df_history = df_history.reindex(columns=KEY_COLUMNS + ['velocity']).fillna({'velocity': 0})
+            df_form = pd.concat([df_form, df_history.assign(backfilled=True)], ignore_index=True)
+            print(f'Pigeon form over {len(df_history)} backfilled race history rows')
+        df_form, _ = rolling_form(df_form, halflives)
+        df_form = df_form[~df_form['backfilled'].to_numpy(bool)]
+        return df_form.sort_values(['race_id', 'pigeon_id'])[KEY_COLUMNS + self.groups['form']]
+
+    def _build_raw(self, df: pd.DataFrame, snapshot_dir: str) -> pd.DataFrame:
+        return df.reindex(columns=KEY_COLUMNS + self.groups['raw'])
+
+    def _build_categorical(self, df: pd.DataFrame, snapshot_dir: str) -> pd.DataFrame:
+        df_cat = df[KEY_COLUMNS].copy()
+        for c in self.groups['categorical']:
+            values = df[c] if c in df else pd.Series(np.nan, index=df.index)
+            vocab = fit_vocab(values)
+            pd.DataFrame({c: vocab}).to_parquet(os.path.join(snapshot_dir, 'vocab', f'{c}.parquet'), index=False)
+            df_cat[f'code_{c}'] = encode(vocab, values)
+        return df_cat
+
+    def vocab(self, column: str, snapshot: str = None) -> np.ndarray:
+        df_vocab = pd.read_parquet(os.path.join(self._snapshot_dir(snapshot), 'vocab', f'{column}.parquet'))
+        return fit_vocab(df_vocab[column])
+
+    def encode(self, df: pd.DataFrame, snapshot: str = None) -> pd.DataFrame:
+        """Encodes the categorical columns of new rows, e.g. of an upcoming race, with the codes of the store"""
+        df = df.copy()
+        for c in self.groups['categorical']:
+            if c in df:
+                df[c] = encode(self.vocab(c, snapshot), df[c])
+        return df
+
+    def load(
+            self,
+            columns: list[str] = None,
+            filters: list[tuple] = None,
+            snapshot: str = None,
+    ) -> pd.DataFrame:
+        """
+        Parameters
+        ----------
+        columns: list[str]
+            Feature columns to read, categorical columns are returned encoded. Defaults to all columns.
+        filters: list[tuple]
+            (column, op, value) predicates on race_id, pigeon_id or release_datetime,
+            e.g. [('race_id', '==', race_id)] for scoring a single race
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot
+
+        Returns
+        -------
+        DataFrame with race_id, pigeon_id, release_datetime and the requested columns, sorted by race and pigeon
+        """
+        snapshot_dir = self._snapshot_dir(snapshot)
+        stale = self.stale_groups(snapshot)
+        if stale:
+            raise FileNotFoundError(f'Feature groups {stale} of {snapshot_dir} are missing or outdated, run build()')
+
+        columns = columns or [c for group in self.groups.values() for c in group]
+        df = None
+        for group, group_columns in self.groups.items():
+            wanted = [c for c in group_columns if c in columns]
+            if not wanted and group != 'base':
+                continue
+            if group == 'categorical':
+                read = [f'code_{c}' for c in wanted]
+            else:
+                read = wanted
+            file = os.path.join(snapshot_dir, f'{group}.parquet')
+            df_group = pq.read_table(file, columns=KEY_COLUMNS + read, filters=filters or None).to_pandas()
+            df = df_group if df is None else df.merge(df_group, on=KEY_COLUMNS, how='left')
+
+        # encoded categoricals replace their raw column, including the pigeon_id key
+        codes = {c: c.removeprefix('code_') for c in df.columns if c.startswith('code_')}
+        df = df.drop(columns=[c for c in codes.values() if c in KEY_COLUMNS]).rename(columns=codes)
+        print(f'Loaded {len(df)} rows of {len(df.columns)} features from {snapshot_dir}')
+        return df
+
+
+def main() -> None:
+    FeatureStore().build()
+
+
+if __name__ == '__main__':
+    main()
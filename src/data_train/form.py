@@ -0,0 +1,221 @@
+"""Pigeon Form
+Single pass computation of the pigeon form features over the race history.
+
+The history is sorted once by pigeon and release time. Lagged velocity, race counts and the expanding mean then
+come from group-boundary arrays and segmented cumulative sums. The time-decayed exponentially weighted means
+are computed for all half-lives together, stepping through the i-th race of every pigeon at once, so the number
+of numpy calls grows with the longest race history rather than with the number of pigeons.
+
+The exponentially weighted mean follows pandas' ewm(halflife=..., times=...).mean() on the lagged velocity:
+missing velocities are skipped but still age the previous races.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+FORM_HALFLIFE = '60 days'
+FORM_COLUMNS = ['velocity_lag', 'race_count', 'total_race_count', 'velocity_form', 'velocity_form_linear']
+STATE_COLUMNS = ['last_velocity', 'last_time', 'race_count', 'velocity_sum', 'velocity_count']
+
+
+def form_column(halflife: str) -> str:
+    """velocity_form for the default half-life, velocity_form_<days>d otherwise"""
+    halflife = pd.Timedelta(halflife)
+    if halflife == pd.Timedelta(FORM_HALFLIFE):
+        return 'velocity_form'
+    return f'velocity_form_{halflife / pd.Timedelta(days=1):g}d'
+
+
+def halflives_from_features(features: list[str]) -> list[str]:
+    """Half-lives needed by a feature list, e.g. velocity_form_30d adds a 30 day half-life to the default one"""
+    halflives = [FORM_HALFLIFE]
+    for feature in features:
+        match = re.fullmatch(r'velocity_form_(\d+(?:\.\d+)?)d', feature)
+        if match:
+            halflives.append(f'{match.group(1)} days')
+    return list(dict.fromkeys(halflives))
+
+
+def empty_state(halflives: list[str] = (FORM_HALFLIFE,)) -> pd.DataFrame:
+    df = pd.DataFrame({
+        'last_velocity': pd.Series(dtype=float),
+        'last_time': pd.Series(dtype='datetime64[ns]'),
+        'race_count': pd.Series(dtype='int64'),
+        'velocity_sum': pd.Series(dtype=float),
+        'velocity_count': pd.Series(dtype='int64'),
+    })
+    for halflife in halflives:
+        df[f'{form_column(halflife)}_mean'] = pd.Series(dtype=float)
+        df[f'{form_column(halflife)}_weight'] = pd.Series(dtype=float)
+    df.index.name = 'pigeon_id'
+    return df
+
+
+def _segmented_cumsum(x: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    cs = np.cumsum(x)
+    return cs - np.repeat(cs[starts] - x[starts], sizes)
+
+
+def rolling_form(
+        df: pd.DataFrame,
+        halflives: list[str] = (FORM_HALFLIFE,),
+        state: pd.DataFrame = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Race results with pigeon_id, release_datetime and velocity
+    halflives: list[str]
+        Half-lives of the exponentially weighted velocity means, one form column each (see form_column)
+    state: pd.DataFrame
+        Form state of pigeons before the races in df, indexed by pigeon_id, as returned by a previous call.
+        Every race in df must be later than the last race in the state of its pigeon.
+
+    Returns
+    -------
+    df sorted by pigeon and release time with the form columns added, and the form state after the last race of
+    every pigeon in df
+    """
+    halflives = list(dict.fromkeys(halflives))
+    df = df.sort_values(['pigeon_id', 'release_datetime'], kind='stable').reset_index(drop=True)
+    n = len(df)
+
+    pigeon_ids = df['pigeon_id'].to_numpy()
+    times = pd.to_datetime(df['release_datetime']).to_numpy('datetime64[ns]').astype('int64') / 1e9
+    velocity = df['velocity'].to_numpy(float)
+
+    starts = np.flatnonzero(np.r_[True, pigeon_ids[1:] != pigeon_ids[:-1]]) if n else np.array([], dtype=int)
+    sizes = np.diff(np.r_[starts, n])
+    group_pigeons = pigeon_ids[starts]
+
+    prior = (state if state is not None else empty_state(halflives)).reindex(group_pigeons)
+    prior_count = prior['race_count'].fillna(0).to_numpy('int64')
+    prior_time = prior['last_time'].to_numpy('datetime64[ns]')
+    prior_time = np.where(np.isnat(prior_time), np.nan, prior_time.astype('int64') / 1e9)
+
+    lag = np.empty(n)
+    lag[1:] = velocity[:-1]
+    lag[starts] = prior['last_velocity'].to_numpy(float)
+    valid = ~np.isnan(lag)
+
+    position = np.arange(n) - np.repeat(starts, sizes)
+    df['velocity_lag'] = lag
+    df['race_count'] = position + np.repeat(prior_count, sizes)
+    df['total_race_count'] = np.repeat(sizes + prior_count, sizes)
+
+    velocity_sum = _segmented_cumsum(np.where(valid, lag, 0), starts, sizes)
+    velocity_sum += np.repeat(prior['velocity_sum'].fillna(0).to_numpy(float), sizes)
+    velocity_count = _segmented_cumsum(valid.astype('int64'), starts, sizes)
+    velocity_count += np.repeat(prior['velocity_count'].fillna(0).to_numpy('int64'), sizes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        df['velocity_form_linear'] = np.where(velocity_count > 0, velocity_sum / velocity_count, np.nan)
+
+    columns = [form_column(halflife) for halflife in halflives]
+    halflife_seconds = np.array([pd.Timedelta(halflife).total_seconds() for halflife in halflives])
+    mean = np.column_stack([prior[f'{c}_mean'].to_numpy(float) for c in columns])
+    weight = np.column_stack([prior[f'{c}_weight'].fillna(0).to_numpy(float) for c in columns])
+    form = np.full((n, len(columns)), np.nan)
+
+    # groups ordered by size, so that the groups with a k-th race are always the first ones
+    order = np.argsort(-sizes, kind='stable')
+    mean, weight, last_time = mean[order], weight[order], prior_time[order]
+    order_starts, order_sizes = starts[order], sizes[order]
+    for k in range(sizes.max() if n else 0):
+        m = np.searchsorted(-order_sizes, -k, side='left')
+        rows = order_starts[:m] + k
+
+        elapsed = times[rows] - last_time[:m]
+        decay = np.exp2(-elapsed[:, None] / halflife_seconds[None, :])
+        weight[:m] *= np.where(np.isnan(decay), 1, decay)
+
+        x = lag[rows][:, None]
+        observed = ~np.isnan(x)
+        updated = (weight[:m] * np.nan_to_num(mean[:m]) + x) / (weight[:m] + 1)
+        mean[:m] = np.where(observed, updated, mean[:m])
+        weight[:m] = np.where(observed, weight[:m] + 1, weight[:m])
+
+        form[rows] = mean[:m]
+        last_time[:m] = times[rows]
+
+    for j, c in enumerate(columns):
+        df[c] = form[:, j]
+
+    ends = starts + sizes - 1
+    inverse = np.argsort(order, kind='stable')
+    df_state = pd.DataFrame({
+        'last_velocity': velocity[ends],
+        'last_time': df['release_datetime'].to_numpy('datetime64[ns]')[ends],
+        'race_count': sizes + prior_count,
+        'velocity_sum': velocity_sum[ends],
+        'velocity_count': velocity_count[ends],
+    }, index=pd.Index(group_pigeons, name='pigeon_id'))
+    for j, c in enumerate(columns):
+        df_state[f'{c}_mean'] = mean[inverse, j]
+        df_state[f'{c}_weight'] = weight[inverse, j]
+    return df, df_state
+
+
+class FormLookup:
+    """
+    Form state held as numpy arrays, to compute the form of pigeons entering an upcoming race without going
+    through pandas on every call. Gives the same features as rolling_form on a race appended to the history.
+    """
+
+    def __init__(self, state: pd.DataFrame, halflives: list[str] = (FORM_HALFLIFE,)):
+        self.halflives = list(dict.fromkeys(halflives))
+        self.positions = {pigeon_id: i for i, pigeon_id in enumerate(state.index)}
+        self.columns = [form_column(halflife) for halflife in self.halflives]
+        self.halflife_seconds = np.array([pd.Timedelta(halflife).total_seconds() for halflife in self.halflives])
+
+        # every array ends with the state of a pigeon without history, found at position -1
+        last_time = state['last_time'].to_numpy('datetime64[ns]')
+        last_time = np.where(np.isnat(last_time), np.nan, last_time.astype('int64') / 1e9)
+        self.last_velocity = np.append(state['last_velocity'].to_numpy(float), np.nan)
+        self.last_time = np.append(last_time, np.nan)
+        self.race_count = np.append(state['race_count'].to_numpy('int64'), 0)
+        self.velocity_sum = np.append(state['velocity_sum'].to_numpy(float), 0)
+        self.velocity_count = np.append(state['velocity_count'].to_numpy('int64'), 0)
+        mean = np.column_stack([state[f'{c}_mean'].to_numpy(float) for c in self.columns])
+        weight = np.column_stack([state[f'{c}_weight'].to_numpy(float) for c in self.columns])
+        self.mean = np.vstack([mean, np.full(len(self.columns), np.nan)])
+        self.weight = np.vstack([weight, np.zeros(len(self.columns))])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def features(self, pigeon_ids: list, release_times: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        Parameters
+        ----------
+        pigeon_ids: list
+        release_times: np.ndarray
+            Release time of the race of each pigeon, in seconds since the epoch
+
+        Returns
+        -------
+        Form column to values, pigeons without history get the features of their first race
+        """
+        pos = np.fromiter((self.positions.get(p, -1) for p in pigeon_ids), dtype='int64', count=len(pigeon_ids))
+
+        lag = self.last_velocity[pos]
+        observed = ~np.isnan(lag)
+        race_count = self.race_count[pos]
+        velocity_sum = self.velocity_sum[pos] + np.where(observed, lag, 0)
+        velocity_count = self.velocity_count[pos] + observed
+
+        elapsed = np.asarray(release_times, dtype=float) - self.last_time[pos]
+        weight = self.weight[pos] * np.exp2(-elapsed[:, None] / self.halflife_seconds[None, :])
+        updated = (weight * np.nan_to_num(self.mean[pos]) + lag[:, None]) / (weight + 1)
+        mean = np.where(observed[:, None], updated, self.mean[pos])
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            features = {
+                'velocity_lag': lag,
+                'race_count': race_count,
+                'total_race_count': race_count + 1,
+                'velocity_form_linear': np.where(velocity_count > 0, velocity_sum / velocity_count, np.nan),
+            }
+        features.update({c: mean[:, j] for j, c in enumerate(self.columns)})
+        return features
@@ -0,0 +1,272 @@
+"""Pigeon Form Store
+Persisted per-pigeon form state, so that form features are updated with new race results instead of being
+recomputed over the whole race history.
+
+For every pigeon the state holds the velocity, time and race id of its last race, the number of races seen, the
+running sum and count of its previous velocities, and the mean and weight of the time-decayed exponentially weighted
+mean of its previous velocities for each half-life. A row of a pigeon is new when it is later, by release time then
+race id, than the last race in its state, so an update only touches the rows given to it and never reads the stored
+features.
+
+Results of races still open (see RaceManifest.is_closed) may still be corrected, so they are never committed: the
+committed state only advances over closed races. The results of every pigeon from its first open race onwards are
+kept, and on every update that gives new rows for the pigeon, or finds that one of its open races has closed since,
+they are merged with the given rows (which replace kept results of the same race) and recomputed on top of the
+committed state. Rows of races that have closed in the meantime are then committed.
+
+Layout under DATA_PATH/form_store:
+    meta.json               halflives, parts and row counts
+    state.parquet           state after the closed races of every pigeon
+    features/part-<n>.parquet
+                            form features of closed races, append-only
+    open_state.parquet      state after the open races, of the pigeons with open races
+    open_features.parquet   form features of open races
+    open_results.parquet    race results of the open races, recomputed on update
+
+A result added late to a closed race older than the last stored race of its pigeon is not picked up, rebuild the
+store (delete the directory) to include it.
+
+Usage (with src on PYTHONPATH):
+    python -m data_train.form_store [--snapshot <id>] [--halflives "60 days" "30 days"]
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_train.form import FORM_HALFLIFE, empty_state, form_column, rolling_form
+from data_train.utils import load_data
+from src import DATA_PATH
+from src.data_preprocess.manifest import OPEN_RACE_DAYS, RaceManifest
+
+FORM_STORE_PATH = os.path.join(DATA_PATH, 'form_store')
+KEY_COLUMNS = ['race_id', 'pigeon_id', 'release_datetime']
+RESULT_COLUMNS = KEY_COLUMNS + ['velocity']
+
+
+def _replace_rows(df: pd.DataFrame, df_new: pd.DataFrame) -> pd.DataFrame:
+    """df with the rows of df_new, by index, replaced or appended"""
+    if not len(df_new):
+        return df
+    if not len(df):
+        return df_new
+    return pd.concat([df[~df.index.isin(df_new.index)], df_new])
+
+
+class PigeonFormStore:
+
+    def __init__(self, path: str = FORM_STORE_PATH, halflives: list[str] = (FORM_HALFLIFE,)):
+        """
+        Reads the state of the store, not its features
+
+        Parameters
+        ----------
+        path: str
+            Directory of the store
+        halflives: list[str]
+            Half-lives of the form columns, the store must have been built with the same ones
+        """
+        self.path = path
+        self.halflives = [str(pd.Timedelta(halflife)) for halflife in dict.fromkeys(halflives)]
+        self.form_columns = ['velocity_lag', 'race_count', 'velocity_form_linear']
+        self.form_columns += [form_column(halflife) for halflife in self.halflives]
+
+        self.closed_state = empty_state(self.halflives).assign(last_race_id=pd.Series(dtype='int64'))
+        self.open_state = self.closed_state.copy()
+        self.open_features = pd.DataFrame(columns=KEY_COLUMNS + self.form_columns)
+        self.open_results = pd.DataFrame(columns=RESULT_COLUMNS)
+        self._n_parts = 0
+        self._n_rows = 0
+
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['halflives'] != self.halflives:
+                raise ValueError(f'Form store at {path} was built with halflives {meta["halflives"]}, rebuild it')
+            if 'n_rows' not in meta or not os.path.exists(os.path.join(path, 'open_results.parquet')):
+                raise ValueError(f'Form store at {path} has an older layout, rebuild it')
+
+            self._n_parts, self._n_rows = meta['n_parts'], meta['n_rows']
+            self.closed_state = pd.read_parquet(os.path.join(path, 'state.parquet'))
+            self.open_state = pd.read_parquet(os.path.join(path, 'open_state.parquet'))
+            self.open_features = pd.read_parquet(os.path.join(path, 'open_features.parquet'))
+            self.open_results = pd.read_parquet(os.path.join(path, 'open_results.parquet'))
+        self.state = _replace_rows(self.closed_state, self.open_state)
+
+    def __len__(self):
+        """Race results with stored form features, closed and open"""
+        return self._n_rows + len(self.open_features)
+
+    def _write(self, df: pd.DataFrame, name: str) -> None:
+        path = os.path.join(self.path, name)
+        df.to_parquet(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+    def save(self, df_features_closed: pd.DataFrame = None) -> None:
+        os.makedirs(os.path.join(self.path, 'features'), exist_ok=True)
+        if df_features_closed is not None and len(df_features_closed):
+            part = os.path.join(self.path, 'features', f'part-{self._n_parts:05d}.parquet')
+            df_features_closed.to_parquet(f'{part}.tmp', index=False)
+            os.replace(f'{part}.tmp', part)
+            self._n_parts += 1
+
+        self._write(self.closed_state, 'state.parquet')
+        self._write(self.open_state, 'open_state.parquet')
+        self._write(self.open_features, 'open_features.parquet')
+        self._write(self.open_results, 'open_results.parquet')
+        meta = {
+            'halflives': self.halflives,
+            'n_parts': self._n_parts,
+            'n_rows': self._n_rows,
+            'n_pigeons': len(self.state),
+        }
+        with open(os.path.join(self.path, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(self.path, 'meta.json.tmp'), os.path.join(self.path, 'meta.json'))
+
+    @staticmethod
+    def open_races(df: pd.DataFrame, manifest: RaceManifest = None) -> np.ndarray:
+        """
+        Whether the race of every row is still open: according to the manifest, or for races missing from it,
+        released within OPEN_RACE_DAYS
+        """
+        manifest = manifest if manifest is not None else RaceManifest()
+        closed = df['race_id'].map({race_id: entry['closed'] for race_id, entry in manifest.races.items()})
+        recent = df['release_datetime'] >= pd.Timestamp.now() - pd.Timedelta(days=OPEN_RACE_DAYS)
+        return closed.eq(False).to_numpy() | (closed.isna() & recent).to_numpy()
+
+    def _advance(self, df: pd.DataFrame, state: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Form features of df, sorted by pigeon, release time and race id, and the state after it"""
+        df_features, df_state = rolling_form(df, self.halflives, state=state)
+        df_state['last_race_id'] = df_features.groupby('pigeon_id')['race_id'].last().reindex(df_state.index)
+        return df_features[KEY_COLUMNS + self.form_columns], df_state
+
+    def update(self, df: pd.DataFrame, save: bool = True, manifest: RaceManifest = None) -> pd.DataFrame:
+        """
+        Advances the state of the pigeons in df with their new race results, in O(len(df)) plus the results of open
+        races kept for those pigeons.
+
+        Parameters
+        ----------
+        df: pd.DataFrame
+            Race results with race_id, pigeon_id, release_datetime and velocity. Only new or corrected rows are
+            needed: rows of closed races at or before the last closed race stored for their pigeon are skipped, and
+            the kept results of open races are merged in.
+        save: bool
+            Persist the new state and features
+        manifest: RaceManifest
+            Tells which races are still open, defaults to the manifest on disk
+
+        Returns
+        -------
+        Form features of the new rows and of the recomputed open race results, closed and open
+        """
+        manifest = manifest if manifest is not None else RaceManifest()
+        df = df[RESULT_COLUMNS].copy()
+        df['release_datetime'] = pd.to_datetime(df['release_datetime'])
+
+        last_time = df['pigeon_id'].map(self.closed_state['last_time'])
+        last_race = df['pigeon_id'].map(self.closed_state['last_race_id'])
+        new = last_time.isna() | (df['release_datetime'] > last_time)
+        new |= (df['release_datetime'] == last_time) & (df['race_id'] > last_race)
+        df = df[new.to_numpy()]
+
+        # kept results of open races are recomputed for the pigeons in df and for those with a race closed since
+        open_pigeons = self.open_results['pigeon_id']
+        if len(open_pigeons):
+            open_pigeons = open_pigeons[~self.open_races(self.open_results, manifest)]
+        pigeons = pd.Index(df['pigeon_id'].unique()).union(open_pigeons.unique())
+        kept = self.open_results['pigeon_id'].isin(pigeons)
+        df = pd.concat([self.open_results[kept], df], ignore_index=True) if kept.any() else df
+        df = df.drop_duplicates(['race_id', 'pigeon_id'], keep='last')
+        df = df.sort_values(['pigeon_id', 'release_datetime', 'race_id'], kind='stable').reset_index(drop=True)
+
+        # rows from the first open race of every pigeon onwards are provisional
+        is_open = pd.Series(self.open_races(df, manifest), index=df.index)
+        provisional = is_open.groupby(df['pigeon_id']).cummax()
+        df_closed, df_open = df[~provisional], df[provisional]
+
+        df_features_closed, df_state_closed = self._advance(df_closed, self.closed_state)
+        self.closed_state = _replace_rows(self.closed_state, df_state_closed)
+        df_features_open, df_state_open = self._advance(df_open, self.closed_state)
+
+        # provisional rows of the recomputed pigeons are replaced, those of the other pigeons are kept
+        self.open_features = pd.concat(
+            [self.open_features[~self.open_features['pigeon_id'].isin(pigeons)], df_features_open],
+            ignore_index=True,
+        ) if len(self.open_features) else df_features_open
+        self.open_results = pd.concat(
+            [self.open_results[~kept], df_open], ignore_index=True
+        ) if len(self.open_results) else df_open.reset_index(drop=True)
+        self.open_state = _replace_rows(self.open_state[~self.open_state.index.isin(pigeons)], df_state_open)
+        self.state = _replace_rows(self.closed_state, self.open_state)
+        self._n_rows += len(df_features_closed)
+
+        if save:
+            self.save(df_features_closed)
+        print(
+            f'Updated form of {len(pigeons)} pigeons with {len(df_features_closed)} closed and '
+            f'{len(df_features_open)} open race results'
+        )
+        return pd.concat([df_features_closed, df_features_open], ignore_index=True)
+
+    def features(self, filters: list[tuple] = None) -> pd.DataFrame:
+        """
+        Stored form features, of closed and open races
+
+        Parameters
+        ----------
+        filters: list[tuple]
+            (column, op, value) predicates pushed down to the closed parts, e.g. [('race_id', 'in', race_ids)]
+        """
+        features_path = os.path.join(self.path, 'features')
+        parts = [self.open_features]
+        if self._n_parts:
+            parts.insert(0, pd.read_parquet(features_path, filters=filters))
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return pd.DataFrame(columns=KEY_COLUMNS + self.form_columns)
+        return pd.concat(parts, ignore_index=True).drop_duplicates(['race_id', 'pigeon_id'], keep='last')
+
+    def attach(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the form features of calculate_pigeon_form to df, reading them from the store. Rows of df not yet in
+        the store are added to it first.
+        """
+        self.update(df)
+        df_features = self.features(filters=[('race_id', 'in', df['race_id'].unique().tolist())])
+        df = df.drop(columns=self.form_columns + ['total_race_count'], errors='ignore').merge(
+            df_features[['race_id', 'pigeon_id'] + self.form_columns], on=['race_id', 'pigeon_id'], how='left'
+        )
+        df['total_race_count'] = df['pigeon_id'].map(self.state['race_count'])
+        return df.sort_values(['pigeon_id', 'release_datetime']).reset_index(drop=True)
+
+    def form_for_race(self, pigeon_ids: list, release_datetime: pd.Timestamp) -> pd.DataFrame:
+        """
+        Form features of pigeons entering a race which has not been run yet, without modifying the store.
+        Pigeons with no stored races get the features of a first race.
+        """
+        df_race = pd.DataFrame({
+            'pigeon_id': pigeon_ids, 'release_datetime': pd.Timestamp(release_datetime), 'velocity': np.nan,
+        })
+        df_form, _ = rolling_form(df_race, self.halflives, state=self.state)
+        columns = ['pigeon_id', 'total_race_count'] + self.form_columns
+        return df_race[['pigeon_id']].merge(df_form[columns], on='pigeon_id', how='left')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Update the pigeon form store with the results of a snapshot')
+    parser.add_argument('--snapshot', default=None, help='Defaults to the latest snapshot')
+    parser.add_argument('--halflives', nargs='+', default=[FORM_HALFLIFE])
+    args = parser.parse_args()
+
+    store = PigeonFormStore(halflives=args.halflives)
+    store.update(load_data('df_race_results_final', columns=KEY_COLUMNS + ['velocity'], snapshot=args.snapshot))
+    print(f'Form store holds {len(store)} race results of {len(store.state)} pigeons')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Incremental Training
+Warm-start retraining of a model artifact on the races that arrived since it was last trained.
+
+Instead of refitting on the whole history after every race weekend, the saved booster keeps boosting on the new
+races only: they are read from the feature store, where pigeon form is already computed over the whole history,
+and encoded with the vocabularies of the artifact, so that the existing trees keep their meaning. Category values
+the artifact has not seen, e.g. new pigeons, get the unseen code.
+
+The most recent holdout_days of races are held out. The update is kept only if it does not worsen the holdout score
+of the previous booster by more than tolerance (relative), and the held out races are trained on by the next update.
+
+A full refit on every race up to the holdout replaces the update when
+    * there is no artifact yet, or it was trained on other features or with another objective
+    * the last full refit is older than full_refit_days
+    * more than max_unseen_share of the new category values are not in the vocabularies of the artifact
+
+The settings are read from the incremental section of the model config.
+
+Usage (with src on PYTHONPATH):
+    python -m data_train.incremental velocity [--full]
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import time
+
+import lightgbm as lgb
+import pandas as pd
+from sklearn.metrics import log_loss, mean_squared_error, roc_auc_score
+
+from data_train.artifact import ARTIFACT_FORMAT, ModelArtifact
+from data_train.feature_store import FeatureStore
+from data_train.models.generic import Model
+from data_train.tuning import MODELS
+from data_train.utils import load_config
+from src import MODEL_PATH
+from src.data_preprocess.snapshot_store import SnapshotStore
+
+ROUNDS = 50
+HOLDOUT_DAYS = 28
+TOLERANCE = 0.002
+FULL_REFIT_DAYS = 90
+MAX_UNSEEN_SHARE = 0.05
+
+# metric name to (function of labels and predictions, whether higher is better)
+METRICS = {
+    'binary_logloss': (lambda y, p: log_loss(y.astype(float), p, labels=[0, 1]), False),
+    'rmse': (lambda y, p: mean_squared_error(y, p) ** 0.5, False),
+    'l2': (mean_squared_error, False),
+    'auc': (roc_auc_score, True),
+}
+
+
+def _metric(model: Model) -> str:
+    """First metric of the model params"""
+    metric = model.param.get('metric')
+    metric = metric[0] if isinstance(metric, list) else metric
+    if metric not in METRICS:
+        raise ValueError(f'Unsupported metric {metric} for the holdout guard, use one of {list(METRICS)}')
+    return metric
+
+
+def holdout_score(booster: lgb.Booster, model: Model) -> float:
+    """Score of booster on the test set of model, with the first metric of the model params"""
+    score, _ = METRICS[_metric(model)]
+    return score(model.y_test.to_numpy(), booster.predict(model.df_x_test.to_numpy(float)))
+
+
+def _schema_changed(artifact: ModelArtifact, model: Model) -> bool:
+    return (
+        artifact.feature_names != list(model.df_x_train.columns)
+        or artifact.categorical != model.important_categorical
+        or artifact.meta['objective'] != model.param['objective']
+    )
+
+
+def retrain(name: str, snapshot: str = None, full: bool = False, model_path: str = MODEL_PATH) -> str:
+    """
+    Updates the artifact model_path/<name> with the races of a snapshot it was not trained on
+
+    Parameters
+    ----------
+    name: str
+        arrival or velocity
+    snapshot: str
+        Snapshot id, defaults to the latest snapshot
+    full: bool
+        Refit on the whole history even if an update is possible
+    model_path: str
+
+    Returns
+    -------
+    What was done: full, updated, rejected (the update worsened the holdout and was discarded) or skipped (no new
+    races to train on)
+    """
+    start = time.perf_counter()
+    model_class, config = MODELS[name]
+    settings = load_config(config).get('incremental') or {}
+    path = os.path.join(model_path, name)
+    now = datetime.now()
+
+    artifact, training = None, {}
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['format'] == ARTIFACT_FORMAT:
+            artifact = ModelArtifact(path)
+            training = meta.get('training') or {}
+
+    snapshot = snapshot or SnapshotStore().latest
+    feature_store = FeatureStore()
+    feature_store.build(snapshot)
+    trained_until = pd.Timestamp(training['trained_until']) if training.get('trained_until') else None
+    filters = [('release_datetime', '>=', trained_until)] if trained_until is not None else None
+    latest = feature_store.load(columns=['velocity'], filters=filters, snapshot=snapshot).release_datetime.max()
+    if pd.isna(latest):
+        print(f'No races after {trained_until} in snapshot {snapshot}, {name} is up to date')
+        return 'skipped'
+    holdout_start = latest.normalize() - pd.Timedelta(days=settings.get('holdout_days', HOLDOUT_DAYS))
+
+    reason = None
+    if full:
+        reason = 'requested'
+    elif artifact is None:
+        reason = f'no artifact of format {ARTIFACT_FORMAT} in {path}'
+    elif trained_until is None or not training.get('full_fit'):
+        reason = 'artifact has no training history'
+    elif now - pd.Timestamp(training['full_fit']) > pd.Timedelta(days=settings.get('full_refit_days', FULL_REFIT_DAYS)):
+        reason = f'last full refit on {training["full_fit"]}'
+    elif holdout_start <= trained_until:
+        print(f'No races to train {name} on between {trained_until} and the holdout from {holdout_start}')
+        return 'skipped'
+    else:
+        model = model_class.from_feature_store(
+            config, snapshot, feature_store, train_start=trained_until, train_end=holdout_start
+        )
+        if _schema_changed(artifact, model):
+            reason = 'feature schema changed'
+        else:
+            unseen = model.reencode(artifact.vocab)
+            if unseen > settings.get('max_unseen_share', MAX_UNSEEN_SHARE):
+                reason = f'{unseen:.1%} of the new category values are not in the vocabularies'
+
+    if reason is not None:
+        print(f'Full refit of {name} on races before {holdout_start}: {reason}')
+        model = model_class.from_feature_store(config, snapshot, feature_store, train_end=holdout_start)
+        model.fit()
+        model.save_pickle(os.path.join(model_path, f'{name}.pkl'))
+        model.save_artifact(path, training={'full_fit': now.isoformat(timespec='seconds'), 'updates': 0})
+        print(f'Refitted {name} in {time.perf_counter() - start:.1f}s')
+        return 'full'
+
+    if model.y_train.empty:
+        print(f'No {name} training rows between {trained_until} and {holdout_start} after cleaning')
+        return 'skipped'
+
+    score_before = holdout_score(artifact.booster, model)
+    booster = model.fit(init_model=artifact.booster, num_boost_round=settings.get('rounds', ROUNDS))
+    score_after = holdout_score(booster, model)
+
+    _, higher_is_better = METRICS[_metric(model)]
+    change = (score_after - score_before) / abs(score_before) * (-1 if higher_is_better else 1)
+    print(
+        f'{name} on {len(model.y_train)} new rows: holdout score {score_before:.5f} -> {score_after:.5f} '
+        f'({len(model.y_test)} rows from {holdout_start.date()})'
+    )
+    if change > settings.get('tolerance', TOLERANCE):
+        print(f'Rejected the update of {name}, it worsens the holdout by {change:.2%}')
+        return 'rejected'
+
+    model.save_pickle(os.path.join(model_path, f'{name}.pkl'))
+    model.save_artifact(path, training={**training, 'updates': training.get('updates', 0) + 1})
+    print(f'Updated {name} in {time.perf_counter() - start:.1f}s')
+    return 'updated'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Warm-start retraining of a model on new races')
+    parser.add_argument('model', choices=list(MODELS))
+    parser.add_argument('--snapshot', default=None, help='Snapshot id, defaults to the latest snapshot')
+    parser.add_argument('--full', action='store_true', help='Refit on the whole history')
+    args = parser.parse_args()
+    retrain(args.model, snapshot=args.snapshot, full=args.full)
+
+
+if __name__ == '__main__':
+    main()
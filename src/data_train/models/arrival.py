@@ -6,7 +6,6 @@ from sklearn.metrics import RocCurveDisplay, classification_report, confusion_ma
 import os
 
 from data_train.models.generic import Model
-from data_train.utils import load_data
 from src import MODEL_PATH
 
 pd.set_option('display.max_columns', None)
@@ -17,9 +16,9 @@ class ArrivalModel(Model):
 
     def plot(self):
         model = self.model
-        lgb.plot_metric(model)
-        y_pred_train = model.predict_proba(self.df_x_train)[:, 1]
-        y_pred = model.predict_proba(self.df_x_test)[:, 1]
+        lgb.plot_metric(self.evals_result)
+        y_pred_train = model.predict(self.df_x_train)
+        y_pred = model.predict(self.df_x_test)
         t = 0.7
 
         print('------------ TRAIN DATA ------------')
@@ -61,7 +60,7 @@ class ArrivalModel(Model):
         plt.legend()
 
         feature_importances = {f: imp for imp, f in
-                               zip(model.feature_importances_, model.feature_name_)}
+                               zip(model.feature_importance(), model.feature_name())}
         dict(sorted(feature_importances.items(), key=lambda item: item[1], reverse=True))
 
         # TODO: use log instead of print
@@ -71,11 +70,11 @@ class ArrivalModel(Model):
 
 def main() -> None:
 
-    df_race_results_final = load_data('df_race_results_final')
-    am = ArrivalModel(df_race_results_final, 'arrival_params.yaml')
+    am = ArrivalModel.from_feature_store('arrival_params.yaml')
     am.fit()
     am.plot()
     am.save_pickle(os.path.join(MODEL_PATH, 'arrival.pkl'))
+    am.save_artifact(os.path.join(MODEL_PATH, 'arrival'))
 
 
 if __name__ == '__main__':
@@ -1,28 +1,46 @@
-from sklearn.preprocessing import LabelEncoder
-
 import lightgbm as lgb
+import numpy as np
 import pandas as pd
+from datetime import datetime
+import json
 import os
-from src import PARAMS_PATH
+from data_train.artifact import save_artifact
+from data_train.categorical import UNSEEN_CODE, encode, fit_vocab, to_categorical
+from data_train.dataset_cache import DatasetCache, binning_params
+from data_train.form import FORM_HALFLIFE, halflives_from_features, rolling_form
+from data_train.feature_store import FeatureStore
+from data_train.form_store import PigeonFormStore
+from data_train.utils import load_config, load_data
+from src.data_preprocess.snapshot_store import SnapshotStore
 import pickle
-import yaml
-
-
-# TODO: data should be in DB and this should be calculated once
-def calculate_pigeon_form(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.sort_values(['pigeon_id', 'release_datetime']).reset_index(drop=True)
-    df['velocity_lag'] = df.groupby('pigeon_id').velocity.shift()
-    df['race_count'] = df.groupby('pigeon_id').velocity_lag.cumcount()
-    df['total_race_count'] = df.groupby('pigeon_id').pigeon_id.transform('count')
-    df['velocity_form'] = df.groupby('pigeon_id').velocity_lag.ewm(
-        halflife='60 days', times=pd.DatetimeIndex(df.release_datetime)
-    ).mean().values
-    df['velocity_form_linear'] = df.groupby('pigeon_id').velocity_lag.expanding().mean().values
+
+# objectives whose artifacts keep the residual distribution, see data_train.artifact
+REGRESSION_OBJECTIVES = {'regression', 'regression_l2', 'l2', 'mean_squared_error', 'mse', 'l2_root', 'rmse'}
+BASE_COLUMNS = ['race_id', 'pigeon_id', 'release_datetime', 'arrival_datetime', 'velocity']
+DERIVED_COLUMNS = ['arrived', 'velocity_lag', 'race_count', 'total_race_count', 'velocity_form', 'velocity_form_linear']
+
+
+def calculate_pigeon_form(df: pd.DataFrame, halflives: list[str] = (FORM_HALFLIFE,)) -> pd.DataFrame:
+    """
+    Lagged velocity, race counts and velocity form of every pigeon before each of its races, see rolling_form.
+    Every half-life adds a form column, velocity_form for 60 days and velocity_form_<days>d otherwise.
+    """
+    df, _ = rolling_form(df, halflives)
     return df
 
 
 class Model:
-    def __init__(self, df: pd.DataFrame, config: str):
+    def __init__(
+            self,
+            df: pd.DataFrame,
+            config: str,
+            form_store: PigeonFormStore = None,
+            encoded: bool = False,
+            vocab: dict[str, np.ndarray] = None,
+            dataset_cache: DatasetCache = None,
+            train_start: str = None,
+            train_end: str = None,
+    ):
         """
 
         Parameters
@@ -31,25 +49,138 @@ class Model:
             DataFrame containing all features and prediction columns
         config: str
             Yaml file name containing model parameters
+        form_store: PigeonFormStore
+            If given, pigeon form is read from the store, which is only updated with the races it has not seen,
+            instead of being recomputed over the whole history
+        encoded: bool
+            df is read from the FeatureStore: pigeon form, arrived and datetimes are already computed and
+            categorical columns already encoded
+        vocab: dict[str, np.ndarray]
+            Vocabulary of every encoded categorical column, see data_train.categorical. Required if encoded
+        dataset_cache: DatasetCache
+            If given, the binned train and test datasets are read from the cache, or built and saved to it
+        train_start: str
+            Overrides the train_start of the config
+        train_end: str
+            Overrides the train_end of the config, races from train_end onwards are the test set
         """
-        with open(os.path.join(PARAMS_PATH, config), 'r') as f:
-            config = yaml.safe_load(f)
+        config = load_config(config)
+        self.config = config
 
         self.pred_col = config['pred_col']
         self.param = config['model_params']
-        self.train_start = pd.Timestamp(config['train_start'])
-        self.train_end = pd.Timestamp(config['train_end'])
+        self.train_start = pd.Timestamp(train_start or config['train_start'])
+        self.train_end = pd.Timestamp(train_end or config['train_end'])
         self.covariates = config['features']['covariates']
         self.categorical = config['features']['categorical']
 
-        self.df = calculate_pigeon_form(df)
-        self.df['arrived'] = ~self.df.arrival_datetime.isna()
-        self.df['arrival_datetime'] = pd.to_datetime(self.df['arrival_datetime'], unit='ms', errors='ignore')
-        self.df['release_datetime'] = pd.to_datetime(df['release_datetime'])
+        self.encoded = encoded
+        self.vocab = dict(vocab or {})
+        self.dataset_cache = dataset_cache
+        if encoded:
+            self.df = df
+        else:
+            halflives = halflives_from_features(self.covariates)
+            if form_store is not None:
+                missing = [str(pd.Timedelta(h)) for h in halflives if str(pd.Timedelta(h)) not in form_store.halflives]
+                if missing:
+                    raise ValueError(
+                        f'Form store at {form_store.path} has halflives {form_store.halflives}, the covariates '
+                        f'also need {missing}: open it with halflives_from_features of the covariates'
+                    )
+                self.df = form_store.attach(df)
+            else:
+                self.df = calculate_pigeon_form(df, halflives)
+            self.df['arrived'] = ~self.df.arrival_datetime.isna()
+            self.df['arrival_datetime'] = pd.to_datetime(self.df['arrival_datetime'], unit='ms', errors='ignore')
+            self.df['release_datetime'] = pd.to_datetime(self.df['release_datetime'])
         self.df = self.clean()
 
         self.df_x_train, self.df_x_test, self.y_train, self.y_test = self.train_test_split()
         self._model = None
+        self.evals_result = {}
+
+    @classmethod
+    def from_snapshot(cls, config: str, snapshot: str = None, form_store: PigeonFormStore = None):
+        """
+        Loads only the columns the model needs, from history_start onwards, out of the snapshot store.
+
+        Parameters
+        ----------
+        config: str
+            Yaml file name containing model parameters
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot
+        form_store: PigeonFormStore
+            Persisted pigeon form, see __init__
+        """
+        params = load_config(config)
+        features = params['features']
+        columns = BASE_COLUMNS + features['covariates'] + features['categorical'] + [params['pred_col']]
+        columns = [c for c in dict.fromkeys(columns) if c not in DERIVED_COLUMNS]
+
+        filters = None
+        if params.get('history_start'):
+            filters = [('release_datetime', '>=', pd.Timestamp(params['history_start']))]
+
+        snapshot = snapshot or SnapshotStore().latest
+        df = load_data('df_race_results_final', columns=columns, filters=filters, snapshot=snapshot)
+        return cls(df, config, form_store=form_store, dataset_cache=DatasetCache(snapshot))
+
+    @classmethod
+    def from_feature_store(
+            cls,
+            config: str,
+            snapshot: str = None,
+            feature_store: FeatureStore = None,
+            train_start: str = None,
+            train_end: str = None,
+    ):
+        """
+        Reads the features of the model, from history_start onwards, out of the feature store of a snapshot.
+        Feature groups missing from the store or outdated are built first.
+
+        Parameters
+        ----------
+        config: str
+            Yaml file name containing model parameters
+        snapshot: str
+            Snapshot id, defaults to the latest snapshot
+        feature_store: FeatureStore
+            Defaults to the store of all model configs under DATA_PATH
+        train_start: str
+            Overrides the train_start of the config. Only races from train_start onwards are read, pigeon form
+            is computed over the whole history by the store.
+        train_end: str
+            Overrides the train_end of the config
+        """
+        params = load_config(config)
+        snapshot = snapshot or SnapshotStore().latest
+        feature_store = feature_store or FeatureStore()
+        feature_store.build(snapshot)
+
+        features = params['features']
+        columns = DERIVED_COLUMNS + features['covariates'] + features['categorical'] + [params['pred_col']]
+        filters = None
+        if train_start or params.get('history_start'):
+            filters = [('release_datetime', '>=', pd.Timestamp(train_start or params['history_start']))]
+
+        df = feature_store.load(columns=list(dict.fromkeys(columns)), filters=filters, snapshot=snapshot)
+        vocab = {c: feature_store.vocab(c, snapshot) for c in features['categorical']}
+
+        # features rebuilt for the same snapshot invalidate its cached datasets
+        groups = feature_store.manifest(snapshot)['groups']
+        data_version = json.dumps({group: [v['version'], v['built']] for group, v in groups.items()}, sort_keys=True)
+        dataset_cache = DatasetCache(snapshot, data_version=data_version)
+        return cls(
+            df,
+            config,
+            encoded=True,
+            vocab=vocab,
+            dataset_cache=dataset_cache,
+            train_start=train_start,
+            train_end=train_end,
+        )
 
     def clean(self) -> pd.DataFrame:
         return self.df
@@ -64,16 +195,25 @@ class Model:
     def train_test_split(self):
         important_features = self.categorical + self.covariates  # comment if we want specific features
 
-        important_categorical = list(set(self.categorical) & set(important_features))
-        important_covariates = list(set(self.covariates) & set(important_features))
+        # in config order, so that the feature order, and with it the cached datasets, is the same on every run
+        important_categorical = [c for c in dict.fromkeys(self.categorical) if c in important_features]
+        important_covariates = [c for c in dict.fromkeys(self.covariates) if c in important_features]
+        self.important_categorical = important_categorical
+        self.important_covariates = important_covariates
 
-        label_encoders = {}
+        # fixed-vocabulary category dtypes, passed to LightGBM as native categorical features
+        categories = {}
         for c in important_categorical:
-            label_encoder = LabelEncoder()
-            self.df.loc[:, c] = label_encoder.fit_transform(self.df[c])
-            label_encoders[c] = label_encoder
+            if not self.encoded:
+                self.vocab[c] = fit_vocab(self.df[c])
+                codes = encode(self.vocab[c], self.df[c])
+            else:
+                codes = self.df[c].to_numpy('int32')
+            categories[c] = to_categorical(codes, self.vocab[c])
+        self.df = self.df.assign(**categories)
+        return self.split()
 
-        self.df[important_categorical] = self.df[important_categorical].astype(float)
+    def split(self):
         df_xy_train = self.df[
             (self.df.release_datetime >= self.train_start) &
             (self.df.release_datetime < self.train_end)
@@ -81,19 +221,88 @@ class Model:
 
         df_xy_test = self.df[self.df.release_datetime >= self.train_end]
 
-        df_x_train = df_xy_train[important_categorical + important_covariates]
+        df_x_train = df_xy_train[self.important_categorical + self.important_covariates]
         y_train = df_xy_train[self.pred_col]
 
-        df_x_test = df_xy_test[important_categorical + important_covariates]
+        df_x_test = df_xy_test[self.important_categorical + self.important_covariates]
         y_test = df_xy_test[self.pred_col]
         return df_x_train, df_x_test, y_train, y_test
 
-    def fit(self):
-        lgbm = lgb.LGBMRegressor if self.param['objective'] == 'regression' else lgb.LGBMClassifier
-        model = lgbm(**self.param)
-        model.fit(
-            self.df_x_train, self.y_train,
-            eval_set=[(self.df_x_test, self.y_test), (self.df_x_train, self.y_train)]
+    def reencode(self, vocab: dict[str, np.ndarray]) -> float:
+        """
+        Re-encodes the categorical features with the vocabularies of a previously trained booster, e.g. of a
+        ModelArtifact, so that the booster can keep training on them. Values not in vocab get UNSEEN_CODE.
+
+        Returns
+        -------
+        Share of the non-missing categorical values not in vocab
+        """
+        categories = {}
+        n_values, n_unseen = 0, 0
+        for c in self.important_categorical:
+            new_vocab = np.array(vocab[c])
+            codes = self.df[c].to_numpy('int32')
+            remap = np.append(np.int32(UNSEEN_CODE), encode(new_vocab, self.vocab[c]))
+            categories[c] = to_categorical(remap[codes], new_vocab)
+            present = codes != UNSEEN_CODE
+            n_values += present.sum()
+            n_unseen += (remap[codes[present]] == UNSEEN_CODE).sum()
+            self.vocab[c] = new_vocab
+
+        self.df = self.df.assign(**categories)
+        self.df_x_train, self.df_x_test, self.y_train, self.y_test = self.split()
+        return n_unseen / max(n_values, 1)
+
+    def datasets(self, use_cache: bool = True) -> tuple[lgb.Dataset, lgb.Dataset]:
+        """Binned train and test datasets, read from the dataset cache if it has them"""
+        dataset_params = binning_params(self.param)
+        use_cache = use_cache and self.dataset_cache is not None
+        if use_cache:
+            config = {**self.config, 'train_start': self.train_start, 'train_end': self.train_end}
+            key = self.dataset_cache.key(type(self).__name__, config, self.encoded)
+            cached = self.dataset_cache.load(
+                key, list(self.df_x_train.columns), len(self.df_x_train), len(self.df_x_test), params=dataset_params
+            )
+            if cached is not None:
+                return cached
+
+        train = lgb.Dataset(
+            self.df_x_train, self.y_train, categorical_feature=self.important_categorical, params=dataset_params
+        )
+        test = lgb.Dataset(
+            self.df_x_test,
+            self.y_test,
+            reference=train,
+            categorical_feature=self.important_categorical,
+            params=dataset_params,
+        )
+        if use_cache:
+            self.dataset_cache.save(key, train, test)
+        return train, test
+
+    def fit(self, init_model: lgb.Booster = None, num_boost_round: int = None) -> lgb.Booster:
+        """
+        Parameters
+        ----------
+        init_model: lgb.Booster
+            Keep boosting from this booster, trained on the same features and vocabularies (see reencode)
+        num_boost_round: int
+            Boosting rounds, defaults to n_estimators of the config
+        """
+        params = dict(self.param)
+        n_estimators = params.pop('n_estimators', 100)
+        # the initial scores of a warm start are predicted from the raw data, which cached datasets do not have
+        train, test = self.datasets(use_cache=init_model is None)
+
+        self.evals_result = {}
+        model = lgb.train(
+            params,
+            train,
+            num_boost_round=num_boost_round or n_estimators,
+            valid_sets=[test, train],
+            valid_names=['test', 'train'],
+            init_model=init_model,
+            callbacks=[lgb.record_evaluation(self.evals_result)],
         )
         self._model = model
         return model
@@ -104,3 +313,32 @@ class Model:
     def save_pickle(self, path):
         with open(path, 'wb') as f:
             pickle.dump(self.model, f)
+
+    def save_artifact(self, path: str, training: dict = None) -> None:
+        """
+        Saves the booster with the vocabularies of its categorical features, and the residuals on the test set of
+        regression models, see data_train.artifact
+
+        Parameters
+        ----------
+        path: str
+        training: dict
+            Training history kept in the artifact metadata, defaults to a full fit now. trained_until, the train_end
+            of the fit, is added.
+        """
+        booster = self.model
+        vocab = {c: self.vocab[c] for c in booster.feature_name() if c in self.vocab}
+        training = training or {'full_fit': datetime.now().isoformat(timespec='seconds'), 'updates': 0}
+        training = {**training, 'trained_until': self.train_end.isoformat()}
+        residuals = None
+        if self.param['objective'] in REGRESSION_OBJECTIVES and len(self.y_test):
+            residuals = self.y_test.to_numpy(float) - booster.predict(self.df_x_test)
+        save_artifact(
+            path,
+            booster,
+            vocab,
+            self.config,
+            name=os.path.basename(os.path.normpath(path)),
+            training=training,
+            residuals=residuals,
+        )
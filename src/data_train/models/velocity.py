@@ -9,7 +9,6 @@ import numpy as np
 import os
 
 from data_train.models.generic import Model
-from data_train.utils import load_data
 from src import MODEL_PATH
 
 pd.set_option('display.max_columns', None)
@@ -20,7 +19,7 @@ class VelocityModel(Model):
 
     def plot(self):
         model = self.model
-        lgb.plot_metric(model.evals_result_)
+        lgb.plot_metric(self.evals_result)
         plt.figure()
 
         y_pred = model.predict(self.df_x_train)
@@ -45,7 +44,7 @@ class VelocityModel(Model):
         lgb.plot_importance(model, importance_type="gain")
         plt.show()
 
-        feature_importances = {f: imp for imp, f in zip(model.feature_importances_, model.feature_name_)}
+        feature_importances = {f: imp for imp, f in zip(model.feature_importance(), model.feature_name())}
 
         # TODO: use log instead of print
         print(dict(sorted(feature_importances.items(), key=lambda item: item[1], reverse=True)))
@@ -59,12 +58,11 @@ class VelocityModel(Model):
 
 def main() -> None:
 
-    df_race_results_final = load_data('df_race_results_final')
-
-    vm = VelocityModel(df_race_results_final, 'velocity_params.yaml')
+    vm = VelocityModel.from_feature_store('velocity_params.yaml')
     vm.fit()
     vm.plot()
     vm.save_pickle(os.path.join(MODEL_PATH, 'velocity.pkl'))
+    vm.save_artifact(os.path.join(MODEL_PATH, 'velocity'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,325 @@
+"""Tuning
+Rolling-origin cross-validation and successive-halving hyperparameter search of a Model.
+
+Folds are expanding windows by season: the last n_folds seasons of the training window (train_start to train_end)
+are validated in turn, each on a model trained on every earlier race of the window. The test period after train_end
+is left untouched for the final evaluation.
+
+The feature matrix is built once, as float32 rows sorted by release time, and placed in shared memory. Workers of a
+process pool attach to it read-only, so that the training rows of a fold are a prefix of the matrix and its
+validation rows the slice after it, both views rather than copies. Each worker keeps the binned datasets of the folds
+it has seen, keyed by the parameters that affect binning (see data_train.dataset_cache).
+
+Candidates are sampled from the search space of the tuning section of the model config and raced with successive
+halving: every candidate is cross-validated with few boosting rounds, and only the best 1/eta of them go on to the
+next rung with eta times more rounds. The scores of every rung form the leaderboard, saved under
+MODEL_PATH/tuning/<model>_leaderboard.parquet.
+
+Usage (with src on PYTHONPATH):
+    python -m data_train.tuning arrival --workers 4
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import time
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import ParameterSampler
+
+from data_train.dataset_cache import binning_params
+from data_train.models.arrival import ArrivalModel
+from data_train.models.generic import Model
+from data_train.models.velocity import VelocityModel
+from src import MODEL_PATH
+
+MODELS = {
+    'arrival': (ArrivalModel, 'arrival_params.yaml'),
+    'velocity': (VelocityModel, 'velocity_params.yaml'),
+}
+TUNING_PATH = os.path.join(MODEL_PATH, 'tuning')
+N_FOLDS = 3
+N_CANDIDATES = 27
+MAX_ROUNDS = 600
+ETA = 3
+N_RUNGS = 3
+HIGHER_IS_BETTER = {'auc', 'average_precision', 'map', 'ndcg', 'auc_mu'}
+THREAD_PARAMS = {'num_threads', 'nthread', 'nthreads', 'num_thread', 'n_jobs'}
+
+# state of a pool worker, set by _init_worker
+_worker = {}
+
+
+def season_folds(release_datetime: pd.Series, n_folds: int = N_FOLDS) -> list[tuple[int, int, int]]:
+    """
+    Expanding-window folds over rows sorted by release time
+
+    Returns
+    -------
+    (season, train_end, valid_end) of every fold: it trains on rows [0, train_end) and validates on rows
+    [train_end, valid_end), the races of the season
+
+    Raises
+    ------
+    ValueError if the window has fewer than n_folds + 1 seasons
+    """
+    seasons = release_datetime.dt.year.to_numpy()
+    if (np.diff(seasons) < 0).any():
+        raise ValueError('Rows must be sorted by release_datetime')
+
+    unique_seasons, starts = np.unique(seasons, return_index=True)
+    if len(unique_seasons) < n_folds + 1:
+        raise ValueError(f'{n_folds} folds need at least {n_folds + 1} seasons, found {list(unique_seasons)}')
+
+    ends = np.append(starts[1:], len(seasons))
+    return [(int(s), int(start), int(end)) for s, start, end in zip(unique_seasons, starts, ends)][-n_folds:]
+
+
+def sample_candidates(space: dict[str, list], n_candidates: int = N_CANDIDATES, seed: int = 0) -> list[dict]:
+    """Distinct random parameter sets from a search space of parameter name to candidate values"""
+    n_combinations = math.prod(len(values) for values in space.values())
+    return list(ParameterSampler(space, n_iter=min(n_candidates, n_combinations), random_state=seed))
+
+
+def halving_schedule(
+        n_candidates: int,
+        max_rounds: int = MAX_ROUNDS,
+        eta: int = ETA,
+        n_rungs: int = N_RUNGS,
+) -> list[tuple[int, int]]:
+    """(number of candidates, boosting rounds) of every rung, ending with max_rounds"""
+    schedule = []
+    for rung in range(n_rungs):
+        rounds = max(1, round(max_rounds / eta ** (n_rungs - 1 - rung)))
+        schedule.append((n_candidates, rounds))
+        n_candidates = max(1, math.ceil(n_candidates / eta))
+    return schedule
+
+
+def _init_worker(x_spec: tuple, y_spec: tuple, categorical: list[int], feature_names: list[str]) -> None:
+    for name, spec in (('x', x_spec), ('y', y_spec)):
+        shm_name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=shm_name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        _worker[name] = array
+        _worker[f'{name}_shm'] = shm
+    _worker['categorical'] = categorical
+    _worker['feature_names'] = feature_names
+    _worker['datasets'] = {}
+
+
+def _datasets(train_end: int, valid_end: int, params: dict) -> tuple[lgb.Dataset, lgb.Dataset]:
+    dataset_params = binning_params(params)
+    key = (train_end, valid_end, json.dumps(dataset_params, sort_keys=True))
+    if key not in _worker['datasets']:
+        x, y = _worker['x'], _worker['y']
+        kwargs = dict(
+            feature_name=_worker['feature_names'],
+            categorical_feature=_worker['categorical'],
+            params=dataset_params,
+            free_raw_data=False,
+        )
+        train = lgb.Dataset(x[:train_end], y[:train_end], **kwargs)
+        valid = lgb.Dataset(x[train_end:valid_end], y[train_end:valid_end], reference=train, **kwargs)
+        _worker['datasets'][key] = train, valid
+    return _worker['datasets'][key]
+
+
+def _fit_fold(params: dict, train_end: int, valid_end: int, rounds: int, early_stopping_rounds: int = None) -> dict:
+    """Validation score of params on one fold, run in a pool worker"""
+    start = time.perf_counter()
+    train, valid = _datasets(train_end, valid_end, params)
+    evals_result = {}
+    callbacks = [lgb.record_evaluation(evals_result)]
+    if early_stopping_rounds:
+        callbacks.append(lgb.early_stopping(early_stopping_rounds, first_metric_only=True, verbose=False))
+
+    booster = lgb.train(
+        params, train, num_boost_round=rounds, valid_sets=[valid], valid_names=['valid'], callbacks=callbacks
+    )
+    metric, scores = next(iter(evals_result['valid'].items()))
+    best_iteration = booster.best_iteration or len(scores)
+    return {
+        'metric': metric,
+        'score': scores[best_iteration - 1],
+        'best_iteration': best_iteration,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def _shared_array(array: np.ndarray) -> tuple[shared_memory.SharedMemory, tuple]:
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+class RollingOriginSearch:
+
+    def __init__(self, model: Model, n_folds: int = N_FOLDS, workers: int = None):
+        """
+        Parameters
+        ----------
+        model: Model
+            ArrivalModel or VelocityModel, not fitted, whose training window is cross-validated
+        n_folds: int
+            Number of validated seasons
+        workers: int
+            Size of the process pool, defaults to the number of CPUs. The CPUs are shared between the workers.
+        """
+        self.model = model
+        self.workers = workers or os.cpu_count()
+        self.threads = max(1, (os.cpu_count() or 1) // self.workers)
+
+        df_x = model.df_x_train
+        release = model.df.release_datetime
+        release = release[(release >= model.train_start) & (release < model.train_end)]
+        order = np.argsort(release.to_numpy(), kind='stable')
+
+        self.feature_names = list(df_x.columns)
+        self.categorical = [j for j, c in enumerate(self.feature_names) if c in model.important_categorical]
+        self.x = np.empty((len(df_x), len(self.feature_names)), dtype='float32')
+        for j, c in enumerate(self.feature_names):
+            self.x[:, j] = df_x[c].to_numpy('float32', na_value=np.nan)[order]
+        self.y = model.y_train.to_numpy(float)[order]
+        self.folds = season_folds(release.iloc[order].reset_index(drop=True), n_folds)
+
+        metric = model.param.get('metric')
+        metric = metric[0] if isinstance(metric, list) else metric
+        self.higher_is_better = metric in HIGHER_IS_BETTER
+        print(
+            f'{len(self.folds)} folds validating seasons {[season for season, _, _ in self.folds]} '
+            f'on {self.x.shape[0]} rows of {self.x.shape[1]} features'
+        )
+
+    def params(self, candidate: dict) -> dict:
+        params = {k: v for k, v in self.model.param.items() if k not in THREAD_PARAMS and k != 'n_estimators'}
+        return {**params, **candidate, 'num_threads': self.threads, 'verbose': -1}
+
+    def run(
+            self,
+            candidates: list[dict],
+            max_rounds: int = MAX_ROUNDS,
+            eta: int = ETA,
+            n_rungs: int = N_RUNGS,
+            early_stopping_rounds: int = None,
+    ) -> pd.DataFrame:
+        """
+        Successive halving of candidates over the folds
+
+        Parameters
+        ----------
+        candidates: list[dict]
+            Parameter sets overriding the model_params of the config
+        max_rounds: int
+            Boosting rounds of the last rung
+        eta: int
+            Each rung keeps the best 1/eta of the candidates, with eta times more rounds
+        n_rungs: int
+        early_stopping_rounds: int
+            If given, a fold stops once its validation score has not improved for this many rounds, and is scored
+            at its best iteration
+
+        Returns
+        -------
+        Leaderboard with the mean and standard deviation of the fold scores of every candidate at every rung it
+        reached, best first
+        """
+        schedule = halving_schedule(len(candidates), max_rounds, eta, n_rungs)
+        x_shm, x_spec = _shared_array(self.x)
+        y_shm, y_spec = _shared_array(self.y)
+        rows = []
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(x_spec, y_spec, self.categorical, self.feature_names),
+            ) as executor:
+                alive = list(range(len(candidates)))
+                for rung, (n_keep, rounds) in enumerate(schedule):
+                    alive = alive[:n_keep]
+                    start = time.perf_counter()
+                    futures = {
+                        (i, season): executor.submit(
+                            _fit_fold, self.params(candidates[i]), train_end, valid_end, rounds, early_stopping_rounds
+                        )
+                        for i in alive for season, train_end, valid_end in self.folds
+                    }
+                    results = {key: future.result() for key, future in futures.items()}
+
+                    rung_rows = []
+                    for i in alive:
+                        folds = [results[(i, season)] for season, _, _ in self.folds]
+                        scores = np.array([fold['score'] for fold in folds])
+                        rung_rows.append({
+                            'candidate': i,
+                            'rung': rung,
+                            'rounds': rounds,
+                            'metric': folds[0]['metric'],
+                            'score': scores.mean(),
+                            'score_std': scores.std(),
+                            'best_iteration': int(np.mean([fold['best_iteration'] for fold in folds])),
+                            'fit_seconds': sum(fold['seconds'] for fold in folds),
+                            **candidates[i],
+                        })
+                    rung_rows.sort(key=lambda row: row['score'], reverse=self.higher_is_better)
+                    alive = [row['candidate'] for row in rung_rows]
+                    rows += rung_rows
+                    print(
+                        f'Rung {rung}: {len(rung_rows)} candidates x {len(self.folds)} folds with {rounds} rounds '
+                        f'in {time.perf_counter() - start:.1f}s, best {rung_rows[0]["metric"]} '
+                        f'{rung_rows[0]["score"]:.5f}'
+                    )
+        finally:
+            for shm in (x_shm, y_shm):
+                shm.close()
+                shm.unlink()
+
+        df_leaderboard = pd.DataFrame(rows)
+        df_leaderboard['_sort'] = df_leaderboard.score if self.higher_is_better else -df_leaderboard.score
+        df_leaderboard = df_leaderboard.sort_values(['rung', '_sort'], ascending=False).drop(columns='_sort')
+        return df_leaderboard.reset_index(drop=True)
+
+
+def save_leaderboard(df_leaderboard: pd.DataFrame, name: str, path: str = TUNING_PATH) -> str:
+    os.makedirs(path, exist_ok=True)
+    file = os.path.join(path, f'{name}_leaderboard.parquet')
+    df_leaderboard.to_parquet(file, index=False)
+    print(f'Saved leaderboard of {df_leaderboard.candidate.nunique()} candidates to {file}')
+    return file
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Rolling-origin cross-validated hyperparameter search')
+    parser.add_argument('model', choices=list(MODELS))
+    parser.add_argument('--workers', type=int, default=None, help='Size of the process pool, defaults to the CPUs')
+    parser.add_argument('--snapshot', default=None, help='Snapshot id, defaults to the latest snapshot')
+    args = parser.parse_args()
+
+    model_class, config = MODELS[args.model]
+    model = model_class.from_feature_store(config, snapshot=args.snapshot)
+    tuning = model.config.get('tuning') or {}
+
+    search = RollingOriginSearch(model, n_folds=tuning.get('n_folds', N_FOLDS), workers=args.workers)
+    candidates = sample_candidates(
+        tuning['search_space'], tuning.get('n_candidates', N_CANDIDATES), seed=tuning.get('seed', 0)
+    )
+    df_leaderboard = search.run(
+        candidates,
+        max_rounds=tuning.get('max_rounds', MAX_ROUNDS),
+        eta=tuning.get('eta', ETA),
+        n_rungs=tuning.get('n_rungs', N_RUNGS),
+        early_stopping_rounds=tuning.get('early_stopping_rounds'),
+    )
+    save_leaderboard(df_leaderboard, args.model)
+    print(df_leaderboard.head(10).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,33 @@
-from datetime import datetime
 import os
+
 import pandas as pd
-from src import DATA_PATH
+import yaml
+
+from src import PARAMS_PATH
+from src.data_preprocess.snapshot_store import SnapshotStore
 
 
-def get_latest_file(prefix) -> str:
-    dt_max = datetime(1970, 1, 1)
-    f_max = ''
-    for f in os.listdir(DATA_PATH):
-        try:
-            if not f.startswith(prefix):
-                continue
-            dt = f.split(prefix)[1].split('.')[0].strip('_')
-            dt = datetime.strptime(dt, '%Y_%m_%d_%H_%M_%S')
-            if dt > dt_max:
-                dt_max = dt
-                f_max = f
-        except (IndexError, ValueError):
-            continue
-    print(f'Loading {f_max}')
-    return os.path.join(DATA_PATH, f_max)
+def load_config(config: str) -> dict:
+    with open(os.path.join(PARAMS_PATH, config), 'r') as f:
+        return yaml.safe_load(f)
 
 
-def load_data(model_name: str) -> pd.DataFrame:
-    df = pd.read_csv(get_latest_file(model_name))
-    return df
+def load_data(
+        table_name: str,
+        columns: list[str] = None,
+        filters: list[tuple] = None,
+        snapshot: str = None,
+) -> pd.DataFrame:
+    """
+    Parameters
+    ----------
+    table_name: str
+        Name of the table in the snapshot store, e.g. df_race_results_final
+    columns: list[str]
+        Only load these columns. Defaults to all columns.
+    filters: list[tuple]
+        (column, op, value) predicates pushed down to the store, e.g. [('release_datetime', '>=', ts)]
+    snapshot: str
+        Snapshot id. Defaults to the latest snapshot.
+    """
+    return SnapshotStore().load(table_name, columns=columns, filters=filters, snapshot=snapshot)